@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Node-wide resource admission control shared by the run_* scripts.
+
+Every job reserves its expected memory and CPUs in a ledger file on the
+local node before it starts and releases them when it finishes. Scripts
+running concurrently on the same node see each other's reservations, and a
+job is admitted only when it fits in the remaining resources.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from contextlib import contextmanager
+from socket import gethostname
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import psutil
+
+import profiler
+
+
+# %% Settings =================================================================
+STATE_DIR = profiler.STATE_DIR
+PROFILE_F = STATE_DIR / 'stage_profiles.json'
+
+# The ledger must be local to the node
+if Path('/dev/shm').is_dir():
+    LEDGER_F = Path('/dev/shm') / f"tractoflowproc_ledger_{gethostname()}.json"
+else:
+    LEDGER_F = Path(tempfile.gettempdir()) / \
+        f"tractoflowproc_ledger_{gethostname()}.json"
+
+# Fallback profiles used until the stage has been measured by profiler.
+# mem: bytes, cpu: number of cores
+DEFAULT_PROFILES = {
+    'tractoflow': {'mem': 10 * 10e8, 'cpu': 4},
+    'freewaterflow': {'mem': 20 * 10e8, 'cpu': 4},
+    'freesurfer': {'mem': 4 * 10e8, 'cpu': 4},
+    'ants_registration': {'mem': 4 * 10e8, 'cpu': 1},
+    'bedpostx': {'mem': 2 * 10e8, 'cpu': 1},
+    'xtract': {'mem': 4 * 10e8, 'cpu': 1},
+    'xtract_stats': {'mem': 2 * 10e8, 'cpu': 1},
+    'probtrackx': {'mem': 2 * 10e8, 'cpu': 1},
+}
+
+# Fraction of the node that is never reserved
+MEM_MARGIN = 0.05
+
+
+# %% stage_profile ============================================================
+def stage_profile(stage, input_size=None):
+    """
+    Return {'mem': bytes, 'cpu': cores} expected for one job of the stage.
+    The profile measured by profiler (scaled by input_size if given) takes
+    precedence over DEFAULT_PROFILES, and values set in PROFILE_F override
+    both.
+    """
+    profile = dict(DEFAULT_PROFILES.get(stage, {'mem': 1 * 10e8, 'cpu': 1}))
+    measured = profiler.estimate(stage, input_size=input_size)
+    if measured is not None:
+        profile.update(measured)
+
+    if PROFILE_F.is_file():
+        try:
+            with open(PROFILE_F, 'r') as fd:
+                override = json.load(fd).get(stage, {})
+            profile.update({k: v for k, v in override.items()
+                            if k in ('mem', 'cpu') and v})
+        except Exception as e:
+            print(f"Failed to read {PROFILE_F}: {e}")
+
+    return profile
+
+
+# %% Ledger ===================================================================
+@contextmanager
+def _locked_ledger():
+    """
+    Open the ledger with an exclusive lock and yield the reservation dict.
+    Changes to the dict are written back on exit.
+    """
+    fd = os.open(LEDGER_F, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with os.fdopen(os.dup(fd), 'r') as fr:
+            txt = fr.read()
+        try:
+            ledger = json.loads(txt) if txt.strip() else {}
+        except json.JSONDecodeError:
+            ledger = {}
+
+        # Drop reservations of dead owners
+        for rid in list(ledger.keys()):
+            if not psutil.pid_exists(ledger[rid]['owner']):
+                del ledger[rid]
+
+        yield ledger
+
+        txt = json.dumps(ledger)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, txt.encode())
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _tree_rss(pid):
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return 0
+
+    rss = 0
+    for pp in procs:
+        try:
+            rss += pp.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def _free_resources(ledger):
+    """
+    Memory and CPUs not used nor reserved by admitted jobs.
+    The memory a job has already allocated is excluded from the available
+    memory, so only the not-yet-used part of its reservation is counted.
+    """
+    vm = psutil.virtual_memory()
+    pending_mem = 0
+    used_cpu = 0
+    for res in ledger.values():
+        used_cpu += res['cpu']
+        pid = res.get('pid')
+        used = _tree_rss(pid) if pid is not None else 0
+        pending_mem += max(res['mem'] - used, 0)
+
+    free_mem = vm.available - vm.total * MEM_MARGIN - pending_mem
+    free_cpu = psutil.cpu_count() - used_cpu
+
+    return free_mem, free_cpu
+
+
+# %% try_admit ================================================================
+def try_admit(stage, subject=None, mem=None, cpu=None, pid=None,
+              input_size=None):
+    """
+    Reserve resources for one job of the stage if they fit.
+    Returns a reservation ID or None if the job does not fit now.
+    A job is always admitted when nothing else is reserved on the node.
+    """
+    profile = stage_profile(stage, input_size=input_size)
+    if mem is None:
+        mem = profile['mem']
+    if cpu is None:
+        cpu = profile['cpu']
+
+    with _locked_ledger() as ledger:
+        free_mem, free_cpu = _free_resources(ledger)
+        if len(ledger) and (mem > free_mem or cpu > free_cpu):
+            return None
+
+        rid = uuid.uuid4().hex
+        ledger[rid] = {'stage': stage, 'subject': subject, 'mem': mem,
+                       'cpu': cpu, 'owner': os.getpid(), 'pid': pid,
+                       'host': gethostname(), 'time': time.time()}
+
+    return rid
+
+
+# %% admit ====================================================================
+def admit(stage, subject=None, mem=None, cpu=None, pid=None, poll=10,
+          timeout=None, input_size=None):
+    """
+    Wait until one job of the stage fits and reserve resources for it.
+    """
+    st = time.time()
+    msg_shown = False
+    while True:
+        rid = try_admit(stage, subject=subject, mem=mem, cpu=cpu, pid=pid,
+                        input_size=input_size)
+        if rid is not None:
+            return rid
+
+        if timeout is not None and time.time() - st > timeout:
+            return None
+
+        if not msg_shown:
+            print(f"Waiting for resources to run {stage}"
+                  f"{'' if subject is None else ' for ' + str(subject)}")
+            sys.stdout.flush()
+            msg_shown = True
+        time.sleep(poll)
+
+
+# %% set_pid ==================================================================
+def set_pid(rid, pid):
+    """
+    Attach the process running the job to the reservation so that its
+    actual memory use is accounted.
+    """
+    with _locked_ledger() as ledger:
+        if rid in ledger:
+            ledger[rid]['pid'] = pid
+
+
+# %% release ==================================================================
+def release(rid):
+    if rid is None:
+        return
+
+    with _locked_ledger() as ledger:
+        if rid in ledger:
+            del ledger[rid]
+
+
+# %% reserve ==================================================================
+@contextmanager
+def reserve(stage, subject=None, mem=None, cpu=None, poll=10,
+            input_size=None):
+    """
+    Context manager to hold a reservation while running a job in this
+    process.
+        with reserve('bedpostx', subject=sub):
+            ...
+    """
+    rid = admit(stage, subject=subject, mem=mem, cpu=cpu, pid=os.getpid(),
+                poll=poll, input_size=input_size)
+    try:
+        yield rid
+    finally:
+        release(rid)
+
+
+# %% max_concurrency ==========================================================
+def max_concurrency(stage, mem=None, cpu=None, input_size=None):
+    """
+    Number of jobs of the stage that fit in the node now.
+    """
+    profile = stage_profile(stage, input_size=input_size)
+    if mem is None:
+        mem = profile['mem']
+    if cpu is None:
+        cpu = profile['cpu']
+
+    with _locked_ledger() as ledger:
+        free_mem, free_cpu = _free_resources(ledger)
+
+    n_mem = int(free_mem // mem) if mem > 0 else sys.maxsize
+    n_cpu = int(free_cpu // cpu) if cpu > 0 else sys.maxsize
+
+    return max(min(n_mem, n_cpu), 1)
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    # Show the current reservations on this node
+    with _locked_ledger() as ledger:
+        free_mem, free_cpu = _free_resources(ledger)
+        for rid, res in ledger.items():
+            print(f"{res['stage']:20s} {str(res['subject']):20s}"
+                  f" mem={res['mem'] / 1e9:.1f}GB cpu={res['cpu']}"
+                  f" owner={res['owner']} since {time.ctime(res['time'])}")
+    print(f"Free: mem={free_mem / 1e9:.1f}GB cpu={free_cpu}")
@@ -8,10 +8,13 @@ Created on Thu Mar 18 17:22:25 2021
 
 # %% import ===================================================================
 from pathlib import Path
+import tempfile
 import nibabel as nib
 import ants
 import argparse
 
+SYN_PARAMS = {'type_of_transform': 'SyN', 'reg_iterations': [100, 70, 50, 0]}
+
 
 # %% read_to_ANTs =============================================================
 def read_to_ANTs(file):
@@ -31,8 +34,7 @@ def ants_registration(fix_f, move_f, outprefix, verbose=True):
     moving = read_to_ANTs(move_f)
 
     warp_params = ants.registration(
-        fixed, moving, outprefix=outprefix, type_of_transform='SyN',
-        reg_iterations=[100, 70, 50, 0], verbose=verbose)
+        fixed, moving, outprefix=outprefix, verbose=verbose, **SYN_PARAMS)
 
     return warp_params
 
@@ -51,6 +53,47 @@ def ants_warp_resample(fix_f, move_f, out_f, transformlist,
     warped.to_filename(str(out_f))
 
 
+# %% ants_warp_resample_batch =================================================
+def ants_warp_resample_batch(fix_f, move_fs, out_fs, transformlist,
+                             interpolator='linear', imagetype=0,
+                             whichtoinvert=None, verbose=True):
+    """
+    Resample multiple moving images with the same fixed image and transforms.
+    The fixed image is read and the transform chain is composed into a single
+    displacement field only once, then all moving images are resampled with
+    it in memory.
+    """
+    assert len(move_fs) == len(out_fs)
+    if len(move_fs) == 0:
+        return []
+
+    fixed = read_to_ANTs(fix_f)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Compose the transform chain on the fixed grid
+        comp_f = ants.apply_transforms(
+            fixed, fixed, transformlist, whichtoinvert=whichtoinvert,
+            compose=str(Path(tmpdir) / 'batch_'), verbose=verbose)
+        comp_img = ants.image_read(comp_f)
+
+        if imagetype == 0:
+            comp_tx = ants.transform_from_displacement_field(comp_img)
+
+        for move_f, out_f in zip(move_fs, out_fs):
+            moving = read_to_ANTs(move_f)
+            if imagetype == 0:
+                warped = comp_tx.apply_to_image(
+                    moving, reference=fixed,
+                    interpolation=interpolator.lower())
+            else:
+                warped = ants.apply_transforms(
+                    fixed, moving, [comp_f], interpolator=interpolator,
+                    imagetype=imagetype, verbose=verbose)
+            warped.to_filename(str(out_f))
+
+    return out_fs
+
+
 # %% __main__ =================================================================
 if __name__ == '__main__':
     # --- Get options ---
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the orchestration overhead of TractoFlowProc.
+
+The external tools are replaced by stubs and the subjects are synthetic, so
+the times are those of the scripts themselves: scanning the subjects,
+checking locks and the state index, scheduling jobs with mproc, and copying
+the results. Each benchmark is run for cohorts of increasing size.
+
+    ./benchmarks/bench_orchestration.py --sizes 10 100 1000
+    ./benchmarks/bench_orchestration.py --compare bench_results.jsonl
+
+The results are appended to --out as JSON lines with the git commit, so a
+later run can be compared with them (--compare) to find regressions.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+repo_dir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_dir))
+from fixtures import make_cohort, make_stub_bin, stub_env  # noqa: E402
+
+# Driver scripts run on a cohort whose stages are all done
+DRIVERS = ('run_TractoFlow', 'run_FreewaterFlow', 'run_warp2template',
+           'run_bedpostX', 'run_XTRACT', 'collect_all_results')
+
+
+# %% Benchmarks ===============================================================
+# Each benchmark takes (cohort dict, number of subjects, options) and returns
+# the elapsed seconds of one run. The cohort dict has 'half' (TractoFlow done
+# for half of the subjects) and 'done' (all stages done) workspaces, and
+# 'bin' and 'state' folders.
+
+def bench_scan_disk(cohort, n, opts):
+    from run_TractoFlow import find_pending_subjects
+    st = time.perf_counter()
+    find_pending_subjects(cohort['half'] / 'input')
+    return time.perf_counter() - st
+
+
+def bench_scan_index_cold(cohort, n, opts):
+    from run_TractoFlow import find_pending_subjects
+    from state_index import StateIndex, index_file
+    db_f = index_file(cohort['half'])
+    if db_f.is_file():
+        db_f.unlink()
+    st = time.perf_counter()
+    find_pending_subjects(cohort['half'] / 'input',
+                          index=StateIndex(cohort['half']))
+    return time.perf_counter() - st
+
+
+def bench_scan_index_warm(cohort, n, opts):
+    from run_TractoFlow import find_pending_subjects
+    from state_index import StateIndex
+    index = StateIndex(cohort['half'])
+    find_pending_subjects(cohort['half'] / 'input', index=index)
+    st = time.perf_counter()
+    find_pending_subjects(cohort['half'] / 'input', index=index)
+    return time.perf_counter() - st
+
+
+def bench_lock_check(cohort, n, opts):
+    from joblock import Lease, is_locked
+    subjects = sorted([dd.name for dd in (cohort['half'] / 'input').glob('*')])
+    # One in ten subjects is running
+    leases = [Lease(cohort['half'] / f"IsRun_TrF_{sub}")
+              for sub in subjects[::10]]
+    for lease in leases:
+        lease.acquire()
+    try:
+        st = time.perf_counter()
+        for sub in subjects:
+            is_locked(cohort['half'] / f"IsRun_TrF_{sub}")
+        return time.perf_counter() - st
+    finally:
+        for lease in leases:
+            lease.release()
+
+
+def bench_mproc_shell(cohort, n, opts):
+    from mproc import run_multi_shell
+    n_jobs = min(n, opts.max_jobs)
+    cwd = os.getcwd()
+    os.chdir(cohort['state'])
+    try:
+        st = time.perf_counter()
+        run_multi_shell([f"{cohort['bin']}/nextflow"] * n_jobs,
+                        [f"job{ii}" for ii in range(n_jobs)])
+        return time.perf_counter() - st
+    finally:
+        shutil.rmtree(cohort['state'] / 'swarmlog', ignore_errors=True)
+        os.chdir(cwd)
+
+
+def _noop(ii):
+    return ii
+
+
+def bench_mproc_imap(cohort, n, opts):
+    from mproc import imap_multi
+    n_jobs = min(n, opts.max_jobs)
+    st = time.perf_counter()
+    for _ in imap_multi([{'ii': ii} for ii in range(n_jobs)], _noop,
+                        poll=0.05):
+        pass
+    return time.perf_counter() - st
+
+
+def bench_sync_tree(cohort, n, opts):
+    from filesync import sync_tree
+    dst_dir = cohort['state'] / 'sync_dst'
+    if dst_dir.is_dir():
+        shutil.rmtree(dst_dir)
+    st = time.perf_counter()
+    sync_tree(cohort['done'] / 'results', dst_dir)
+    # The second pass copies nothing
+    sync_tree(cohort['done'] / 'results', dst_dir)
+    return time.perf_counter() - st
+
+
+def _run_script(cohort, script, args, opts):
+    out_f = cohort['state'] / f"{script}.out"
+    cmd = [sys.executable, str(repo_dir / f"{script}.py")] + \
+        [str(arg) for arg in args]
+    st = time.perf_counter()
+    with open(out_f, 'w') as fd:
+        proc = subprocess.run(cmd, stdout=fd, stderr=subprocess.STDOUT,
+                              cwd=cohort['state'], timeout=opts.timeout,
+                              env=stub_env(cohort['bin'], cohort['state']))
+    elapsed = time.perf_counter() - st
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} exited with {proc.returncode}."
+                           f" See {out_f}")
+    return elapsed
+
+
+def driver_args(script, cohort):
+    wd = cohort['done']
+    work = cohort['state'] / 'work'
+    return {'run_TractoFlow': [wd / 'input', '--with_docker', '--workplace',
+                               work / 'tf'],
+            'run_FreewaterFlow': [wd / 'results', '--workplace',
+                                  work / 'fwf'],
+            'run_warp2template': [wd / 'results'],
+            'run_bedpostX': [wd / 'results', '--workplace', work / 'bpx'],
+            'run_XTRACT': [wd / 'FDT'],
+            'collect_all_results': [wd]}[script]
+
+
+def bench_driver(script):
+    def bench(cohort, n, opts):
+        return _run_script(cohort, script, driver_args(script, cohort), opts)
+    bench.__name__ = f"bench_{script}"
+    return bench
+
+
+def bench_collect_cold(cohort, n, opts):
+    all_res = cohort['done'] / 'all_results'
+    if all_res.is_dir():
+        shutil.rmtree(all_res)
+    return _run_script(cohort, 'collect_all_results', [cohort['done']],
+                       opts)
+
+
+BENCHMARKS = {'scan_disk': bench_scan_disk,
+              'scan_index_cold': bench_scan_index_cold,
+              'scan_index_warm': bench_scan_index_warm,
+              'lock_check': bench_lock_check,
+              'mproc_shell': bench_mproc_shell,
+              'mproc_imap': bench_mproc_imap,
+              'sync_tree': bench_sync_tree,
+              'collect_cold': bench_collect_cold}
+BENCHMARKS.update({f"driver_{script}": bench_driver(script)
+                   for script in DRIVERS})
+
+
+# %% git_commit ===============================================================
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# %% compare ==================================================================
+def compare(records, baseline_f, tolerance, noise=0.05):
+    """
+    Compare the records with the median of the baseline records of the same
+    benchmark and size. Returns the list of regressions.
+    """
+    baseline = {}
+    with open(baseline_f, 'r') as fd:
+        for line in fd:
+            rec = json.loads(line)
+            baseline.setdefault((rec['bench'], rec['n']), []).append(
+                rec['seconds'])
+
+    regressions = []
+    for rec in records:
+        key = (rec['bench'], rec['n'])
+        if key not in baseline:
+            continue
+        base = float(np.median(baseline[key]))
+        ratio = rec['seconds'] / base if base > 0 else np.inf
+        flag = ''
+        if rec['seconds'] > base * (1 + tolerance) and \
+                rec['seconds'] - base > noise:
+            flag = ' REGRESSION'
+            regressions.append(rec)
+        print(f"{rec['bench']:32s} n={rec['n']:6d} {base:9.3f} s ->"
+              f" {rec['seconds']:9.3f} s (x{ratio:.2f}){flag}")
+
+    return regressions
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='bench_orchestration.py',
+        description='Benchmark the orchestration overhead of TractoFlowProc')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='Numbers of subjects')
+    parser.add_argument('--bench', nargs='+', choices=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each benchmark. The fastest is used.')
+    parser.add_argument('--max_jobs', type=int, default=1000,
+                        help='Maximum number of jobs of the mproc benchmarks')
+    parser.add_argument('--timeout', type=float, default=3600,
+                        help='Timeout (seconds) of a driver script')
+    parser.add_argument('--tmp', help='Folder of the synthetic cohorts')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the synthetic cohorts')
+    parser.add_argument('--out', default='bench_results.jsonl',
+                        help='File to append the results')
+    parser.add_argument('--compare',
+                        help='Results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown regarded as a regression')
+    opts = parser.parse_args()
+
+    benches = opts.bench if opts.bench else list(BENCHMARKS)
+    # Keep the state of the profiler, telemetry, and admission of the
+    # benchmark apart from the real one
+    tmp_root = Path(tempfile.mkdtemp(prefix='tfp_bench_', dir=opts.tmp))
+    os.environ['TRACTOFLOWPROC_STATE'] = str(tmp_root / 'state')
+
+    records = []
+    try:
+        bin_dir = make_stub_bin(tmp_root / 'bin')
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        for n in opts.sizes:
+            # --- Synthetic cohorts ---
+            st = time.perf_counter()
+            cohort = {'half': tmp_root / f"half_{n}",
+                      'done': tmp_root / f"done_{n}", 'bin': bin_dir,
+                      'state': tmp_root / f"state_{n}"}
+            make_cohort(cohort['half'], n, done=('tractoflow',),
+                        done_every=2)
+            make_cohort(cohort['done'], n)
+            (cohort['state'] / 'work').mkdir(parents=True)
+            print(f"Made cohorts of {n} subjects"
+                  f" ({time.perf_counter() - st:.1f} s)")
+            sys.stdout.flush()
+
+            # --- Benchmarks ---
+            for bench in benches:
+                times = []
+                error = None
+                for _ in range(opts.repeat):
+                    try:
+                        times.append(BENCHMARKS[bench](cohort, n, opts))
+                    except Exception as e:
+                        error = str(e)
+                        break
+
+                if error is not None:
+                    print(f"{bench:32s} n={n:6d} failed: {error}")
+                    continue
+
+                rec = {'bench': bench, 'n': n, 'seconds': min(times),
+                       'per_subject': min(times) / n, 'repeat': len(times),
+                       'commit': git_commit(), 'host': gethostname(),
+                       'python': platform.python_version(),
+                       'cpu_count': os.cpu_count(), 'time': time.time()}
+                records.append(rec)
+                print(f"{bench:32s} n={n:6d} {rec['seconds']:9.3f} s"
+                      f" ({rec['per_subject'] * 1e3:.3f} ms/subject)")
+                sys.stdout.flush()
+
+            if not opts.keep:
+                for key in ('half', 'done', 'state'):
+                    shutil.rmtree(cohort[key], ignore_errors=True)
+
+    finally:
+        if not opts.keep:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+        else:
+            print(f"Cohorts are kept in {tmp_root}")
+
+    regressions = []
+    if opts.compare is not None:
+        regressions = compare(records, opts.compare, opts.tolerance)
+
+    with open(opts.out, 'a') as fd:
+        for rec in records:
+            fd.write(json.dumps(rec) + '\n')
+    print(f"Results are appended to {opts.out}")
+
+    if len(regressions):
+        sys.exit(1)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic cohorts and stub external tools for the benchmarks.
+
+make_cohort() creates a workspace with tiny input files (dwi.nii.gz, bval,
+bvec, t1.nii.gz) and the result layouts of the stages (TractoFlow results/,
+FDT/) as if the stages were done for the given subjects. make_stub_bin()
+writes stub executables of FSL, ANTs, FreeSurfer, and Nextflow that sleep
+or allocate memory on a schedule given by environment variables:
+    TFP_STUB_SCHEDULE="sleep:0.5,alloc:200,sleep:1"   (all tools)
+    TFP_STUB_BEDPOSTX="sleep:2"                       (one tool)
+    TFP_STUB_EXIT=1                                   (exit code)
+    TFP_STUB_LOG=stub_calls.log                       (log of the calls)
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+import gzip
+import os
+import re
+import sys
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Tools called by the run_* scripts
+TOOLS = ('nextflow', 'singularity', 'docker',
+         'bedpostx', 'bedpostx_gpu', 'xtract', 'xtract_stats',
+         'probtrackx2', 'probtrackx2_gpu', 'flirt', 'fnirt', 'applywarp',
+         'invwarp', 'convertwarp', 'convert_xfm', 'fslmaths', 'fslroi',
+         'antsRegistrationSyN.sh', 'antsApplyTransforms', 'c3d_affine_tool',
+         'recon-all', 'mri_convert', '3dresample')
+
+STAGES = ('tractoflow', 'freewaterflow', 'warp2template', 'bedpostx',
+          'xtract')
+
+STUB = '''#!{python}
+# Stub of {tool} for the TractoFlowProc benchmarks
+import os
+import sys
+import time
+
+schedule = os.environ.get('{env}',
+                          os.environ.get('TFP_STUB_SCHEDULE', ''))
+buf = []
+for step in [st for st in schedule.split(',') if st]:
+    kind, val = step.split(':')
+    if kind == 'sleep':
+        time.sleep(float(val))
+    elif kind == 'alloc':
+        buf.append(bytearray(int(float(val) * 2**20)))
+
+if os.environ.get('TFP_STUB_LOG'):
+    with open(os.environ['TFP_STUB_LOG'], 'a') as fd:
+        fd.write(' '.join(['{tool}'] + sys.argv[1:]) + '\\n')
+
+sys.exit(int(os.environ.get('TFP_STUB_EXIT', 0)))
+'''
+
+
+# %% stub_env_name ============================================================
+def stub_env_name(tool):
+    """
+    Environment variable of the schedule of a tool.
+    """
+    return 'TFP_STUB_' + re.sub(r'[^A-Z0-9]', '_', tool.upper())
+
+
+# %% make_stub_bin ============================================================
+def make_stub_bin(bin_dir, tools=TOOLS):
+    """
+    Write stub executables into bin_dir. Put bin_dir at the head of PATH to
+    use them.
+    """
+    bin_dir = Path(bin_dir)
+    if not bin_dir.is_dir():
+        bin_dir.mkdir(parents=True)
+
+    for tool in tools:
+        stub_f = bin_dir / tool
+        stub_f.write_text(STUB.format(python=sys.executable, tool=tool,
+                                      env=stub_env_name(tool)))
+        stub_f.chmod(0o755)
+
+    return bin_dir
+
+
+# %% _nii_bytes ===============================================================
+def _nii_bytes(shape):
+    img = nib.Nifti1Image(np.zeros(shape, dtype=np.int16), np.eye(4))
+    return gzip.compress(img.to_bytes(), compresslevel=1)
+
+
+# %% make_cohort ==============================================================
+def make_cohort(root, n_subj, done=STAGES, done_every=1, prefix='sub'):
+    """
+    Create a synthetic workspace at root with n_subj subjects.
+    done: stages whose outputs are made.
+    done_every: the outputs are made for every done_every-th subject (e.g.,
+    2 makes half of the cohort done).
+    Returns the list of subject names.
+    """
+    # Imported here so that the caller can set TRACTOFLOWPROC_STATE first
+    from run_warp2template import metric_files
+
+    root = Path(root)
+    dwi = _nii_bytes((4, 4, 4, 7))
+    vol = _nii_bytes((4, 4, 4))
+    bval = ' '.join(['0'] + ['1000'] * 6) + '\n'
+    bvec = '\n'.join([' '.join(['0'] + ['1'] * 6)] * 3) + '\n'
+
+    def put(path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, bytes):
+            path.write_bytes(data)
+        else:
+            path.write_text(data)
+
+    subjects = [f"{prefix}{ii:05d}" for ii in range(n_subj)]
+    for ii, sub in enumerate(subjects):
+        in_dir = root / 'input' / sub
+        put(in_dir / 'dwi.nii.gz', dwi)
+        put(in_dir / 't1.nii.gz', vol)
+        put(in_dir / 'bval', bval)
+        put(in_dir / 'bvec', bvec)
+
+        if ii % done_every:
+            continue
+
+        res = root / 'results' / sub
+        fdt = root / 'FDT'
+        if 'tractoflow' in done:
+            put(res / 'PFT_Tracking' /
+                f"{sub}__pft_tracking_prob_wm_seed_0.trk", b'')
+            put(res / 'Resample_DWI' / f"{sub}__dwi_resampled.nii.gz", dwi)
+            put(res / 'Eddy_Topup' / f"{sub}__bval_eddy", bval)
+            put(res / 'Eddy_Topup' / f"{sub}__dwi_eddy_corrected.bvec", bvec)
+            put(res / 'Extract_B0' / f"{sub}__b0_mask_resampled.nii.gz", vol)
+            put(res / 'Register_T1' / f"{sub}__t1_warped.nii.gz", vol)
+            for metric_dir in ('DTI_Metrics', 'FODF_Metrics'):
+                for metric in metric_files[metric_dir]:
+                    put(res / metric_dir / f"{sub}__{metric}.nii.gz", vol)
+
+        if 'freewaterflow' in done:
+            put(res / 'FW_Corrected_Metrics' /
+                f"{sub}__fw_corr_tensor.nii.gz", vol)
+            put(res / 'Compute_FreeWater' / f"{sub}__dwi_fw_corrected.nii.gz",
+                dwi)
+            for metric in metric_files['FW_Corrected_Metrics']:
+                put(res / 'FW_Corrected_Metrics' / f"{sub}__{metric}.nii.gz",
+                    vol)
+
+        if 'warp2template' in done:
+            put(res / 'Standardize_T1' / 'template2orig_0GenericAffine.mat',
+                b'')
+            put(res / 'Standardize_T1' / 'template2orig_1InverseWarp.nii.gz',
+                vol)
+            for metric_dir, metrics in metric_files.items():
+                for metric in metrics:
+                    put(res / f"Standardize_{metric_dir}" /
+                        f"{sub}__{metric}_standard.nii.gz", vol)
+
+        if 'bedpostx' in done:
+            put(fdt / f"{sub}.bedpostX" / 'mean_fsumsamples.nii.gz', vol)
+            put(fdt / f"{sub}.bedpostX" / 'xfms' / 'standard2diff.nii.gz',
+                vol)
+
+        if 'xtract' in done:
+            put(fdt / f"{sub}.xtract" / 'tracts' / 'vof_r' /
+                'densityNorm.nii.gz', vol)
+            put(fdt / f"{sub}.xtract" / 'stats.csv',
+                'tract,volume,mean,median\nvof_r,1,0.5,0.5\n')
+
+    return subjects
+
+
+# %% stub_env =================================================================
+def stub_env(bin_dir, state_dir, env=None):
+    """
+    Environment running the scripts with the stub tools. The profiler,
+    telemetry, and admission state is kept in state_dir.
+    """
+    env = dict(os.environ if env is None else env)
+    env['PATH'] = f"{bin_dir}{os.pathsep}{env.get('PATH', '')}"
+    env['TRACTOFLOWPROC_STATE'] = str(state_dir)
+    return env
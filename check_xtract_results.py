@@ -5,10 +5,11 @@
 # %% import ===================================================================
 import argparse
 from pathlib import Path
-import numpy as np
 
 import pandas as pd
 
+from xtract_table import read_table, qc_table
+
 if '__file__' not in locals():
     __file__ = 'this.py'
 
@@ -17,8 +18,8 @@ if '__file__' not in locals():
 if __name__ == '__main__':
     # Read arguments
     parser = argparse.ArgumentParser(
-        prog='run_XTRACT.py',
-        description='Run FSL XTRACT to extract major tracts and there stats')
+        prog='check_xtract_results.py',
+        description='Check the XTRACT stats for zero and missing tracts')
 
     parser.add_argument('FDT_folder', help='FDT results folder')
 
@@ -26,16 +27,19 @@ if __name__ == '__main__':
     FDT_folder = Path(args.FDT_folder).resolve()
 
     # --- XTRACT ----------------------------------------------------------
-    # Get input data
-    sub_dirs = [sub_dir for sub_dir in FDT_folder.glob('*.xtract')
-                if sub_dir.is_dir()]
-
-    for sub_dir in sub_dirs:
-        stat_tab = pd.read_csv(sub_dir / 'stats.csv', index_col=0)
-        missing_tract = stat_tab.index[np.any(stat_tab == 0, axis=1)]
-        if len(missing_tract):
-            print(f"{sub_dir.name}: xtract missing {missing_tract}")
-            print(stat_tab.loc[missing_tract])
+    # Stats of all subjects in one table. The stored table is used for the
+    # unchanged stats.csv files if it can be read, and nothing is written.
+    table = read_table(FDT_folder)
+    issues = qc_table(table)
+
+    wide = table[table.subject.isin(issues.subject)].set_index(
+        ['subject', 'tract', 'measure']).value.unstack('measure')
+    for sub, sub_issues in issues.groupby('subject', sort=True):
+        missing_tract = sub_issues.tract.unique()
+        print(f"{sub}: xtract missing {list(missing_tract)}")
+        with pd.option_context('display.width', 200):
+            print(wide.reindex(
+                pd.MultiIndex.from_product([[sub], missing_tract])).loc[sub])
 
 
 # %%
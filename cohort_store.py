@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cohort store of the standardized metric maps.
+
+Each metric of all subjects in all_results is packed into one HDF5 file
+(all_results/cohort_store.h5) as a chunked, compressed array of subjects x
+voxels in the template brain mask. Voxelwise group analyses read only the
+chunks they need instead of decoding one gzipped NIfTI file per subject.
+The store is updated incrementally: only the metric files that are new or
+have changed since the last update are read.
+
+Layout
+    mask: brain mask (3D bool) with the affine in attrs['affine']
+    subjects: subject IDs; the row index of the metric arrays
+    metrics/{metric}: float32 [subjects, voxels in the mask], NaN if missing
+    metrics/{metric}_mtime: mtime of the source file of each subject
+
+    ./cohort_store.py ~/TractoFlow_workspace/all_results
+updates the store, and
+    subjects, fa = read_metric(store_f, 'fw_corr_fa')
+reads a metric, and open_metric() gives the dataset to read a part of it.
+h5py is required only for this store.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from contextlib import contextmanager
+import argparse
+import os
+import re
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from joblock import Lease
+
+if '__file__' not in locals():
+    __file__ = 'cohort_store.py'
+
+STORE_NAME = 'cohort_store.h5'
+MASK_F = Path(__file__).resolve().parent / 'MNI152_T1_1mm_brain.nii.gz'
+
+
+# %% _h5py ====================================================================
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        sys.exit("h5py is required for the cohort store."
+                 " Install it with 'pip install h5py'.")
+    return h5py
+
+
+# %% list_metric_files ========================================================
+def list_metric_files(all_results_dir, subjects=None):
+    """
+    Return {subject: {metric: file}} of the standardized maps in
+    all_results_dir: {sub}__{metric}_standard.nii.gz (DTI, FODF, and
+    FW-corrected metrics) and {sub}_{roi}_fdt_paths_prob_standard.nii.gz
+    (PROBTRACKX).
+    """
+    files = {}
+    for sub_dir in sorted(Path(all_results_dir).glob('*')):
+        sub = sub_dir.name
+        if not sub_dir.is_dir() or \
+                (subjects is not None and sub not in subjects):
+            continue
+
+        pat = re.compile(rf"^{re.escape(sub)}__?(.+)_standard\.nii\.gz$")
+        for img_f in sub_dir.glob('*_standard.nii.gz'):
+            ma = pat.match(img_f.name)
+            if ma:
+                files.setdefault(sub, {})[ma.group(1)] = img_f
+
+    return files
+
+
+# %% update_store =============================================================
+def update_store(all_results_dir, store_f=None, mask_f=MASK_F, subjects=None,
+                 chunk_subjects=16, chunk_voxels=2**16, cache_mb=512):
+    """
+    Add new or changed metric files in all_results_dir to the store.
+    The mask is fixed when the store is created.
+    Returns the number of updated (subject, metric) maps.
+    """
+    h5py = _h5py()
+    all_results_dir = Path(all_results_dir)
+    if store_f is None:
+        store_f = all_results_dir / STORE_NAME
+    store_f = Path(store_f)
+
+    metric_files = list_metric_files(all_results_dir, subjects=subjects)
+
+    # One writer at a time
+    with Lease(store_f.parent / f".{store_f.name}.lock") as lock:
+        if not lock.acquired:
+            print(f"{store_f} is being updated by another process.")
+            return 0
+
+        with h5py.File(store_f, 'a', rdcc_nbytes=cache_mb * 2**20,
+                       rdcc_nslots=10007) as h5:
+            # --- Mask ---
+            if 'mask' not in h5:
+                mask_img = nib.load(mask_f)
+                ds = h5.create_dataset(
+                    'mask', data=np.asanyarray(mask_img.dataobj) > 0,
+                    compression='gzip')
+                ds.attrs['affine'] = mask_img.affine
+                ds.attrs['source'] = str(mask_f)
+            mask = h5['mask'][()]
+            n_vox = int(mask.sum())
+
+            # --- Subject index ---
+            if 'subjects' not in h5:
+                h5.create_dataset('subjects', shape=(0,), maxshape=(None,),
+                                  dtype=h5py.string_dtype(), chunks=True)
+            stored = list(h5['subjects'].asstr()[()])
+            new_subs = [sub for sub in metric_files if sub not in stored]
+            if len(new_subs):
+                h5['subjects'].resize((len(stored) + len(new_subs),))
+                h5['subjects'][len(stored):] = new_subs
+                stored += new_subs
+            row = {sub: ii for ii, sub in enumerate(stored)}
+
+            # --- Metric arrays ---
+            metrics = sorted(set([metric for mfs in metric_files.values()
+                                  for metric in mfs]))
+            grp = h5.require_group('metrics')
+            n_updated = 0
+            for metric in metrics:
+                if metric not in grp:
+                    grp.create_dataset(
+                        metric, shape=(len(stored), n_vox),
+                        maxshape=(None, n_vox), dtype='f4',
+                        fillvalue=np.nan,
+                        chunks=(min(chunk_subjects, max(len(stored), 1)),
+                                min(chunk_voxels, n_vox)),
+                        compression='gzip', compression_opts=4, shuffle=True)
+                    grp.create_dataset(
+                        f"{metric}_mtime", shape=(len(stored),),
+                        maxshape=(None,), dtype='f8', fillvalue=0,
+                        chunks=True)
+                data_ds = grp[metric]
+                mtime_ds = grp[f"{metric}_mtime"]
+                if data_ds.shape[0] < len(stored):
+                    data_ds.resize((len(stored), n_vox))
+                    mtime_ds.resize((len(stored),))
+                mtimes = mtime_ds[()]
+
+                # Rows in order so that the chunks stay in the cache
+                for sub in sorted(metric_files, key=lambda sub: row[sub]):
+                    img_f = metric_files[sub].get(metric)
+                    if img_f is None:
+                        continue
+                    mtime = os.stat(img_f).st_mtime
+                    if mtimes[row[sub]] == mtime:
+                        continue
+
+                    img = nib.load(img_f)
+                    if img.shape[:3] != mask.shape:
+                        print(f"{img_f} does not match the mask grid"
+                              f" {mask.shape}. Skipped.")
+                        continue
+                    data = np.asarray(img.dataobj, dtype=np.float32)
+                    if data.ndim > 3:
+                        data = data.reshape(mask.shape)
+                    data_ds[row[sub], :] = data[mask]
+                    mtime_ds[row[sub]] = mtime
+                    n_updated += 1
+
+    return n_updated
+
+
+# %% open_metric ==============================================================
+@contextmanager
+def open_metric(store_f, metric):
+    """
+    Context manager giving (subject list, h5py dataset [subjects, voxels in
+    the mask]) of a metric. Slicing the dataset reads only the chunks of the
+    slice.
+        with open_metric(store_f, 'fw_corr_fa') as (subjects, fa):
+            block = fa[:, 0:10000]
+    """
+    h5py = _h5py()
+    with h5py.File(store_f, 'r') as h5:
+        yield list(h5['subjects'].asstr()[()]), h5['metrics'][metric]
+
+
+# %% read_metric ==============================================================
+def read_metric(store_f, metric, subjects=None, voxels=slice(None)):
+    """
+    Return (subject list, array [subjects, voxels]) of a metric.
+    subjects: subjects to read (default: all).
+    voxels: slice of the voxels in the mask to read (default: all).
+    """
+    with open_metric(store_f, metric) as (stored, data):
+        if subjects is None:
+            return stored, data[:, voxels]
+
+        rows = np.array([stored.index(sub) for sub in subjects])
+        order = np.argsort(rows)
+        values = data[rows[order], voxels]
+        values[order] = values.copy()
+        return list(subjects), values
+
+
+# %% unmask ===================================================================
+def unmask(store_f, values):
+    """
+    Put the values of the mask voxels into a NIfTI image in the template
+    space.
+    """
+    h5py = _h5py()
+    with h5py.File(store_f, 'r') as h5:
+        mask = h5['mask'][()]
+        affine = h5['mask'].attrs['affine']
+    vol = np.zeros(mask.shape, dtype=np.float32)
+    vol[mask] = values
+    return nib.Nifti1Image(vol, affine)
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='cohort_store.py',
+        description='Pack the standardized metric maps into a cohort HDF5'
+        ' store')
+    parser.add_argument('all_results', help='all_results folder')
+    parser.add_argument('--store', help='Store file (default:'
+                        f' all_results/{STORE_NAME})')
+    parser.add_argument('--mask', default=MASK_F,
+                        help='Brain mask in the template space (used when'
+                        ' the store is created)')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Update only these subjects')
+    opts = parser.parse_args()
+
+    n_updated = update_store(opts.all_results, store_f=opts.store,
+                             mask_f=opts.mask, subjects=opts.subjects)
+    print(f"Updated {n_updated} maps")
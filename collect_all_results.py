@@ -4,10 +4,41 @@
 # %% import ===================================================================
 import argparse
 from pathlib import Path
-import shutil
+import sys
+import time
 
 from tqdm import tqdm
 
+from filesync import sync_files, copy_file, COPY_MODES
+import telemetry
+
+
+# %% result_files =============================================================
+def result_files(workplace, sub, out_dir):
+    """
+    List (source, destination) of the result files of a subject.
+    """
+    pairs = []
+
+    # DTI, FODF, and FW-corrected DTI metrics in the template space
+    for metric_dir in ('Standardize_DTI_Metrics', 'Standardize_FODF_Metrics',
+                       'Standardize_FW_Corrected_Metrics'):
+        src_dir = workplace / 'results' / sub / metric_dir
+        for src_f in src_dir.glob('*.nii.gz'):
+            pairs.append((src_f, out_dir / src_f.name))
+
+    # FDT XTRACT stats
+    src_f = workplace / 'FDT' / f"{sub}.xtract" / 'stats.csv'
+    if src_f.is_file():
+        pairs.append((src_f, out_dir / f"{sub}_FDT_xtract_stats.csv"))
+
+    # FDT probtackx
+    src_dir = workplace / 'FDT' / f"{sub}.probtackx"
+    for src_f in src_dir.glob('*_prob_standard.nii.gz'):
+        pairs.append((src_f, out_dir / f"{sub}_{src_f.name}"))
+
+    return pairs
+
 
 # %% __main__ =================================================================
 if __name__ == '__main__':
@@ -17,14 +48,39 @@ if __name__ == '__main__':
         description='Collect all result files of TractoFlowProc')
 
     parser.add_argument('workplace', help='worked directory')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--mode', choices=COPY_MODES, default='link',
+                        help='How the files are placed. link: hardlink if'
+                        ' possible, reflink: clone the file extents if'
+                        ' possible, copy: always copy. The modes fall back'
+                        ' to copy. (default: %(default)s)')
+    parser.add_argument('--num_streams', type=int, default=8,
+                        help='Number of parallel file copies')
+    parser.add_argument('--cohort_store', action='store_true',
+                        help='Update the cohort HDF5 store of the metrics'
+                        ' (all_results/cohort_store.h5)')
+    parser.add_argument('--xtract_table', action='store_true',
+                        help='Update the XTRACT stats table of all subjects'
+                        ' (all_results/xtract_stats.parquet)')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
     workplace = Path(args.workplace)
+    subjects = args.subjects
+    mode = args.mode
+    num_streams = args.num_streams
+    cohort_store = args.cohort_store
+    xtract_table = args.xtract_table
     overwrite = args.overwrite
 
     '''
     workplace = Path.home() / 'MRI/TractoFlow_workspace/DTI_AdolescentData'
+    subjects = None
+    mode = 'link'
+    num_streams = 8
+    cohort_store = False
+    xtract_table = False
     overwrite = False
     '''
 
@@ -33,48 +89,46 @@ if __name__ == '__main__':
     Subs = [sub_dir.name for sub_dir in res_dir.glob('*')
             if sub_dir.is_dir() and
             sub_dir.name not in ('Compute_Kernel', 'Readme')]
+    if subjects is not None:
+        Subs = [sub for sub in Subs if sub in subjects]
 
     # Copy result files
     OUT_ROOT = workplace / 'all_results'
     if not OUT_ROOT.is_dir():
         OUT_ROOT.mkdir()
 
-    for sub in tqdm(Subs, desc='Copy result files'):
-        sub_dir = OUT_ROOT / sub
-        if not sub_dir.is_dir():
-            sub_dir.mkdir()
+    # Files already collected (same size and mtime) are skipped.
+    file_pairs = []
+    for sub in tqdm(Subs, desc='List result files'):
+        file_pairs += result_files(workplace, sub, OUT_ROOT / sub)
 
-        # DTI metrics
-        src_dir = workplace / 'results' / sub / 'Standardize_DTI_Metrics'
-        for src_f in src_dir.glob('*.nii.gz'):
-            dst_f = sub_dir / src_f.name
-            if not dst_f.is_file() or overwrite:
-                shutil.copy(src_f, dst_f)
+    telemetry.emit('plan', 'collect', total=len(Subs), done=0)
+    st = time.time()
+    n_files, n_bytes, failed = sync_files(
+        file_pairs, num_streams=num_streams, mode=mode, force=overwrite)
+    print(f"Placed {n_files} of {len(file_pairs)} files"
+          f" ({n_bytes / 1e9:.2f} GB, {mode}) in {time.time() - st:.1f} s")
 
-        # FODF Metrics
-        src_dir = workplace / 'results' / sub / 'Standardize_FODF_Metrics'
-        for src_f in src_dir.glob('*.nii.gz'):
-            dst_f = sub_dir / src_f.name
-            if not dst_f.is_file() or overwrite:
-                shutil.copy(src_f, dst_f)
+    failed_subs = set([dst_f.parent.name for _, dst_f in failed])
+    for sub in Subs:
+        telemetry.emit('state', 'collect', sub,
+                       status='failed' if sub in failed_subs else 'done')
+    if len(failed):
+        sys.exit(f"Failed to collect {len(failed)} files")
 
-        # FW-corrected DTI metrics
-        src_dir = workplace / 'results' / sub / \
-            'Standardize_FW_Corrected_Metrics'
-        for src_f in src_dir.glob('*.nii.gz'):
-            dst_f = sub_dir / src_f.name
-            if not dst_f.is_file() or overwrite:
-                shutil.copy(src_f, dst_f)
-
-        # FDT XTRACT stats
-        src_f = workplace / 'FDT' / f"{sub}.xtract" / 'stats.csv'
-        dst_f = sub_dir / f"{sub}_FDT_xtract_stats.csv"
-        if src_f.is_file() and not dst_f.is_file() or overwrite:
-            shutil.copy(src_f, dst_f)
-
-        # FDT probtackx
-        src_dir = workplace / 'FDT' / f"{sub}.probtackx"
-        for src_f in src_dir.glob('*_prob_standard.nii.gz'):
-            dst_f = sub_dir / f"{sub}_{src_f.name}"
-            if not dst_f.is_file() or overwrite:
-                shutil.copy(src_f, dst_f)
+    # Cohort store of the metrics
+    if cohort_store:
+        from cohort_store import update_store
+        n_updated = update_store(OUT_ROOT, subjects=Subs)
+        print(f"Updated {n_updated} maps in the cohort store")
+
+    # Table of the XTRACT stats
+    if xtract_table:
+        from xtract_table import update_table, TABLE_NAME
+        FDT_folder = workplace / 'FDT'
+        table, n_parsed = update_table(FDT_folder)
+        if (FDT_folder / TABLE_NAME).is_file():
+            copy_file(FDT_folder / TABLE_NAME, OUT_ROOT / TABLE_NAME,
+                      mode=mode, force=overwrite)
+        print(f"Parsed {n_parsed} XTRACT stats files;"
+              f" {table.subject.nunique()} subjects in {TABLE_NAME}")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Copy-back of result trees from a local working place to the network share.
+
+Files are copied with several parallel streams, without recompression
+(NIfTI files are already gzipped), and put in place by an atomic rename.
+Files whose size and mtime match the destination are skipped, and the
+copies are verified by size or, optionally, by checksum.
+On the same filesystem, a file can be placed by a hardlink or a reflink
+(shared extents) instead of duplicating its bytes.
+CopyBack runs the copies in the background so that a driver can hand over
+each finished subject and continue.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from socket import gethostname
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import threading
+
+# ioctl to clone the extents of a file (Btrfs, XFS, and others)
+FICLONE = 0x40049409
+COPY_MODES = ('link', 'reflink', 'copy')
+
+
+# %% file_checksum ============================================================
+def file_checksum(fname, chunk=2**22):
+    hs = hashlib.sha256()
+    with open(fname, 'rb') as fd:
+        while True:
+            buf = fd.read(chunk)
+            if not buf:
+                break
+            hs.update(buf)
+    return hs.hexdigest()
+
+
+# %% is_same_file =============================================================
+def is_same_file(src_f, dst_f, checksum=False):
+    """
+    Check if dst_f is a copy of src_f by size and mtime, or by checksum.
+    """
+    try:
+        src_st = os.stat(src_f)
+        dst_st = os.stat(dst_f)
+    except FileNotFoundError:
+        return False
+
+    if src_st.st_size != dst_st.st_size:
+        return False
+
+    if checksum:
+        return file_checksum(src_f) == file_checksum(dst_f)
+
+    return int(src_st.st_mtime) == int(dst_st.st_mtime)
+
+
+# %% list_tree ================================================================
+def list_tree(src_dir, exclude=()):
+    """
+    List files under src_dir (following symlinks) as relative paths.
+    Paths whose any component matches an exclude pattern are skipped.
+    """
+    src_dir = Path(src_dir)
+    files = []
+    for root, dirs, fnames in os.walk(src_dir, followlinks=True):
+        rel_root = Path(root).relative_to(src_dir)
+        dirs[:] = [dd for dd in dirs
+                   if not any([fnmatch(dd, pat) for pat in exclude])]
+        for fname in fnames:
+            if any([fnmatch(fname, pat) for pat in exclude]):
+                continue
+            files.append(rel_root / fname)
+
+    return files
+
+
+# %% _reflink =================================================================
+def _reflink(src_f, dst_f):
+    """
+    Clone src_f to dst_f with FICLONE, or with copy_file_range, which the
+    kernel can do without reading the data through user space (reflink or
+    server-side copy). Returns False if neither is supported.
+    """
+    with open(src_f, 'rb') as src, open(dst_f, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                nb = os.copy_file_range(src.fileno(), dst.fileno(),
+                                        size - copied)
+                if nb == 0:
+                    break
+                copied += nb
+        except OSError:
+            return False
+
+    return copied == size
+
+
+# %% copy_file ================================================================
+def copy_file(src_f, dst_f, checksum=False, mode='copy', force=False):
+    """
+    Copy one file atomically unless the destination is already the same.
+    mode: 'link' tries a hardlink, then a reflink, then a copy. 'reflink'
+    tries a reflink, then a copy. A hardlink shares the file with the
+    source, so use 'reflink' or 'copy' if the source can be modified in
+    place.
+    force: replace the destination even if it is the same.
+    Returns the number of placed bytes.
+    """
+    assert mode in COPY_MODES, f"Unknown mode {mode}"
+    if not force and is_same_file(src_f, dst_f, checksum=checksum):
+        return 0
+
+    dst_f = Path(dst_f)
+    if not dst_f.parent.is_dir():
+        dst_f.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_f = dst_f.parent / f".{dst_f.name}.{gethostname()}_{os.getpid()}" \
+        f"_{threading.get_ident()}"
+    try:
+        placed = False
+        if mode == 'link':
+            try:
+                os.link(src_f, tmp_f)
+                placed = True
+            except OSError:
+                pass
+
+        if not placed and mode in ('link', 'reflink'):
+            if _reflink(src_f, tmp_f):
+                shutil.copystat(src_f, tmp_f)
+                placed = True
+
+        if not placed:
+            shutil.copy2(src_f, tmp_f)
+        os.replace(tmp_f, dst_f)
+    finally:
+        if tmp_f.exists():
+            tmp_f.unlink()
+
+    # Verify
+    if not is_same_file(src_f, dst_f, checksum=checksum):
+        raise IOError(f"Verification of {dst_f} failed")
+
+    return os.stat(dst_f).st_size
+
+
+# %% sync_tree ================================================================
+def sync_tree(src_dir, dst_dir, exclude=(), num_streams=4, checksum=False):
+    """
+    Synchronize src_dir to dst_dir with num_streams parallel copies.
+    Returns (number of copied files, copied bytes).
+    """
+    with ThreadPoolExecutor(max_workers=num_streams) as pool:
+        futures = [pool.submit(copy_file, Path(src_dir) / rel_f,
+                               Path(dst_dir) / rel_f, checksum)
+                   for rel_f in list_tree(src_dir, exclude=exclude)]
+
+    nbytes = [ft.result() for ft in futures]
+    return len([nb for nb in nbytes if nb > 0]), sum(nbytes)
+
+
+# %% sync_files ===============================================================
+def sync_files(file_pairs, num_streams=8, checksum=False, mode='copy',
+               force=False):
+    """
+    Place each (src_f, dst_f) of file_pairs with num_streams parallel
+    copies (see copy_file for mode and force).
+    Returns (number of placed files, placed bytes, list of failed pairs).
+    """
+    with ThreadPoolExecutor(max_workers=num_streams) as pool:
+        futures = [pool.submit(copy_file, src_f, dst_f, checksum, mode,
+                               force)
+                   for src_f, dst_f in file_pairs]
+
+    nbytes = []
+    failed = []
+    for pair, ft in zip(file_pairs, futures):
+        if ft.exception() is not None:
+            print(f"Failed to copy {pair[0]}: {ft.exception()}")
+            failed.append(pair)
+        else:
+            nbytes.append(ft.result())
+    sys.stdout.flush()
+
+    return len([nb for nb in nbytes if nb > 0]), sum(nbytes), failed
+
+
+# %% CopyBack =================================================================
+class CopyBack:
+    """
+    Background copy-back of result trees.
+        copier = CopyBack(num_streams=4)
+        copier.submit('S1', src_dir, dst_dir, on_done=cleanup_func)
+        ...
+        copier.wait()
+    """
+
+    def __init__(self, num_streams=4, checksum=False):
+        self.pool = ThreadPoolExecutor(max_workers=num_streams)
+        self.checksum = checksum
+        self._lock = threading.Lock()
+        self._pending = {}  # name -> [remaining files, failed, on_done]
+        self._all_done = threading.Condition(self._lock)
+
+    def submit(self, name, src_dir, dst_dir, exclude=(), on_done=None):
+        """
+        Copy src_dir to dst_dir in the background. on_done(name, ok) is
+        called when all files of the tree are copied.
+        """
+        files = list_tree(src_dir, exclude=exclude)
+        with self._lock:
+            self._pending[name] = [len(files), False, on_done]
+
+        if len(files) == 0:
+            self._finish(name)
+            return
+
+        for rel_f in files:
+            ft = self.pool.submit(copy_file, Path(src_dir) / rel_f,
+                                  Path(dst_dir) / rel_f, self.checksum)
+            ft.add_done_callback(
+                lambda ft, name=name: self._file_done(name, ft))
+
+    def _file_done(self, name, ft):
+        err = ft.exception()
+        if err is not None:
+            print(f"Copy-back of {name} failed: {err}")
+            sys.stdout.flush()
+
+        with self._lock:
+            self._pending[name][0] -= 1
+            if err is not None:
+                self._pending[name][1] = True
+            finished = self._pending[name][0] == 0
+
+        if finished:
+            self._finish(name)
+
+    def _finish(self, name):
+        with self._lock:
+            _, failed, on_done = self._pending[name]
+
+        if on_done is not None:
+            try:
+                on_done(name, not failed)
+            except Exception as e:
+                print(f"Error after copy-back of {name}: {e}")
+
+        with self._lock:
+            del self._pending[name]
+            self._all_done.notify_all()
+
+    def wait(self):
+        """
+        Wait until all submitted trees are copied.
+        """
+        with self._lock:
+            while len(self._pending):
+                self._all_done.wait()
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
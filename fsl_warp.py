@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process application of FSL warp fields (e.g., xfms/diff2standard.nii.gz
+made by convertwarp) with NumPy, equivalent to applywarp --interp=trilinear.
+
+The target coordinates of a warp field are computed once and saved as a
+.npy file (~86 MB for a 1 mm MNI warp) in CACHE_DIR on the local disk, so
+later calls from any process on the node (e.g., the (subject, ROI) jobs of
+run_PROBTRACKX.py) only memory-map the file instead of decompressing the
+warp again. Nothing is written next to the warp files. CACHE_DIR can be
+set with the environment variable TRACTOFLOWPROC_WARP_CACHE (an empty
+value keeps the coordinates only in the memory of each process). Cache
+files not updated for CACHE_MAX_AGE seconds are removed.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+_coords_cache = {}
+CACHE_DIR = os.environ.get(
+    'TRACTOFLOWPROC_WARP_CACHE',
+    str(Path(tempfile.gettempdir()) /
+        f"tractoflowproc_warp_cache_{os.getuid()}"))
+CACHE_MAX_AGE = 24 * 3600
+
+
+# %% fsl_vox2mm ===============================================================
+def fsl_vox2mm(img):
+    """
+    Matrix from voxel indices to FSL scaled-voxel (mm) coordinates.
+    FSL flips the x axis of images stored in neurological order.
+    """
+    zooms = img.header.get_zooms()[:3]
+    vox2mm = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        vox2mm = vox2mm @ flip
+
+    return vox2mm
+
+
+def _affine_points(mat, pts):
+    return np.tensordot(mat[:3, :3], pts, axes=1) + \
+        mat[:3, 3][:, None, None, None]
+
+
+# %% _prune_cache =============================================================
+def _prune_cache(cache_dir):
+    """
+    Remove the cache files not updated for CACHE_MAX_AGE seconds. Files
+    memory-mapped by running processes stay readable until they are closed.
+    """
+    now = time.time()
+    for cache_f in Path(cache_dir).glob('*_coords.npy'):
+        try:
+            if now - cache_f.stat().st_mtime > CACHE_MAX_AGE:
+                cache_f.unlink()
+        except OSError:
+            pass
+
+
+# %% load_warp_coords =========================================================
+def load_warp_coords(warp_f, relative=None):
+    """
+    Return the input-space FSL mm coordinates, shape (3, X, Y, Z), that
+    each voxel of the warp's reference grid is mapped to.
+    relative: whether the warp holds relative displacements. If None, it is
+    guessed from the values as applywarp does.
+    """
+    warp_f = Path(warp_f)
+    key = str(warp_f.resolve())
+    if key in _coords_cache:
+        return _coords_cache[key]
+
+    if CACHE_DIR:
+        cache_f = Path(CACHE_DIR) / (
+            warp_f.name.replace('.nii.gz', '').replace('.nii', '') +
+            f"_{hashlib.sha1(key.encode()).hexdigest()[:12]}_coords.npy")
+    else:
+        cache_f = None
+
+    if cache_f is not None and cache_f.is_file() and \
+            cache_f.stat().st_mtime >= warp_f.stat().st_mtime:
+        coords = np.load(cache_f, mmap_mode='r')
+    else:
+        wimg = nib.load(warp_f)
+        field = np.moveaxis(np.asarray(wimg.dataobj, dtype=np.float32),
+                            -1, 0)
+        grid = np.indices(wimg.shape[:3], dtype=np.float32)
+        ref_mm = _affine_points(fsl_vox2mm(wimg), grid).astype(np.float32)
+        del grid
+
+        if relative is None:
+            relative = np.mean(np.abs(field)) < \
+                np.mean(np.abs(field - ref_mm))
+
+        if relative:
+            coords = ref_mm + field
+        else:
+            coords = field
+        del ref_mm
+
+        # Save the cache atomically
+        if cache_f is not None:
+            tmp_f = cache_f.parent / \
+                f".{gethostname()}_{os.getpid()}_{cache_f.name}"
+            try:
+                cache_f.parent.mkdir(parents=True, exist_ok=True)
+                np.save(tmp_f, coords)
+                os.replace(tmp_f, cache_f)
+            except Exception as e:
+                print(f"Failed to save {cache_f}: {e}")
+                if tmp_f.is_file():
+                    tmp_f.unlink()
+            _prune_cache(cache_f.parent)
+
+    _coords_cache[key] = coords
+
+    return coords
+
+
+# %% ref_coords ===============================================================
+def ref_coords(warp_f, ref_img, relative=None):
+    """
+    Input-space FSL mm coordinates of each voxel of ref_img's grid, as
+    applywarp -r ref_img samples the warp at the reference voxels' mm
+    coordinates. The warp's own coordinates are returned if the grids are
+    the same.
+    """
+    coords = load_warp_coords(warp_f, relative=relative)
+    wimg = nib.load(warp_f)
+    if tuple(ref_img.shape[:3]) == tuple(wimg.shape[:3]) and \
+            np.allclose(fsl_vox2mm(ref_img), fsl_vox2mm(wimg)):
+        return coords
+
+    key = (str(Path(warp_f).resolve()), tuple(ref_img.shape[:3]),
+           tuple(np.round(fsl_vox2mm(ref_img), 6).ravel()))
+    if key in _coords_cache:
+        return _coords_cache[key]
+
+    grid = np.indices(ref_img.shape[:3], dtype=np.float32)
+    wvox = _affine_points(np.linalg.inv(fsl_vox2mm(wimg)) @
+                          fsl_vox2mm(ref_img), grid)
+    del grid
+    rcoords = np.stack([ndimage.map_coordinates(
+        np.asarray(coords[ii]), wvox, order=1, mode='nearest',
+        prefilter=False) for ii in range(3)])
+    _coords_cache[key] = rcoords
+
+    return rcoords
+
+
+# %% apply_warp ===============================================================
+def apply_warp(in_datas, in_img, warp_f, order=1, relative=None,
+               ref_img=None):
+    """
+    Resample volumes in the space of in_img into the reference space of the
+    warp, or into ref_img's grid if it is given. in_datas is one array or a
+    list of arrays with in_img's grid.
+    All volumes share one computation of the sampling coordinates.
+    """
+    single = isinstance(in_datas, np.ndarray)
+    if single:
+        in_datas = [in_datas]
+
+    if ref_img is None:
+        coords = load_warp_coords(warp_f, relative=relative)
+    else:
+        coords = ref_coords(warp_f, ref_img, relative=relative)
+    mm2vox = np.linalg.inv(fsl_vox2mm(in_img))
+    vox = _affine_points(mm2vox, coords)
+
+    out_datas = [ndimage.map_coordinates(data, vox, order=order,
+                                         mode='constant', cval=0.0,
+                                         prefilter=False)
+                 for data in in_datas]
+
+    if single:
+        return out_datas[0]
+    return out_datas
+
+
+# %% save_in_ref ==============================================================
+def save_in_ref(data, ref_f, out_f):
+    """
+    Save data in the reference space as float32 NIfTI.
+    """
+    ref_img = nib.load(ref_f)
+    hdr = ref_img.header.copy()
+    hdr.set_data_dtype(np.float32)
+    img = nib.Nifti1Image(data.astype(np.float32), ref_img.affine,
+                          header=hdr)
+    nib.save(img, out_f)
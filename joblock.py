@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lease-based locks to claim work on a shared file system.
+
+A lock file is created atomically by hard-linking a private file holding
+host/PID metadata to the lock name, which is safe on NFS. The owner renews
+the lease by touching the file from a heartbeat thread. A lock whose lease
+has expired, or whose owner process is dead on the same host, is stale and
+is reclaimed automatically by the next worker.
+
+    with Lease(work_root / f"IsRun_ANTs_{subj}") as lock:
+        if not lock.acquired:
+            continue
+        ...
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+
+# Default lease duration and heartbeat interval (seconds)
+LEASE_TTL = 600
+HEARTBEAT = 60
+
+
+# %% read_lock ================================================================
+def read_lock(lock_f):
+    """
+    Return the metadata of a lock file, or None if it does not exist.
+    Lock files made by older versions (plain text) give an empty dict.
+    """
+    try:
+        with open(lock_f, 'r') as fd:
+            txt = fd.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+    try:
+        info = json.loads(txt)
+        if not isinstance(info, dict):
+            info = {}
+    except json.JSONDecodeError:
+        info = {}
+
+    return info
+
+
+# %% is_stale =================================================================
+def is_stale(lock_f, ttl=LEASE_TTL):
+    """
+    A lock is stale if its lease has not been renewed within ttl or its owner
+    process on this host is dead.
+    """
+    info = read_lock(lock_f)
+    if info is None:
+        return False
+
+    try:
+        mtime = os.stat(lock_f).st_mtime
+    except FileNotFoundError:
+        return False
+
+    if time.time() - mtime > info.get('ttl', ttl):
+        return True
+
+    if info.get('host') == gethostname() and 'pid' in info:
+        try:
+            os.kill(info['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+
+    return False
+
+
+# %% is_locked ================================================================
+def is_locked(lock_f, ttl=LEASE_TTL):
+    """
+    True if lock_f is held by a live owner.
+    """
+    return Path(lock_f).exists() and not is_stale(lock_f, ttl=ttl)
+
+
+# %% Lease ====================================================================
+class Lease:
+    """
+    A lease-based lock on lock_f.
+    """
+
+    def __init__(self, lock_f, ttl=LEASE_TTL, heartbeat=HEARTBEAT,
+                 info={}):
+        self.lock_f = Path(lock_f)
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.token = uuid.uuid4().hex
+        self.info = dict(info)
+        self.acquired = False
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _write_private(self):
+        meta = {'host': gethostname(), 'pid': os.getpid(),
+                'token': self.token, 'ttl': self.ttl,
+                'time': time.ctime()}
+        meta.update(self.info)
+        tmp_f = self.lock_f.parent / \
+            f".{self.lock_f.name}.{gethostname()}.{os.getpid()}.{self.token}"
+        with open(tmp_f, 'w') as fd:
+            json.dump(meta, fd)
+        return tmp_f
+
+    def _break_stale(self):
+        """
+        Move a stale lock aside. Only one worker can rename it, and the moved
+        lock is checked again so that a fresh lock is not broken.
+        """
+        aside_f = self.lock_f.parent / \
+            f".{self.lock_f.name}.stale.{self.token}"
+        try:
+            os.rename(self.lock_f, aside_f)
+        except FileNotFoundError:
+            return
+
+        if is_stale(aside_f, ttl=self.ttl) or read_lock(aside_f) == {}:
+            aside_f.unlink()
+        else:
+            # Renewed in the meantime: put it back
+            try:
+                os.link(aside_f, self.lock_f)
+            except FileExistsError:
+                pass
+            aside_f.unlink()
+
+    def acquire(self):
+        """
+        Try to take the lock without waiting. Returns True on success.
+        """
+        if self.acquired:
+            return True
+
+        if not self.lock_f.parent.is_dir():
+            self.lock_f.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_f = self._write_private()
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_f, self.lock_f)
+                    self.acquired = True
+                    break
+                except FileExistsError:
+                    if not is_stale(self.lock_f, ttl=self.ttl):
+                        break
+                    self._break_stale()
+        finally:
+            tmp_f.unlink()
+
+        if self.acquired:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._renew, daemon=True)
+            self._thread.start()
+
+        return self.acquired
+
+    def _owned(self):
+        info = read_lock(self.lock_f)
+        return info is not None and info.get('token') == self.token
+
+    def _renew(self):
+        while not self._stop.wait(self.heartbeat):
+            if not self._owned():
+                self.lost = True
+                print(f"Lost the lock {self.lock_f}")
+                break
+            try:
+                os.utime(self.lock_f)
+            except FileNotFoundError:
+                self.lost = True
+                break
+
+    def release(self):
+        if not self.acquired:
+            return
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._owned():
+            try:
+                self.lock_f.unlink()
+            except FileNotFoundError:
+                pass
+        self.acquired = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='joblock.py', description='List or clean lock files')
+    parser.add_argument('run', help='[list|clean]')
+    parser.add_argument('lock_dir', help='Directory of lock files')
+    parser.add_argument('--pattern', default='IsRun*',
+                        help='Lock file name pattern')
+    opts = parser.parse_args()
+
+    for lock_f in sorted(Path(opts.lock_dir).glob(opts.pattern)):
+        stale = is_stale(lock_f)
+        if opts.run == 'list':
+            info = read_lock(lock_f)
+            print(f"{lock_f.name}: {'stale' if stale else 'active'}"
+                  f" {info.get('host', '')} {info.get('pid', '')}"
+                  f" {info.get('time', '')}")
+        elif opts.run == 'clean' and stale:
+            print(f"Remove stale lock {lock_f}")
+            lock_f.unlink()
@@ -8,17 +8,88 @@
 # %% import ===================================================================
 from pathlib import Path
 import multiprocessing
-from collections import OrderedDict
+from collections import deque
+import queue
 import time
 import sys
 import datetime
 import os
-import subprocess
+import shutil
+import asyncio
 
+import psutil
 
-# %% run_multi ================================================================
-def run_multi(job_kwargs, job_func, num_proc=0, no_return=False):
-    # --- Initialize ----------------------------------------------------------
+import admission
+import profiler
+import telemetry
+from joblock import Lease
+
+# Environment variables setting the number of threads of OpenMP, ITK (ANTs),
+# and MKL
+THREAD_ENVS = ('OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+               'MKL_NUM_THREADS')
+
+# Interval (seconds) to check the node resources of a waiting shell job
+ADMIT_POLL = 10
+
+
+# %% physical_cores ===========================================================
+def physical_cores():
+    """
+    Logical CPUs available to this process grouped by physical core.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(multiprocessing.cpu_count()))
+
+    cores = {}
+    for cpu in cpus:
+        topo_dir = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            key = ((topo_dir / 'physical_package_id').read_text().strip(),
+                   (topo_dir / 'core_id').read_text().strip())
+        except OSError:
+            key = cpu
+        cores.setdefault(key, []).append(cpu)
+
+    return list(cores.values())
+
+
+# %% core_sets ================================================================
+def core_sets(num_proc, threads=None):
+    """
+    Split the physical cores into core sets of parallel jobs so that
+    threads x jobs does not exceed the number of physical cores.
+    threads: number of threads of a job. The default shares the cores
+    evenly between num_proc jobs.
+    Returns (number of jobs, threads, list of the CPU IDs of each set).
+    """
+    cores = physical_cores()
+    num_proc = max(min(num_proc, len(cores)), 1)
+    if threads is None:
+        threads = len(cores) // num_proc
+    threads = max(min(threads, len(cores)), 1)
+    num_proc = min(num_proc, len(cores) // threads)
+
+    cpu_sets = [sum(cores[ii*threads:(ii+1)*threads], [])
+                for ii in range(num_proc)]
+    return num_proc, threads, cpu_sets
+
+
+# %% thread_env ===============================================================
+def thread_env(threads, env=None):
+    """
+    Copy of the environment with the thread counts set to threads.
+    """
+    env = dict(os.environ if env is None else env)
+    for name in THREAD_ENVS:
+        env[name] = str(threads)
+    return env
+
+
+# %% _num_proc ================================================================
+def _num_proc(num_proc, num_jobs):
     if num_proc is None:
         num_proc = int(multiprocessing.cpu_count())
     elif num_proc == 0:
@@ -26,124 +97,365 @@ def run_multi(job_kwargs, job_func, num_proc=0, no_return=False):
     elif num_proc < 1:
         num_proc = int(multiprocessing.cpu_count() / 2 * num_proc)
 
-    if num_proc > len(job_kwargs):
-        num_proc = len(job_kwargs)
-
-    # Create processor pool
-    mp_pool = multiprocessing.Pool(processes=num_proc)
-
-    # Initialize result buffer
-    proc_ret = OrderedDict()
-
-    # --- Submit jobs ---------------------------------------------------------
-    st = time.time()
-    print(f"Started at {time.ctime(st)}.")
-    sys.stdout.flush()
-
-    num_allJobs = len(job_kwargs)
-    for job_i in range(num_allJobs):
-        # Submit job
-        proc_kwargs = job_kwargs[job_i]
-        proc_ret[job_i] = mp_pool.apply_async(job_func, kwds=proc_kwargs)
+    return max(min(num_proc, num_jobs), 1)
 
-    print(f"Processing {len(proc_ret)} jobs with {num_proc} processes.")
-    sys.stdout.flush()
-
-    # Close processor pool (no more jobs)
-    mp_pool.close()
 
-    if not no_return:
-        # --- Wait and read the results ---------------------------------------
-        missed_jobs = []
-        proc_res = [None] * num_allJobs
-        for job_i, pr in proc_ret.items():
-            if pr is None:
-                continue
+# %% _run_job =================================================================
+def _run_job(job_func, job_i, attempt, kwargs, res_q):
+    try:
+        res_q.put((job_i, attempt, True, job_func(**kwargs)))
+    except Exception as e:
+        res_q.put((job_i, attempt, False, f"{type(e).__name__}: {e}"))
 
-            if job_i == 0:
-                while not pr.ready():
-                    pr.wait(1)
 
-                wait_t = (time.time() - st) * 1.5
-            elif not pr.ready():
-                pr.wait(wait_t)
+# %% _kill_tree_pid ===========================================================
+def _kill_tree_pid(pid):
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True) + [parent]
+    except psutil.Error:
+        return
+    for pp in procs:
+        try:
+            pp.terminate()
+        except psutil.Error:
+            pass
+    _, alive = psutil.wait_procs(procs, timeout=10)
+    for pp in alive:
+        try:
+            pp.kill()
+        except psutil.Error:
+            pass
+
+
+# %% _kill_tree ===============================================================
+def _kill_tree(proc):
+    _kill_tree_pid(proc.pid)
+    proc.join()
+
+
+# %% imap_multi ===============================================================
+def imap_multi(job_kwargs, job_func, num_proc=0, timeout=None,
+               stall_timeout=None, retries=0, poll=1):
+    """
+    Run job_func(**kwargs) for each kwargs in job_kwargs with num_proc
+    parallel processes, and yield (job_index, result) as the jobs complete.
+
+    timeout: wall time limit (seconds) of a job.
+    stall_timeout: a job that has not used CPU (including its child
+        processes) for this time (seconds) is regarded as hung.
+    retries: number of reruns of a job that raised an exception, crashed, or
+        was killed by a timeout. Reruns are queued to the free slots.
+    Only the job that exceeds its own limit is killed. A job that fails in
+    all attempts yields (job_index, None). Both limits are off by default,
+    so slow jobs are never killed.
+    """
+    num_jobs = len(job_kwargs)
+    num_proc = _num_proc(num_proc, num_jobs)
+    res_q = multiprocessing.Queue()
+    pending = deque(range(num_jobs))
+    attempts = [0] * num_jobs
+    running = {}  # job_i -> [process, monitor, start, cpu, last progress]
+
+    def get_results(wait):
+        results = []
+        while True:
+            try:
+                results.append(res_q.get(timeout=wait))
+            except queue.Empty:
+                break
+            wait = 0.01
+        return results
+
+    def finish(job_i):
+        proc, mon = running.pop(job_i)[:2]
+        proc.join()
+        mon.stop(save=False)
+
+    def failed(job_i, reason):
+        telemetry.emit('job_failed', job_func.__name__, job=job_i,
+                       reason=reason, rerun=attempts[job_i] <= retries)
+        if attempts[job_i] <= retries:
+            print(f"Job {job_i} failed ({reason}). Rerun.")
+            pending.append(job_i)
+            ret = None
+        else:
+            print(f"Job {job_i} failed ({reason}).")
+            ret = (job_i, None)
+        sys.stdout.flush()
+        return ret
 
-            if not pr.ready():
-                missed_jobs.append(job_i)
-                continue
+    try:
+        while len(pending) or len(running):
+            # Fill free slots
+            while len(pending) and len(running) < num_proc:
+                job_i = pending.popleft()
+                proc = multiprocessing.Process(
+                    target=_run_job,
+                    args=(job_func, job_i, attempts[job_i] + 1,
+                          job_kwargs[job_i], res_q))
+                proc.start()
+                mon = profiler.ProcMonitor(proc.pid, 'mproc', interval=poll,
+                                           events=False)
+                mon.start()
+                attempts[job_i] += 1
+                now = time.time()
+                running[job_i] = [proc, mon, now, 0.0, now]
+
+            # Harvest results
+            results = get_results(poll)
+            dead = [job_i for job_i, (proc, *_) in running.items()
+                    if proc.exitcode is not None]
+            if len(dead):
+                # Results put just before the process exit
+                results += get_results(0.1)
+
+            for job_i, attempt, ok, ret in results:
+                # Drop a late result of an attempt that has been killed
+                if job_i not in running or attempt != attempts[job_i]:
+                    continue
+
+                finish(job_i)
+                if ok:
+                    yield job_i, ret
+                else:
+                    ret = failed(job_i, ret)
+                    if ret is not None:
+                        yield ret
+
+            for job_i in dead:
+                if job_i in running:
+                    exitcode = running[job_i][0].exitcode
+                    finish(job_i)
+                    ret = failed(job_i, f"exit code {exitcode}")
+                    if ret is not None:
+                        yield ret
+
+            # Check the time limits
+            now = time.time()
+            for job_i in list(running.keys()):
+                proc, mon, start, cpu, last_prog = running[job_i]
+                cpu_now = mon.cpu_seconds()
+                if cpu_now > cpu:
+                    running[job_i][3:] = [cpu_now, now]
+                    last_prog = now
+
+                if timeout is not None and now - start > timeout:
+                    reason = f"timeout {timeout} s"
+                elif stall_timeout is not None and \
+                        now - last_prog > stall_timeout:
+                    reason = f"no progress for {stall_timeout} s"
+                else:
+                    continue
 
-            try:
-                assert pr.successful() and pr.get() is not None
-                proc_res[job_i] = pr.get()
+                _kill_tree(proc)
+                finish(job_i)
+                ret = failed(job_i, reason)
+                if ret is not None:
+                    yield ret
 
-            except Exception:
-                continue
+    finally:
+        for job_i in list(running.keys()):
+            _kill_tree(running[job_i][0])
+            finish(job_i)
 
-        mp_pool.terminate()
 
-        # --- Recover missed results ------------------------------------------
-        if len(missed_jobs):
-            # Retry failed jobs
-            for job_i in missed_jobs:
-                pr = proc_ret[job_i]
-                if pr.ready() and pr.successful() and pr.get() is not None:
-                    proc_res[job_i] = pr.get()
-                else:
-                    print(f'Rerun job {job_i}')
-                    sys.stdout.flush()
-                    proc_kwargs = job_kwargs[job_i]
-                    proc_res[job_i] = job_func(**proc_kwargs)
+# %% run_multi ================================================================
+def run_multi(job_kwargs, job_func, num_proc=0, no_return=False,
+              timeout=None, stall_timeout=None, retries=0):
+    """
+    Run jobs in parallel with imap_multi and return the results in the job
+    order (None for failed jobs), or None if no_return is True.
+    """
+    st = time.time()
+    print(f"Started at {time.ctime(st)}.")
+    print(f"Processing {len(job_kwargs)} jobs with"
+          f" {_num_proc(num_proc, len(job_kwargs))} processes.")
+    sys.stdout.flush()
 
-    else:
-        # Wait for the jobs finished
-        mp_pool.join()
-        proc_res = None
+    proc_res = [None] * len(job_kwargs)
+    for job_i, ret in imap_multi(job_kwargs, job_func, num_proc=num_proc,
+                                 timeout=timeout,
+                                 stall_timeout=stall_timeout,
+                                 retries=retries):
+        proc_res[job_i] = ret
 
     # --- End message ---------------------------------------------------------
     etstr = str(datetime.timedelta(seconds=time.time()-st)).split('.')[0]
     print('done (took %s)' % etstr)
     sys.stdout.flush()
 
-    return proc_res
+    if no_return:
+        return None
 
+    return proc_res
 
-# %% _exec_cmd_shell ==========================================================
-def _exec_cmd_shell(jobcmd, jobname, log):
-    ret = []
-    try:
-        if log:
-            log_dir = Path('swarmlog')
-            if not log_dir.is_dir():
-                log_dir.mkdir()
-
-            # Redirect stdout to file
-            stdout_fame = log_dir / f"{jobname}_{os.getpid()}_swarm.o"
-            fdsto = open(stdout_fame, 'w')
-
-            # Redirect stderr to file
-            stderr_fame = log_dir / f"{jobname}_{os.getpid()}_swarm.e"
-            fdste = open(stderr_fame, 'w')
-
-            ret = subprocess.check_call(jobcmd, stdout=fdsto,
-                                        stderr=fdste, shell=True,
-                                        executable='/bin/bash')
-        else:
-            ret = subprocess.check_output(jobcmd, shell=True,
-                                          executable='/bin/bash')
 
-        return ret
+# %% _exec_cmd_async ==========================================================
+async def _exec_cmd_async(jobcmd, jobname, log, sem, free_sets, stage=None,
+                          lock_f=None, threads=None, pin=False):
+    """
+    Run a shell command when a slot and a core set are free.
+    Returns a dict of the job name, exit code (-1 if the job was skipped or
+    could not be run), start time, and elapsed time (and the output if log is
+    False).
+    """
+    res = {'job': jobname, 'returncode': -1, 'start': None, 'elapsed': None}
+    async with sem:
+        rid = None
+        lock = None
+        cpus = None
+        proc = None
+        monitor = None
+        fds = []
+        try:
+            if lock_f is not None:
+                # Skip the job if it is running on another process
+                lock = Lease(lock_f)
+                if not lock.acquire():
+                    print(f"{jobname} is running in another process"
+                          f" ({lock_f}).")
+                    return res
+
+            cpus = await free_sets.get()
+            kwargs = {'env': thread_env(threads)}
+            # preexec_fn is not safe with the threads of this process
+            # (monitors, lease heartbeats), so the affinity is set by
+            # taskset, or on the started process if taskset is not found.
+            args = ['/bin/bash', '-c', jobcmd]
+            if pin and shutil.which('taskset'):
+                args = ['taskset', '-c', ','.join(map(str, cpus))] + args
+
+            if stage is not None:
+                # Wait until the job fits in the node resources
+                rid = admission.try_admit(stage, subject=jobname, cpu=threads)
+                if rid is None:
+                    print(f"Waiting for resources to run {stage}"
+                          f" for {jobname}")
+                    sys.stdout.flush()
+                while rid is None:
+                    await asyncio.sleep(ADMIT_POLL)
+                    rid = admission.try_admit(stage, subject=jobname,
+                                              cpu=threads)
+
+            if log:
+                log_dir = Path('swarmlog')
+                if not log_dir.is_dir():
+                    log_dir.mkdir()
+
+                # stdout and stderr are written to the files directly by the
+                # job.
+                fds.append(open(log_dir / f"{jobname}_{os.getpid()}_swarm.o",
+                                'w'))
+                fds.append(open(log_dir / f"{jobname}_{os.getpid()}_swarm.e",
+                                'w'))
+                kwargs['stdout'], kwargs['stderr'] = fds
+            else:
+                kwargs['stdout'] = asyncio.subprocess.PIPE
+
+            res['start'] = time.time()
+            proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+            if pin and args[0] != 'taskset' and \
+                    hasattr(os, 'sched_setaffinity'):
+                try:
+                    os.sched_setaffinity(proc.pid, cpus)
+                except OSError:
+                    pass
+            admission.set_pid(rid, proc.pid)
+            monitor = profiler.ProcMonitor(
+                proc.pid, 'shell' if stage is None else stage,
+                subject=jobname)
+            monitor.start()
+
+            if log:
+                await proc.wait()
+            else:
+                res['output'], _ = await proc.communicate()
+            res['returncode'] = proc.returncode
+            monitor.stop(returncode=proc.returncode)
+            monitor = None
+            res['elapsed'] = time.time() - res['start']
+
+            if proc.returncode != 0:
+                print(f"Error {jobcmd}: exit code {proc.returncode}")
+            sys.stdout.flush()
+
+        except asyncio.CancelledError:
+            if proc is not None and proc.returncode is None:
+                print(f"Cancel {jobname}")
+                sys.stdout.flush()
+                _kill_tree_pid(proc.pid)
+                await proc.wait()
+            raise
+
+        except Exception as e:
+            print(f"Error {jobcmd}: {e}")
+
+        finally:
+            if monitor is not None:
+                monitor.stop(save=False)
+            for fd in fds:
+                fd.close()
+            admission.release(rid)
+            if cpus is not None:
+                free_sets.put_nowait(cpus)
+            if lock is not None:
+                lock.release()
+
+    return res
+
+
+# %% _run_shell_jobs ==========================================================
+async def _run_shell_jobs(scmds, jobNames, Nr_proc, log, stage, locks,
+                          threads, pin, cpu_sets):
+    sem = asyncio.Semaphore(Nr_proc)
+    free_sets = asyncio.Queue()
+    for cpus in cpu_sets:
+        free_sets.put_nowait(cpus)
+
+    jobs = []
+    for jn in range(len(scmds)):
+        print(f"Submit job {jobNames[jn]}")
+        jobs.append(_exec_cmd_async(
+            scmds[jn], jobNames[jn], log, sem, free_sets, stage=stage,
+            lock_f=locks[jn], threads=threads, pin=pin))
+    sys.stdout.flush()
 
-    except Exception as e:
-        print(f"Error {jobcmd}: {e}")
-        return -1
+    return await asyncio.gather(*jobs)
 
 
 # %% run_multi_shell ==========================================================
-def run_multi_shell(scmds, jobNames=[], Nr_proc=0, log=True):
+def run_multi_shell(scmds, jobNames=[], Nr_proc=0, log=True, stage=None,
+                    locks=None, threads=None, pin=False, details=False):
+    """
+    Run shell commands in parallel.
+    The commands are run directly as subprocesses of this process by an
+    asyncio event loop, and stdout and stderr are written to
+    swarmlog/{jobname}_{pid}_swarm.[oe]. On Ctrl-C, the running commands are
+    terminated.
+    locks: lock file of each job (or None). A job whose lock is held by a
+    live process is skipped.
+    threads: number of threads of a job. Each job is given a set of physical
+    cores, and OMP_NUM_THREADS, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS, and
+    MKL_NUM_THREADS are set to its size. The number of parallel jobs is
+    reduced so that threads x jobs does not exceed the physical cores. The
+    default shares the cores evenly between the jobs.
+    pin: bind each job to its core set with taskset (or sched_setaffinity on
+    the started process if taskset is not available).
+    Returns a list of the results of the jobs: 0 (log=True) or the output
+    (log=False) for a job that succeeded, and -1 for a job that failed, was
+    skipped, or could not be run.
+    details: return a list of dicts with the exit code ('returncode', -1 if
+    the job was skipped or could not be run), 'start' time (None if it was
+    not started), and 'elapsed' seconds of each job instead.
+    """
     # Set jobNames
     if len(jobNames) < len(scmds):
         jobNames += map(str, range(len(jobNames)+1, len(scmds)+1))
 
+    if locks is None:
+        locks = [None] * len(scmds)
+
     # Set number of proceccors
     if Nr_proc < 0:
         Nr_proc = max(int(multiprocessing.cpu_count()//2)+Nr_proc, 1)
@@ -156,19 +468,8 @@ def run_multi_shell(scmds, jobNames=[], Nr_proc=0, log=True):
     if len(scmds) < Nr_proc:
         Nr_proc = len(scmds)
 
-    # Create processor pool
-    pool = multiprocessing.Pool(processes=Nr_proc)
-
-    # Submit jobs to processor pool
-    pret = []
-    for jn in range(len(scmds)):
-        print(f"Submit job {jobNames[jn]}")
-        sys.stdout.flush()
-        pret.append(pool.apply_async(_exec_cmd_shell,
-                                     (scmds[jn], jobNames[jn], log)))
-
-    # Close processor pool (no more jobs)
-    pool.close()
+    # Core set of each parallel job
+    Nr_proc, threads, cpu_sets = core_sets(Nr_proc, threads)
 
     # Print message
     if len(scmds) == 1:
@@ -179,14 +480,21 @@ def run_multi_shell(scmds, jobNames=[], Nr_proc=0, log=True):
             print("(Each job is executed sequentially))")
         else:
             print(f"({Nr_proc} jobs are executed in parallel)")
-
+    print(f"Each job uses {threads} threads")
     sys.stdout.flush()
 
-    # Wait for finish
-    pool.join()
+    # Run and wait for finish
+    results = asyncio.run(_run_shell_jobs(scmds, jobNames, Nr_proc, log,
+                                          stage, locks, threads, pin,
+                                          cpu_sets))
+    if details:
+        return results
 
     ret = []
-    for pr in pret:
-        ret.append(pr.get())
+    for res in results:
+        if res['returncode'] != 0:
+            ret.append(-1)
+        else:
+            ret.append(0 if log else res['output'])
 
     return ret
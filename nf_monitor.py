@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event-driven monitor for the nextflow runs launched by run_TractoFlow.py and
+run_FreewaterFlow.py.
+
+Each run is followed through the exact process that was launched and its
+trace file (nextflow -with-trace). Every completed task in the trace
+triggers a check of the subject's result file, so subject completion is
+reported as soon as it happens. No fixed sleep or host-wide pgrep is
+needed.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+import queue
+import subprocess
+import threading
+
+
+# %% parse_trace_tag ==========================================================
+def parse_trace_tag(line, name_col):
+    """
+    Return the tag of a task (e.g., 'S1' of 'PFT_Tracking (S1)') in a trace
+    line, or None.
+    """
+    cols = line.rstrip('\n').split('\t')
+    if len(cols) <= name_col:
+        return None
+
+    name = cols[name_col]
+    if '(' not in name or not name.endswith(')'):
+        return None
+
+    return name[name.rindex('(') + 1:-1].strip()
+
+
+# %% NextflowMonitor ==========================================================
+class NextflowMonitor:
+    """
+    Follow nextflow processes and report events through a queue.
+    Events are tuples:
+        ('done', key, subject): the subject's result file is made
+        ('failed', key, subject): the run exited without the result file
+        ('exit', key, returncode): the nextflow process exited
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def watch(self, key, proc, trace_f, subjects, is_done, interval=1):
+        """
+        Start following a nextflow process.
+        key: ID of the run reported with the events
+        proc: subprocess.Popen object of the nextflow run
+        trace_f: trace file of the run
+        subjects: subjects processed in the run
+        is_done: function(subject) returning True if the subject is done
+        """
+        th = threading.Thread(
+            target=self._follow,
+            args=(key, proc, Path(trace_f), subjects, is_done, interval),
+            daemon=True)
+        th.start()
+
+        return th
+
+    def _follow(self, key, proc, trace_f, subjects, is_done, interval):
+        pending = set(subjects)
+        fd = None
+        buf = ''
+        name_col = None
+        while True:
+            exited = proc.poll() is not None
+
+            # Read new lines of the trace file
+            if fd is None and trace_f.is_file():
+                fd = open(trace_f, 'r')
+
+            if fd is not None:
+                buf += fd.read()
+                lines = buf.split('\n')
+                buf = lines[-1]
+                for line in lines[:-1]:
+                    if name_col is None:
+                        header = line.split('\t')
+                        name_col = header.index('name') \
+                            if 'name' in header else 3
+                        continue
+
+                    tag = parse_trace_tag(line, name_col)
+                    if tag in pending and is_done(tag):
+                        pending.discard(tag)
+                        self.events.put(('done', key, tag))
+
+            if exited:
+                break
+
+            try:
+                proc.wait(timeout=interval)
+            except subprocess.TimeoutExpired:
+                pass
+
+        if fd is not None:
+            fd.close()
+
+        # Final check
+        for sub in sorted(pending):
+            if is_done(sub):
+                self.events.put(('done', key, sub))
+            else:
+                self.events.put(('failed', key, sub))
+
+        self.events.put(('exit', key, proc.returncode))
+
+    def get(self, timeout=None):
+        """
+        Wait for the next event. Returns None at timeout.
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
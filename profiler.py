@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resource profiler for the external commands run by TractoFlowProc.
+
+The process tree of each command is sampled with psutil to record peak RSS,
+CPU seconds, wall time and bytes read/written. The records are appended to
+a local history file per stage and subject, and their percentiles, scaled
+by the input size, are used to estimate the resources of later jobs.
+"""
+
+
+# %% import ===================================================================
+import fcntl
+import json
+import math
+import subprocess
+import threading
+import time
+from socket import gethostname
+
+import numpy as np
+import psutil
+
+import telemetry
+
+# %% Settings =================================================================
+STATE_DIR = telemetry.STATE_DIR
+HISTORY_F = STATE_DIR / 'profile_history.jsonl'
+
+# Minimum number of records to trust the measured profile
+MIN_RECORDS = 3
+
+
+# %% ProcMonitor ==============================================================
+class ProcMonitor(threading.Thread):
+    """
+    Sample the resource use of a process and its descendants until the
+    process exits or stop() is called.
+    The start and end of the process are emitted to the telemetry events if
+    events is True.
+    """
+
+    def __init__(self, pid, stage, subject=None, input_size=None,
+                 interval=2, events=True):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.stage = stage
+        self.subject = subject
+        self.input_size = input_size
+        self.interval = interval
+        self.events = events
+
+        self.start_time = time.time()
+        self.peak_rss = 0
+        self._cpu = {}  # pid -> cpu seconds
+        self._io = {}  # pid -> (read_bytes, write_bytes)
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        try:
+            proc = psutil.Process(self.pid)
+            procs = [proc] + proc.children(recursive=True)
+        except psutil.Error:
+            return False
+
+        rss = 0
+        for pp in procs:
+            try:
+                with pp.oneshot():
+                    rss += pp.memory_info().rss
+                    ct = pp.cpu_times()
+                    self._cpu[pp.pid] = ct.user + ct.system
+                    try:
+                        io = pp.io_counters()
+                        self._io[pp.pid] = (io.read_bytes, io.write_bytes)
+                    except (psutil.Error, AttributeError):
+                        pass
+            except psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+        return True
+
+    def cpu_seconds(self):
+        """
+        CPU seconds used so far by the process and its descendants.
+        """
+        return sum(self._cpu.values())
+
+    def run(self):
+        if self.events:
+            telemetry.emit('start', self.stage, self.subject,
+                           command_pid=self.pid)
+        while not self._stop_event.is_set():
+            if not self._sample():
+                break
+            self._stop_event.wait(self.interval)
+
+    def stop(self, returncode=None, save=True):
+        """
+        Stop sampling and return the record. The record is appended to the
+        history file if save is True.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        record = {
+            'stage': self.stage, 'subject': self.subject,
+            'host': gethostname(), 'start': self.start_time,
+            'wall': time.time() - self.start_time,
+            'peak_rss': self.peak_rss,
+            'cpu_seconds': self.cpu_seconds(),
+            'read_bytes': sum([v[0] for v in self._io.values()]),
+            'write_bytes': sum([v[1] for v in self._io.values()]),
+            'input_size': self.input_size,
+            'returncode': returncode}
+
+        if save:
+            save_record(record)
+
+        if self.events:
+            telemetry.emit('end', self.stage, self.subject,
+                           command_pid=self.pid, returncode=returncode,
+                           wall=record['wall'], peak_rss=self.peak_rss,
+                           cpu_seconds=record['cpu_seconds'])
+
+        return record
+
+
+# %% save_record ==============================================================
+def save_record(record):
+    try:
+        if not STATE_DIR.is_dir():
+            STATE_DIR.mkdir(parents=True)
+        with open(HISTORY_F, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.write(json.dumps(record) + '\n')
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    except Exception as e:
+        print(f"Failed to save the profile record: {e}")
+
+
+# %% load_history =============================================================
+def load_history(stage=None):
+    if not HISTORY_F.is_file():
+        return []
+
+    records = []
+    with open(HISTORY_F, 'r') as fd:
+        for line in fd:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if stage is not None and rec['stage'] != stage:
+                continue
+            records.append(rec)
+
+    return records
+
+
+# %% estimate =================================================================
+def estimate(stage, input_size=None, q=90):
+    """
+    Estimate {'mem': bytes, 'cpu': cores} for one job of the stage from the
+    successful records. Memory is the q-th percentile of the peak RSS, per
+    unit of input size when the input size is known. CPU is the median
+    number of cores used (CPU seconds / wall time).
+    Returns None if the stage has not been measured enough.
+    """
+    records = [rec for rec in load_history(stage)
+               if rec.get('returncode') in (0, None) and rec['peak_rss'] > 0
+               and rec['wall'] > 0]
+    if len(records) < MIN_RECORDS:
+        return None
+
+    sized = [rec for rec in records if rec.get('input_size')]
+    if input_size and len(sized) >= MIN_RECORDS:
+        mem = np.percentile(
+            [rec['peak_rss'] / rec['input_size'] for rec in sized], q) * \
+            input_size
+    else:
+        mem = np.percentile([rec['peak_rss'] for rec in records], q)
+
+    cpu = np.median([rec['cpu_seconds'] / rec['wall'] for rec in records])
+
+    return {'mem': float(mem), 'cpu': max(int(math.ceil(cpu)), 1)}
+
+
+# %% dwi_input_size ===========================================================
+def dwi_input_size(dwi_f):
+    """
+    Number of voxels x volumes of a DWI file (read from the header only).
+    """
+    try:
+        import nibabel as nib
+        return int(np.prod(nib.load(str(dwi_f)).shape))
+    except Exception:
+        return None
+
+
+# %% check_call ===============================================================
+def check_call(cmd, stage, subject=None, input_size=None, **kwargs):
+    """
+    subprocess.check_call with profiling of the process tree.
+    """
+    proc = subprocess.Popen(cmd, **kwargs)
+    monitor = ProcMonitor(proc.pid, stage, subject=subject,
+                          input_size=input_size)
+    monitor.start()
+    try:
+        ret = proc.wait()
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        monitor.stop(returncode=proc.returncode, save=False)
+        raise
+
+    monitor.stop(returncode=ret)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+    return ret
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    # Summarize the history
+    records = load_history()
+    stages = sorted(set([rec['stage'] for rec in records]))
+    for stage in stages:
+        recs = [rec for rec in records if rec['stage'] == stage]
+        peak = np.array([rec['peak_rss'] for rec in recs]) / 1e9
+        wall = np.array([rec['wall'] for rec in recs]) / 60
+        print(f"{stage:20s} n={len(recs):4d}"
+              f" peak RSS median={np.median(peak):.1f}GB"
+              f" p90={np.percentile(peak, 90):.1f}GB"
+              f" wall median={np.median(wall):.1f}min"
+              f" estimate={estimate(stage)}")
@@ -8,16 +8,25 @@ from pathlib import Path
 import os
 import shlex
 import subprocess
-import multiprocessing
 
-from mproc import run_multi_shell
+from mproc import run_multi_shell, physical_cores
+from joblock import is_locked
+from state_index import StateIndex
 
 
 # %% run_reconall =============================================================
-def run_reconall(input_folder, FS_SUBJ_DIR):
+def run_reconall(input_folder, FS_SUBJ_DIR, rescan=False, subjects=None,
+                 pin=False):
     """
     Run FreeSurfer recon-all to create aparc+aseg and wmparc
+    Subjects recorded as done in the state index are not checked on disk.
+    Each recon-all uses up to 4 OpenMP threads, and threads x parallel jobs
+    does not exceed the physical cores.
+    pin: bind each recon-all to its cores.
     """
+    def is_done(subjid):
+        return (FS_SUBJ_DIR / subjid / 'mri' / 'aparc+aseg.mgz').is_file() \
+            and (FS_SUBJ_DIR / subjid / 'mri' / 'wmparc.mgz').is_file()
 
     if not FS_SUBJ_DIR.is_dir():
         os.makedirs(FS_SUBJ_DIR)
@@ -25,34 +34,34 @@ def run_reconall(input_folder, FS_SUBJ_DIR):
     # Get subject folders
     SUBJIDS = [dd.name for dd in input_folder.glob('*')
                if dd.is_dir() and (dd / 't1.nii.gz').is_file()]
+    if subjects is not None:
+        SUBJIDS = [subjid for subjid in SUBJIDS if subjid in subjects]
+
+    index = StateIndex(input_folder.parent)
+    done = index.done_subjects('freesurfer', SUBJIDS, is_done, rescan=rescan)
 
     # Prepare command lines
     Cmds = []
     JobNames = []
+    Locks = []
+    Subjs = []
     for subjid in SUBJIDS:
         dst_root = FS_SUBJ_DIR / subjid
-
-        aseg_f = dst_root / 'mri' / 'aparc+aseg.mgz'
-        wmparc_f = dst_root / 'mri' / 'wmparc.mgz'
-        if aseg_f.is_file() and wmparc_f.is_file():
+        if subjid in done:
             continue
 
         IsRun = input_folder / f"IsRunning.{subjid}"
         IsRun_FS = dst_root / 'scripts' / 'IsRunning.lh+rh'
-        if IsRun.is_file() or IsRun_FS.is_file():
+        if is_locked(IsRun) or IsRun_FS.is_file():
             print("IsRun file exists."
                   f" Recon-all for {subjid} seems to be running.\n"
                   f"Otherwise, remove {IsRun} file.")
             continue
 
         # Make command
+        # IsRun is held by the worker process while the job runs.
         cmd = ''
 
-        # Check if the job is running (on anohter node).
-        cmd += f"if test -f {IsRun}; then exit; fi; "
-        # Place IsRun to block other process
-        cmd += f"hostname > {IsRun} && date >> {IsRun} && "
-
         # recon-all
         t1_src_f = input_folder / subjid / 't1.nii.gz'
         t2_src_f = input_folder / subjid / 't2.nii.gz'
@@ -68,22 +77,37 @@ def run_reconall(input_folder, FS_SUBJ_DIR):
                 cmd += f" -T2 {t2_src_f}"
             cmd += " -T2pial"
 
-        cmd += " -all -openmp 4;"
-        cmd += f"if test -f {IsRun}; then rm {IsRun}; fi"
+        # OMP_NUM_THREADS is set by run_multi_shell
+        cmd += " -all -openmp ${OMP_NUM_THREADS}"
 
         Cmds.append(cmd)
         JobNames.append(f"Recon-all_{subjid}")
+        Locks.append(IsRun)
+        Subjs.append(subjid)
 
     # Run command list in parallel
     if len(Cmds) > 0:
-        nr_proc = min(len(Cmds), max(int(multiprocessing.cpu_count() // 2), 1))
-        run_multi_shell(Cmds, JobNames, Nr_proc=nr_proc)
+        n_cores = len(physical_cores())
+        nr_proc = min(len(Cmds), n_cores)
+        threads = max(min(4, n_cores // nr_proc), 1)
+        results = run_multi_shell(Cmds, JobNames, Nr_proc=nr_proc,
+                                  stage='freesurfer', locks=Locks,
+                                  threads=threads, pin=pin, details=True)
+        # Jobs skipped for a lock held by another process are not failures
+        for subjid, res in zip(Subjs, results):
+            if is_done(subjid):
+                index.set('freesurfer', subjid, 'done')
+            elif res['returncode'] != 0 and res['start'] is not None:
+                index.set('freesurfer', subjid, 'failed')
 
 
 # %% Copy aparc+aseg and wmparc ===============================================
-def copy_aparc_wmparc(input_folder, FS_SUBJ_DIR, overwrite=False):
+def copy_aparc_wmparc(input_folder, FS_SUBJ_DIR, overwrite=False,
+                      subjects=None):
     SUBJIDS = [dd.name for dd in input_folder.glob('*')
                if dd.is_dir() and (dd / 't1.nii.gz').is_file()]
+    if subjects is not None:
+        SUBJIDS = [subjid for subjid in SUBJIDS if subjid in subjects]
     for subjid in SUBJIDS:
         dst_dir = input_folder / subjid
         subjdir = FS_SUBJ_DIR / subjid
@@ -124,6 +148,12 @@ if __name__ == '__main__':
     parser.add_argument('input_folder', help='input folder')
     parser.add_argument('--copy_local', action='store_true',
                         help='Copy local working place')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
+    parser.add_argument('--pin', action='store_true',
+                        help='Bind each recon-all to its CPU cores')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
@@ -139,10 +169,12 @@ if __name__ == '__main__':
     overwrite = args.overwrite
 
     # Run recon-all
-    run_reconall(input_folder, subjdir)
+    run_reconall(input_folder, subjdir, rescan=args.rescan,
+                 subjects=args.subjects, pin=args.pin)
 
     # Copy aparc+aseg and wmparc to TractoFlow input_folder
-    copy_aparc_wmparc(input_folder, subjdir, overwrite=overwrite)
+    copy_aparc_wmparc(input_folder, subjdir, overwrite=overwrite,
+                      subjects=args.subjects)
 
     # Sync to the original workpalce
     if copy_local and subjdir != FS_SUBJ_DIR:
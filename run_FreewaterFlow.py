@@ -19,17 +19,31 @@ pip install -e .
 
 # %% import ===================================================================
 import argparse
+from functools import partial
 from pathlib import Path
+from socket import gethostname
+import os
 import shlex
 import subprocess
 import sys
 import shutil
-import time
-from socket import gethostname
 
-import psutil
 import numpy as np
 
+import admission
+import profiler
+from nf_monitor import NextflowMonitor
+from filesync import CopyBack, sync_tree
+from joblock import Lease, is_locked
+from state_index import StateIndex
+
+
+# %% is_fwflow_done ===========================================================
+def is_fwflow_done(results_root, sub):
+    last_f = results_root / sub / 'FW_Corrected_Metrics' / \
+        f"{sub}__fw_corr_tensor.nii.gz"
+    return last_f.is_file()
+
 
 # %% __main__ =================================================================
 if __name__ == '__main__':
@@ -49,6 +63,15 @@ if __name__ == '__main__':
     parser.add_argument('--b_thr', type=float,
                         help='Limit value to consider that a b-value is on' +
                         ' an existing shell. The default is 40.')
+    parser.add_argument('--copy_streams', default=4, type=int,
+                        help='Number of parallel file copies for copying'
+                        ' back the results')
+    parser.add_argument('--verify_checksum', action='store_true',
+                        help='Verify the copied files by checksum')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
@@ -56,8 +79,7 @@ if __name__ == '__main__':
     assert tf_results_folder.is_dir(), f"No directory at {tf_results_folder}"
 
     num_proc = args.num_proc
-    num_proc_possible = max(int(np.round(psutil.virtual_memory().available /
-                                         (20 * 10e8))), 1)
+    num_proc_possible = admission.max_concurrency('freewaterflow')
     if num_proc == 0:
         num_proc = num_proc_possible
     else:
@@ -68,6 +90,10 @@ if __name__ == '__main__':
     workplace = args.workplace
     if workplace is not None:
         workplace = Path(workplace).resolve()
+    copy_streams = args.copy_streams
+    verify_checksum = args.verify_checksum
+    rescan = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     '''DEBUG
@@ -76,14 +102,19 @@ if __name__ == '__main__':
     main_nf = Path.home() / 'freewater_flow' / 'main.nf'
     copy_local = False
     workplace = None
+    rescan = False
+    subjects = None
     overwrite = False
     '''
 
     wd0 = tf_results_folder.parent
 
     if workplace is None:
+        # A folder of this run, as other instances on the host may share
+        # ~/fwflow_work
         tmp_workplace = True
-        workplace = Path.home() / 'fwflow_work'
+        workplace = Path.home() / 'fwflow_work' / \
+            f"{gethostname()}_{os.getpid()}"
     else:
         tmp_workplace = False
 
@@ -94,128 +125,202 @@ if __name__ == '__main__':
                                            '__b0_mask_resampled.nii.gz')
                      }
 
+    index = StateIndex(wd0)
+
+    def copy_back_done(sub, ok):
+        if ok:
+            index.set('freewaterflow', sub, 'done', outputs=[
+                wd0 / 'results' / sub / 'FW_Corrected_Metrics' /
+                f"{sub}__fw_corr_tensor.nii.gz"],
+                checksum=verify_checksum)
+        else:
+            index.set('freewaterflow', sub, 'failed')
+
     # --- Proc loop -----------------------------------------------------------
     while True:
         # Get input data
         sub_dirs = [sub_dir for sub_dir in tf_results_folder.glob('*')
                     if sub_dir.is_dir() and
                     sub_dir.name not in ('Readme', 'Compute_Kernel')]
+        if subjects is not None:
+            sub_dirs = [sub_dir for sub_dir in sub_dirs
+                        if sub_dir.name in subjects]
 
         # Check if the job is done
+        # Subjects recorded as done in the state index are not checked on
+        # disk.
+        if overwrite:
+            done = set()
+        else:
+            done = index.done_subjects(
+                'freewaterflow', [sub_dir.name for sub_dir in sub_dirs],
+                partial(is_fwflow_done, tf_results_folder), rescan=rescan)
+            rescan = False
+
         done_subj = []
         for sub_dir in sub_dirs:
             sub = sub_dir.name
-            results_dir = tf_results_folder / sub
-            last_f = results_dir / 'FW_Corrected_Metrics' / \
-                f"{sub}__fw_corr_tensor.nii.gz"
-            if last_f.is_file() and not overwrite:
+            if sub in done:
                 done_subj.append(sub_dir)
 
-        # Check running process
-        for isrun in wd0.glob('IsRun_FWF_*'):
-            with open(isrun, 'r') as fd:
-                run_subjs = [tf_results_folder / subj
-                             for subj in fd.read().rstrip().split(',')]
-            done_subj.extend(run_subjs)
+            # Running on any host
+            elif is_locked(wd0 / f'IsRun_FWF_{sub}'):
+                done_subj.append(sub_dir)
 
         done_subj = np.unique(done_subj)
         sub_dirs = np.setdiff1d(sub_dirs, done_subj)
         if len(sub_dirs) == 0:
             break
 
-        # Process num_proc subjects at once
-        sub_dirs = sub_dirs[:num_proc]
+        # Process num_proc subjects at once as far as the node resources
+        # allow. The first subject waits for the resources.
+        locks = {}
+        rids = []
+        for sub_dir in sub_dirs:
+            if len(locks) >= num_proc:
+                break
 
-        # Put IsRun
-        IsRun = wd0 / f'IsRun_FWF_{gethostname()}'
-        run_subjs = [d.name for d in sub_dirs]
-        with open(IsRun, 'w') as fd:
-            print(','.join(run_subjs), file=fd)
+            lock = Lease(wd0 / f'IsRun_FWF_{sub_dir.name}')
+            if not lock.acquire():
+                continue
 
-        # --- Prepare input files ---------------------------------------------
-        if tmp_workplace and workplace.is_dir():
-            shutil.rmtree(workplace)
+            input_size = profiler.dwi_input_size(
+                sub_dir / 'Resample_DWI' /
+                f"{sub_dir.name}__dwi_resampled.nii.gz")
+            if len(rids) == 0:
+                rid = admission.admit('freewaterflow', subject=sub_dir.name,
+                                      input_size=input_size)
+            else:
+                rid = admission.try_admit('freewaterflow',
+                                          subject=sub_dir.name,
+                                          input_size=input_size)
+            if rid is None:
+                lock.release()
+                break
+            rids.append(rid)
+            locks[sub_dir] = lock
 
-        if not workplace.is_dir():
-            workplace.mkdir()
+        if len(locks) == 0:
+            continue
+        sub_dirs = list(locks.keys())
 
-        fwflow_input_dir = workplace / 'fwflow_input'
-        if fwflow_input_dir.is_dir():
-            shutil.rmtree(fwflow_input_dir)
-        fwflow_input_dir.mkdir()
+        # The leases and the admission reservations are released even if
+        # the run or the copy-back fails.
+        try:
+            # --- Prepare input files -----------------------------------------
+            if tmp_workplace and workplace.is_dir():
+                shutil.rmtree(workplace)
 
-        print('Copy tractoflow results for freewater_flow')
-        excld_subj = []
-        for sub_dir in sub_dirs:
-            if not sub_dir.is_dir():
-                continue
+            if not workplace.is_dir():
+                workplace.mkdir(parents=True)
 
-            sub = sub_dir.name
-            dst_dir = fwflow_input_dir / sub
-            if not dst_dir.is_dir():
-                dst_dir.mkdir()
-
-            for dst_pat, src_pat in file_patterns.items():
-                dst_f = dst_dir / dst_pat
-                src_f = sub_dir / src_pat[0] / f"{sub}{src_pat[1]}"
-                if not src_f.is_file():
-                    src_f = sub_dir / src_pat[0].replace('_Topup', '') / \
-                        f"{sub}{src_pat[1]}"
-                    if not src_f.is_file():
-                        print(f"Not found {src_f} for {dst_f.name}")
-                        shutil.rmtree(dst_dir)
-                        excld_subj.append(sub_dir)
-                        break
-                dst_f.symlink_to(src_f)
-
-        sub_dirs = np.setdiff1d(sub_dirs, excld_subj)
-
-        # --- Run freewater_flow ----------------------------------------------
-        cmd = f"nextflow run -bg {main_nf} --input {fwflow_input_dir} -w q"
-        if b_thr is not None:
-            cmd += f" --bthr {b_thr}"
-        try:
-            print('-' * 80)
-            print(f"Run {cmd} at {workplace} in background.")
-            sys.stdout.flush()
-            subprocess.check_call(shlex.split(cmd), cwd=workplace)
-        except Exception:
-            print(f"Failed to run {cmd}")
-            sys.exit()
-
-        # Wait for complete
-        while True:
-            # Check if all the result filese are made
-            done_subj = []
+            fwflow_input_dir = workplace / 'fwflow_input'
+            if fwflow_input_dir.is_dir():
+                shutil.rmtree(fwflow_input_dir)
+            fwflow_input_dir.mkdir()
+
+            print('Copy tractoflow results for freewater_flow')
+            excld_subj = []
             for sub_dir in sub_dirs:
+                if not sub_dir.is_dir():
+                    continue
+
                 sub = sub_dir.name
-                results_dir = fwflow_input_dir.parent / 'results' / sub
-                last_f = results_dir / 'FW_Corrected_Metrics' / \
-                    f"{sub}__fw_corr_tensor.nii.gz"
-                if last_f.is_file():
-                    done_subj.append(sub_dir)
-
-            last_subs = np.setdiff1d(sub_dirs, done_subj)
-            if len(last_subs) == 0:
-                break
+                dst_dir = fwflow_input_dir / sub
+                if not dst_dir.is_dir():
+                    dst_dir.mkdir()
 
-            # Check if the process is running
-            cmd = f"pgrep -f 'run -bg {main_nf}'"
+                for dst_pat, src_pat in file_patterns.items():
+                    dst_f = dst_dir / dst_pat
+                    src_f = sub_dir / src_pat[0] / f"{sub}{src_pat[1]}"
+                    if not src_f.is_file():
+                        src_f = sub_dir / src_pat[0].replace('_Topup', '') / \
+                            f"{sub}{src_pat[1]}"
+                        if not src_f.is_file():
+                            print(f"Not found {src_f} for {dst_f.name}")
+                            shutil.rmtree(dst_dir)
+                            excld_subj.append(sub_dir)
+                            break
+                    dst_f.symlink_to(src_f)
+
+            sub_dirs = np.setdiff1d(sub_dirs, excld_subj)
+
+            # --- Run freewater_flow ------------------------------------------
+            trace_f = workplace / 'trace.txt'
+            if trace_f.is_file():
+                trace_f.unlink()
+            cmd = f"nextflow run {main_nf} --input {fwflow_input_dir} -w q"
+            cmd += f" -with-trace {trace_f}"
+            if b_thr is not None:
+                cmd += f" --bthr {b_thr}"
             try:
-                out = subprocess.check_output(shlex.split(cmd))
+                print('-' * 80)
+                print(f"Run {cmd} at {workplace}.")
+                sys.stdout.flush()
+                log_fd = open(workplace / 'fwflow_stdout.log', 'w')
+                proc = subprocess.Popen(shlex.split(cmd), cwd=workplace,
+                                        stdout=log_fd,
+                                        stderr=subprocess.STDOUT)
+                log_fd.close()
             except Exception:
-                break
-
-            time.sleep(10)
+                print(f"Failed to run {cmd}")
+                sys.exit()
+
+            input_size = np.sum([profiler.dwi_input_size(
+                sub_dir / 'Resample_DWI' /
+                f"{sub_dir.name}__dwi_resampled.nii.gz")
+                or 0 for sub_dir in sub_dirs])
+            prof = profiler.ProcMonitor(proc.pid, 'freewaterflow',
+                                        input_size=int(input_size) or None,
+                                        interval=30)
+            prof.start()
+            for sub_dir in sub_dirs:
+                index.set('freewaterflow', sub_dir.name, 'running')
+
+            # Wait for complete
+            # Each subject is copied back as soon as its results are made.
+            nf_mon = NextflowMonitor()
+            copier = CopyBack(num_streams=copy_streams,
+                              checksum=verify_checksum)
+            nf_mon.watch('fwflow', proc, trace_f, [d.name for d in sub_dirs],
+                         partial(is_fwflow_done, workplace / 'results'))
+            while True:
+                kind, _, val = nf_mon.get()
+                if kind == 'done':
+                    print(f"freewater_flow for {val} finished.")
+                    sys.stdout.flush()
+                    copier.submit(val, workplace / 'results' / val,
+                                  wd0 / 'results' / val,
+                                  on_done=copy_back_done)
+                elif kind == 'failed':
+                    print(f"freewater_flow for {val} failed."
+                          f" See {workplace}/.nextflow.log")
+                    index.set('freewaterflow', val, 'failed')
+                elif kind == 'exit':
+                    break
+            prof.stop(returncode=proc.returncode)
+
+            # --- Copy back ---------------------------------------------------
+            # Copy the rest of the files. Files already copied are skipped.
+            copier.shutdown()
+            shutil.rmtree(fwflow_input_dir)
+            sync_tree(workplace, wd0,
+                      exclude=('.nextflow*', 'q', 'fwflow_input', 'trace.txt',
+                               'fwflow_stdout.log'),
+                      num_streams=copy_streams, checksum=verify_checksum)
 
-        # --- Copy back -------------------------------------------------------
-        shutil.rmtree(fwflow_input_dir)
-        cmd = "rsync -rtuvz --copy-links --exclude='.nextflow*' --exclude='q'"
-        cmd += f" --exclude='fwflow_input' {workplace}/ {wd0}/"
-        subprocess.run(shlex.split(cmd))
+        finally:
+            for lock in locks.values():
+                lock.release()
 
-        if IsRun.is_file():
-            IsRun.unlink()
+            for rid in rids:
+                admission.release(rid)
 
-    if tmp_workplace and workplace.is_dir():
-        shutil.rmtree(workplace)
+    # Remove only the folder of this run
+    if tmp_workplace:
+        if workplace.is_dir():
+            shutil.rmtree(workplace)
+        try:
+            workplace.parent.rmdir()
+        except OSError:
+            pass
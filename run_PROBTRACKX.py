@@ -9,22 +9,242 @@ https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/FDT/UserGuide#PROBTRACKX_-_probabilistic_
 import argparse
 from pathlib import Path
 import shlex
+import os
+import shutil
 import subprocess
 import sys
 from socket import gethostname
-import time
+import tempfile
 
 from tqdm import tqdm
 import numpy as np
 import nibabel as nib
 import pandas as pd
 
+import admission
+import profiler
+import fsl_warp
+from mproc import imap_multi
+from joblock import Lease, is_locked
+from state_index import StateIndex
+
 if '__file__' not in locals():
     __file__ = 'run_PROBTRACKX.py'
 
 script_dir = Path(__file__).resolve().parent
 MNI_f = script_dir / 'MNI152_T1_1mm_brain.nii.gz'
 
+# Returned by run_roi_probtrackx when the ROI is run by another process
+SKIPPED = 'skipped'
+
+
+# %% load_roi_names ===========================================================
+def load_roi_names(seed_template):
+    """
+    ROI names of the seed values from the csv file next to seed_template,
+    or ROI_{value} if there is no csv file.
+    """
+    seed_template = Path(seed_template)
+    roi_name_f = seed_template.parent / \
+        seed_template.name.replace('.nii.gz', '.csv')
+    if roi_name_f.is_file():
+        ROI_names = pd.read_csv(roi_name_f, index_col=0).squeeze()
+    else:
+        seed_V = nib.load(seed_template).get_fdata().astype(int)
+        ROI_names = pd.Series(
+            {ri: f"ROI_{ri}" for ri in np.unique(seed_V) if ri != 0}
+        )
+
+    return ROI_names
+
+
+# %% make_seed_map ============================================================
+def make_seed_map(sub_d, res_dir, seed_template, overwrite=False):
+    """
+    Warp the seed template into the individual diffusion space.
+    """
+    sub = sub_d.name.replace('.bedpostX', '')
+    seed_map_f = res_dir / \
+        seed_template.name.replace('.nii.gz', '_diff.nii.gz')
+    if not seed_map_f.is_file() or overwrite:
+        t1_ref = sub_d.parent / sub / 'T1_brain.nii.gz'
+        wrp_f = sub_d / 'xfms' / 'standard2diff.nii.gz'
+        tmp_f = res_dir / f".{gethostname()}_{os.getpid()}_{seed_map_f.name}"
+        cmd = f"applywarp --ref={t1_ref} --in={seed_template}"
+        cmd += f" --warp={wrp_f} --interp=nn --out={tmp_f}"
+        subprocess.check_call(shlex.split(cmd))
+        os.replace(tmp_f, seed_map_f)
+
+    return seed_map_f
+
+
+# %% split_seed_labels ========================================================
+def split_seed_labels(seed_V):
+    """
+    Split a multi-label volume into the voxels of each label with a single
+    sort of the labeled voxels.
+    Returns {label: (flat voxel indices, bounding box slices)}.
+    """
+    flat = seed_V.ravel()
+    nz = np.flatnonzero(flat)
+    order = np.argsort(flat[nz], kind='stable')
+    nz = nz[order]
+    vals = flat[nz]
+    if len(vals) == 0:
+        return {}
+
+    # Boundaries of each label in the sorted voxels
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(vals)) + 1])
+    ends = np.concatenate([starts[1:], [len(vals)]])
+
+    # Bounding boxes of all labels
+    ijk = np.stack(np.unravel_index(nz, seed_V.shape))
+    bb_min = np.minimum.reduceat(ijk, starts, axis=1)
+    bb_max = np.maximum.reduceat(ijk, starts, axis=1)
+
+    labels = {}
+    for li, (st, en) in enumerate(zip(starts, ends)):
+        bbox = tuple([slice(bb_min[ax, li], bb_max[ax, li] + 1)
+                      for ax in range(seed_V.ndim)])
+        labels[vals[st].item()] = (nz[st:en], bbox)
+
+    return labels
+
+
+# %% write_roi_masks ==========================================================
+def write_roi_masks(seed_map_f, ROI_names, res_dir, overwrite=False):
+    """
+    Write seed masks of all ROIs from the multi-label seed map in one pass.
+    Returns {roi: mask file} for the ROIs with at least one voxel.
+    """
+    seed_f_dict = {}
+    todo = {}
+    for seed_idx, roi in ROI_names.items():
+        seed_f = res_dir / f"{roi}_ROI.nii.gz"
+        if seed_f.is_file() and not overwrite:
+            seed_f_dict[roi] = seed_f
+        else:
+            todo[seed_idx] = roi
+
+    if len(todo) == 0:
+        return seed_f_dict
+
+    seed_img = nib.load(seed_map_f)
+    seed_V = np.asanyarray(seed_img.dataobj).astype(int)
+    labels = split_seed_labels(seed_V)
+
+    # One mask volume is reused for all ROIs. Only the bounding box of the
+    # last ROI is cleared instead of allocating a volume for each ROI.
+    roi_V = np.zeros(seed_V.shape, dtype=np.uint8)
+    for seed_idx, roi in todo.items():
+        if seed_idx not in labels:
+            print(f"No voxel of {roi} (index {seed_idx}) in {seed_map_f}")
+            continue
+
+        idx, bbox = labels[seed_idx]
+        roi_V.flat[idx] = 1
+        simg = nib.Nifti1Image(roi_V, seed_img.affine)
+
+        seed_f = res_dir / f"{roi}_ROI.nii.gz"
+        tmp_f = res_dir / f".{gethostname()}_{os.getpid()}_{seed_f.name}"
+        nib.save(simg, tmp_f)
+        os.replace(tmp_f, seed_f)
+        seed_f_dict[roi] = seed_f
+        roi_V[bbox] = 0
+
+    return seed_f_dict
+
+
+# %% run_roi_probtrackx =======================================================
+def run_roi_probtrackx(sub_d, res_dir, seed_f, roi, gpu=False,
+                       overwrite=False, keep_scratch=False,
+                       save_intermediate=False):
+    """
+    Run probtrackx for one ROI of a subject and warp the probability map into
+    the template space.
+    probtrackx runs in a private scratch directory, and only the final map
+    and the waytotal are promoted into the subject folder by atomic renames,
+    so ROIs of a subject can be processed concurrently from several hosts.
+    The normalization by waytotal and the warp to the template space are done
+    in memory. The intermediate {roi}_fdt_paths_prob.nii.gz is saved only if
+    save_intermediate is True.
+    Returns the output file, or SKIPPED if the ROI is claimed by another
+    process. A probtrackx failure is raised so that the job is rerun.
+    """
+    sub = sub_d.name.replace('.bedpostX', '')
+    out_f = res_dir / f'{roi}_fdt_paths_prob_standard.nii.gz'
+    waytotal_f = res_dir / f'{roi}_waytotal'
+    if out_f.is_file() and not overwrite:
+        return str(out_f)
+
+    # Claim the ROI. A claim left by a crashed worker is reclaimed.
+    lock = Lease(res_dir / f".{roi}.lock")
+    if not lock.acquire():
+        return SKIPPED
+
+    scratch_dir = Path(tempfile.mkdtemp(
+        prefix=f".{roi}.{gethostname()}.", dir=res_dir))
+    try:
+        # probtrackx
+        if gpu:
+            cmd0 = 'probtrackx2_gpu'
+        else:
+            cmd0 = 'probtrackx2'
+
+        mask_f = sub_d.parent / sub / 'nodif_brain_mask'
+        cmd = cmd0 + f" -s {sub_d}/merged"
+        cmd += f" -m {mask_f}"
+        cmd += f" -x {seed_f} --opd -P 5000 -S 2000"
+        cmd += f" -o {roi}_fdt_paths --dir={scratch_dir} --forcedir"
+        try:
+            with admission.reserve('probtrackx', subject=sub):
+                profiler.check_call(shlex.split(cmd), 'probtrackx',
+                                    subject=f"{sub}_{roi}",
+                                    stdout=subprocess.DEVNULL)
+            fdt_path_f = scratch_dir / f'{roi}_fdt_paths.nii.gz'
+            assert fdt_path_f.is_file()
+        except Exception as e:
+            sys.stderr.write(f"Faild: {cmd}\n")
+            sys.stderr.write(f"{e}\n")
+            raise
+
+        # Make fdt_paths to probability
+        waytotal = float(np.loadtxt(scratch_dir / 'waytotal'))
+        fdt_img = nib.load(fdt_path_f)
+        prob_V = fdt_img.get_fdata(dtype=np.float32)
+        if waytotal > 0:
+            prob_V /= waytotal
+        else:
+            prob_V[:] = 0
+
+        if save_intermediate:
+            hdr = fdt_img.header.copy()
+            hdr.set_data_dtype(np.float32)
+            prob_fdt_path_f = scratch_dir / f'{roi}_fdt_paths_prob.nii.gz'
+            nib.save(nib.Nifti1Image(prob_V, fdt_img.affine, header=hdr),
+                     prob_fdt_path_f)
+
+        # Warp fdt_paths_prob to standard space
+        wrp2std_f = sub_d / 'xfms' / 'diff2standard.nii.gz'
+        tmp_out_f = scratch_dir / out_f.name
+        std_V = fsl_warp.apply_warp(prob_V, fdt_img, wrp2std_f)
+        fsl_warp.save_in_ref(std_V, MNI_f, tmp_out_f)
+
+        # Promote the results
+        if save_intermediate:
+            os.replace(prob_fdt_path_f, res_dir / prob_fdt_path_f.name)
+        os.replace(scratch_dir / 'waytotal', waytotal_f)
+        os.replace(tmp_out_f, out_f)
+
+    finally:
+        try:
+            if not keep_scratch:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+        finally:
+            lock.release()
+
+    return str(out_f)
+
 
 # %% __main__ =================================================================
 if __name__ == '__main__':
@@ -40,6 +260,25 @@ if __name__ == '__main__':
                         help='Filename of the seed mask in the template' +
                         ' (MNI152) space. Multiple seeds can be implemented' +
                         ' in one file with different values')
+    parser.add_argument('--num_proc', type=int,
+                        help='Number of (subject, ROI) jobs run in parallel.'
+                        ' The default is 1 with --gpu and'
+                        ' (number of CPU cores)//2 otherwise.')
+    parser.add_argument('--save_intermediate', action='store_true',
+                        help='Save {roi}_fdt_paths_prob.nii.gz in the'
+                        ' individual space')
+    parser.add_argument('--timeout', type=float,
+                        help='Kill a job that has run for this time'
+                        ' (seconds). No limit by default.')
+    parser.add_argument('--stall_timeout', type=float,
+                        help='Kill a job that has not used CPU for this time'
+                        ' (seconds). No limit by default.')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Number of reruns of a failed job')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
@@ -47,6 +286,15 @@ if __name__ == '__main__':
     assert FDT_folder.is_dir(), f"No directory at {FDT_folder}"
     gpu = args.gpu
     seed_template = Path(args.seed_template)
+    num_proc = args.num_proc
+    if num_proc is None:
+        num_proc = 1 if gpu else 0
+    save_intermediate = args.save_intermediate
+    timeout = args.timeout
+    stall_timeout = args.stall_timeout
+    retries = args.retries
+    rescan = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     '''DEBUG
@@ -55,114 +303,97 @@ if __name__ == '__main__':
     gpu = True
     seed_template = Path.home() / \
         'MRI/TractoFlow_workspace/DTI_AdolescentData/SeedROI.nii.gz'
+    save_intermediate = False
+    timeout = None
+    stall_timeout = None
+    retries = 1
+    rescan = False
+    subjects = None
     overwrite = False
     '''
 
     # --- Set ROI names -------------------------------------------------------
-    roi_name_f = seed_template.parent / \
-        seed_template.name.replace('.nii.gz', '.csv')
-    if roi_name_f.is_file():
-        ROI_names = pd.read_csv(roi_name_f, index_col=0).squeeze()
-    else:
-        seed_V = nib.load(seed_template).get_fdata().astype(int)
-        ROI_names = pd.Series(
-            {ri: f"ROI_{ri}" for ri in np.unique(seed_V) if ri != 0}
-        )
+    ROI_names = load_roi_names(seed_template)
 
     # --- Get input data ------------------------------------------------------
     Subj_dirs = [sub_dir for sub_dir in FDT_folder.glob('*.bedpostX')
                  if sub_dir.is_dir()]
+    if subjects is not None:
+        Subj_dirs = [sub_dir for sub_dir in Subj_dirs
+                     if sub_dir.name.replace('.bedpostX', '') in subjects]
 
     # Check if the job is done
+    # (subject, ROI) pairs recorded as done in the state index are not
+    # checked on disk.
+    def roi_out_f(key):
+        sub, roi = key.split('/')
+        return FDT_folder / f"{sub}.probtackx" / \
+            f'{roi}_fdt_paths_prob_standard.nii.gz'
+
+    index = StateIndex(FDT_folder.parent)
+    if overwrite:
+        done = set()
+    else:
+        done = index.done_subjects(
+            'probtrackx',
+            [f"{sub_dir.name.replace('.bedpostX', '')}/{roi}"
+             for sub_dir in Subj_dirs for roi in ROI_names.values],
+            lambda key: roi_out_f(key).is_file(), rescan=rescan)
+
     done_subj = []
     for sub_dir in Subj_dirs:
         sub = sub_dir.name.replace('.bedpostX', '')
-        res_dir = FDT_folder / f"{sub}.probtackx"
-        DONE = True
-        for roi in ROI_names.values:
-            last_f = res_dir / f'{roi}_fdt_paths_prob_standard.nii.gz'
-            if not last_f.is_file():
-                DONE = False
-                break
-        if DONE:
+        if all([f"{sub}/{roi}" in done for roi in ROI_names.values]):
             done_subj.append(sub_dir)
     Subj_dirs = np.setdiff1d(Subj_dirs, done_subj)
 
-    # --- Loop for subjects ---------------------------------------------------
-    for sub_d in tqdm(Subj_dirs, desc="Running probtackx"):
+    # --- Prepare jobs for (subject, ROI) pairs -------------------------------
+    # ROIs are claimed one by one in the workers, so several hosts can work on
+    # the same subject.
+    job_kwargs = []
+    for sub_d in tqdm(Subj_dirs, desc="Preparing probtackx"):
         sub = sub_d.name.replace('.bedpostX', '')
-        IsRun = FDT_folder / f"IsRun_probtackx_{sub}"
-        if IsRun.is_file():
-            continue
-
-        with open(IsRun, 'w', encoding='utf-8') as fd:
-            print(gethostname(), file=fd)
-            print(time.ctime(), file=fd)
-
         res_dir = FDT_folder / f"{sub}.probtackx"
         if not res_dir.is_dir():
             res_dir.mkdir()
 
         # Seed map in individual diffusion space
-        seed_map_f = res_dir / \
-            seed_template.name.replace('.nii.gz', '_diff.nii.gz')
-        if not seed_map_f.is_file() or overwrite:
-            t1_ref = sub_d.parent / sub / 'T1_brain.nii.gz'
-            wrp_f = sub_d / 'xfms' / 'standard2diff.nii.gz'
-            cmd = f"applywarp --ref={t1_ref} --in={seed_template}"
-            cmd += f" --warp={wrp_f} --interp=nn --out={seed_map_f}"
-            subprocess.check_call(shlex.split(cmd))
-
-        seed_img = nib.load(seed_map_f)
-        seed_V = seed_img.get_fdata().astype(int)
-
-        # Run PROBTRACKX
-        if gpu:
-            cmd0 = 'probtrackx2_gpu'
-        else:
-            cmd0 = 'probtrackx2'
+        seed_map_f = make_seed_map(sub_d, res_dir, seed_template,
+                                   overwrite=overwrite)
 
-        # Loop for ROIs
-        wrp2std_f = sub_d / 'xfms' / 'diff2standard.nii.gz'
+        # Seed masks of all ROIs
+        seed_f_dict = write_roi_masks(seed_map_f, ROI_names, res_dir,
+                                      overwrite=overwrite)
 
-        for seed_idx, roi in ROI_names.items():
-            out_f = res_dir / f'{roi}_fdt_paths_prob_standard.nii.gz'
-            if out_f.is_file() and not overwrite:
+        for roi, seed_f in seed_f_dict.items():
+            if f"{sub}/{roi}" in done:
                 continue
 
-            # Create seed mask for the roi
-            seed_f = res_dir / f"{roi}_ROI.nii.gz"
-            roi_V = np.zeros_like(seed_V, dtype=np.int8)
-            roi_V[seed_V == seed_idx] = 1
-            simg = nib.Nifti1Image(roi_V, seed_img.affine)
-            nib.save(simg, seed_f)
-
-            # probtrackx
-            mask_f = sub_d.parent / sub / 'nodif_brain_mask'
-            cmd = cmd0 + f" -s {sub_d}/merged"
-            cmd += f" -m {mask_f}"
-            cmd += f" -x {seed_f} --opd -P 5000 -S 2000"
-            cmd += f" -o {roi}_fdt_paths --dir={res_dir} --forcedir"
-            try:
-                subprocess.check_output(shlex.split(cmd))
-                fdt_path_f = res_dir / f'{roi}_fdt_paths.nii.gz'
-                assert fdt_path_f.is_file()
-            except Exception as e:
-                sys.stderr.write(f"Faild: {cmd}\n")
-                sys.stderr.write(f"{e}\n")
+            if is_locked(res_dir / f".{roi}.lock"):
                 continue
 
-            # Make fdt_paths to probability
-            waytotal = float(np.loadtxt(res_dir / 'waytotal'))
-            prob_fdt_path_f = res_dir / f'{roi}_fdt_paths_prob.nii.gz'
-            cmd = f"fslmaths {fdt_path_f} -div {waytotal} {prob_fdt_path_f}"
-            subprocess.check_call(shlex.split(cmd))
+            job_kwargs.append({'sub_d': sub_d, 'res_dir': res_dir,
+                               'seed_f': seed_f, 'roi': roi, 'gpu': gpu,
+                               'overwrite': overwrite,
+                               'save_intermediate': save_intermediate})
 
-            # Warp fdt_paths_prob.nii.gz to standard space
-            out_f = res_dir / f'{roi}_fdt_paths_prob_standard.nii.gz'
-            cmd = f"applywarp --ref={MNI_f} --in={prob_fdt_path_f}"
-            cmd += f" --warp={wrp2std_f} --out={out_f}"
-            subprocess.check_call(shlex.split(cmd))
+    # --- Run PROBTRACKX ------------------------------------------------------
+    # The state index is updated as each job completes.
+    if len(job_kwargs):
+        for job_i, out_f in tqdm(
+                imap_multi(job_kwargs, run_roi_probtrackx, num_proc=num_proc,
+                           timeout=timeout, stall_timeout=stall_timeout,
+                           retries=retries),
+                total=len(job_kwargs), desc="PROBTRACKX"):
+            kwargs = job_kwargs[job_i]
+            key = f"{kwargs['sub_d'].name.replace('.bedpostX', '')}/" \
+                f"{kwargs['roi']}"
+            # An ROI run by another process is not a failure
+            if out_f == SKIPPED:
+                continue
 
-        if IsRun.is_file():
-            IsRun.unlink()
+            if roi_out_f(key).is_file():
+                index.set('probtrackx', key, 'done',
+                          outputs=[roi_out_f(key)])
+            else:
+                index.set('probtrackx', key, 'failed')
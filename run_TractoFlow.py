@@ -7,6 +7,7 @@ https://tractoflow-documentation.readthedocs.io/en/latest/index.html
 
 # %% import ===================================================================
 import argparse
+from functools import partial
 import os
 from pathlib import Path
 import shlex
@@ -14,9 +15,143 @@ import subprocess
 import sys
 import shutil
 import time
-from socket import gethostname
 import numpy as np
-import psutil
+
+import admission
+import profiler
+from nf_monitor import NextflowMonitor
+from filesync import CopyBack
+from joblock import Lease, is_locked
+from state_index import StateIndex
+
+
+# %% is_tractoflow_done =======================================================
+def is_tractoflow_done(results_root, sub):
+    last_f = results_root / sub / 'PFT_Tracking' / \
+        f"{sub}__pft_tracking_prob_wm_seed_0.trk"
+    return last_f.is_file()
+
+
+# %% find_pending_subjects ====================================================
+def find_pending_subjects(input_orig, overwrite=False, exclude=[],
+                          ABS=False, index=None, rescan=False,
+                          subjects=None):
+    """
+    Find subjects whose input files are ready and that are not processed nor
+    running on any host.
+    Subjects recorded as done in the state index are not checked on disk.
+    subjects: limit the search to these subjects.
+    """
+    wd0 = input_orig.parent
+    required_files = ['bval', 'bvec', 'dwi.nii.gz', 't1.nii.gz']
+    if ABS:
+        required_files += ['aparc+aseg.nii.gz', 'wmparc.nii.gz']
+
+    sub_dirs = [sub_dir for sub_dir in sorted(input_orig.glob('*'))
+                if sub_dir.is_dir()]
+    if subjects is not None:
+        sub_dirs = [sub_dir for sub_dir in sub_dirs
+                    if sub_dir.name in subjects]
+    if overwrite:
+        done = set()
+    elif index is None:
+        done = set([sub_dir.name for sub_dir in sub_dirs
+                    if is_tractoflow_done(wd0 / 'results', sub_dir.name)])
+    else:
+        done = index.done_subjects(
+            'tractoflow', [sub_dir.name for sub_dir in sub_dirs],
+            partial(is_tractoflow_done, wd0 / 'results'), rescan=rescan)
+
+    pending = []
+    for sub_dir in sub_dirs:
+        sub = sub_dir.name
+        if sub in done or sub in exclude:
+            continue
+
+        # Subjects running on any host
+        if is_locked(wd0 / f'IsRun_TrF_{sub}'):
+            continue
+
+        # Dependencies are not ready yet
+        if not np.all([(sub_dir / ff).is_file() for ff in required_files]):
+            continue
+
+        pending.append(sub_dir)
+
+    return pending
+
+
+# %% launch_tractoflow ========================================================
+def launch_tractoflow(sub_dir, sub_work, ABS=False, fs=None, processes=None,
+                      use_cuda=False, fully_reproducible=False,
+                      with_docker=False, sif_file=None, tmpdir=None):
+    """
+    Launch TractoFlow for one subject in its own launch directory.
+    The task trace is written in sub_work/trace.txt.
+    """
+    sub = sub_dir.name
+    if not sub_work.is_dir():
+        sub_work.mkdir(parents=True)
+
+    # Link tractoflow input files
+    tractoflow_input_dir = sub_work / 'tractoflow_input'
+    if tractoflow_input_dir.is_dir():
+        shutil.rmtree(tractoflow_input_dir)
+    dst_dir = tractoflow_input_dir / sub
+    dst_dir.mkdir(parents=True)
+    for src_f in sub_dir.glob('*'):
+        if not src_f.is_file():
+            continue
+        dst_f = dst_dir / src_f.name
+        dst_f.symlink_to(src_f)
+
+    # Make the command
+    cmd = "nextflow run tractoflow -r 2.4.2"
+    cmd += f" --input {tractoflow_input_dir}"
+    if ABS:
+        cmd += f" --fs {fs}"
+    if processes is not None:
+        cmd += f" --processes {processes}"
+
+    profile = ['cbrain']  # Copy all the output files, not use symlinks.
+    if use_cuda:
+        profile.append('use_cuda')
+
+    if fully_reproducible:
+        profile.append('fully_reproducible')
+
+    if ABS:
+        profile.append('ABS')
+
+    if len(profile):
+        cmd += f" -profile {','.join(profile)}"
+
+    if with_docker:
+        # cmd += ' -with-docker scilus/scilus:1.4.2'
+        cmd += ' -with-docker scilus/scilus:1.6.0'
+    else:
+        cmd += f' -with-singularity {sif_file}'
+    cmd += ' -resume'
+
+    trace_f = sub_work / 'trace.txt'
+    if trace_f.is_file():
+        trace_f.unlink()
+    cmd += f" -with-trace {trace_f}"
+
+    if tmpdir is not None:
+        env = os.environ.copy()
+        env["SINGULARITY_TMPDIR"] = tmpdir
+    else:
+        env = None
+
+    print(f"Start TractoFlow for {sub} at {time.ctime()}")
+    sys.stdout.flush()
+    log_fd = open(sub_work / 'tractoflow_stdout.log', 'w')
+    proc = subprocess.Popen(shlex.split(cmd), cwd=sub_work, env=env,
+                            stdout=log_fd, stderr=subprocess.STDOUT)
+    log_fd.close()
+
+    return proc
 
 
 # %% __main__ =================================================================
@@ -43,8 +178,17 @@ if __name__ == '__main__':
     parser.add_argument('--with_docker', action='store_true',
                         help='with docker')
     parser.add_argument('--processes', help='The number of parallel processes'
-                        ' to launch.')
+                        ' to launch for each subject (default: 4).')
     parser.add_argument('--tempdir', help='Singurality tmp dir')
+    parser.add_argument('--copy_streams', default=4, type=int,
+                        help='Number of parallel file copies for copying'
+                        ' back the results')
+    parser.add_argument('--verify_checksum', action='store_true',
+                        help='Verify the copied files by checksum')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
@@ -58,6 +202,10 @@ if __name__ == '__main__':
     with_docker = args.with_docker
     processes = args.processes
     tmpdir = args.tempdir
+    copy_streams = args.copy_streams
+    verify_checksum = args.verify_checksum
+    rescan_index = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     ''' DEBUG
@@ -70,6 +218,8 @@ if __name__ == '__main__':
     num_proc = 0
     with_docker = True
     processes = None
+    rescan_index = False
+    subjects = None
     overwrite = False
     '''
 
@@ -78,8 +228,16 @@ if __name__ == '__main__':
         fs = input_orig.parent / 'freesurfer'
     if workplace is not None:
         workplace = Path(workplace).resolve()
-    num_proc_possible = max(int(np.round(psutil.virtual_memory().available /
-                                         (10 * 10e8))), 1)
+
+    # CPUs of each nextflow run (--processes), also reserved by admission.
+    # The measured CPU use of past runs is not used, as it is capped by
+    # --processes itself.
+    if processes is None:
+        processes = admission.DEFAULT_PROFILES['tractoflow']['cpu']
+    processes = int(processes)
+
+    num_proc_possible = admission.max_concurrency('tractoflow',
+                                                  cpu=processes)
     if num_proc == 0:
         num_proc = num_proc_possible
     else:
@@ -93,6 +251,10 @@ if __name__ == '__main__':
     else:
         tmp_workplace = False
 
+    if not workplace.is_dir():
+        workplace.mkdir()
+
+    sif_file = None
     if not with_docker:
         sif_files = sorted(
             list(Path(__file__).resolve().parent.glob('scilus*.sif')))
@@ -101,149 +263,157 @@ if __name__ == '__main__':
         sif_file = sif_files[-1]
 
     # --- Proc loop -----------------------------------------------------------
-    while True:
-        # -- Find unprocessed data ----
-        sub_dirs = [sub_dir for sub_dir in input_orig.glob('*')
-                    if sub_dir.is_dir()]
-        required_files = ['bval', 'bvec', 'dwi.nii.gz', 't1.nii.gz']
-
-        # Check if the job is done
-        done_subj = []
-        for sub_dir in sub_dirs:
-            sub = sub_dir.name
-            results_dir = input_orig.parent / 'results' / sub
-            last_f = results_dir / 'PFT_Tracking' / \
-                f"{sub}__pft_tracking_prob_wm_seed_0.trk"
-            if last_f.is_file() and not overwrite:
-                done_subj.append(sub_dir)
-
-            if not np.all([(sub_dir / ff).is_file() for ff in required_files]):
-                done_subj.append(sub_dir)
-
-        # Check running process
-        for isrun in wd0.glob('IsRun_TrF_*'):
-            with open(isrun, 'r') as fd:
-                run_subjs = [input_orig / subj
-                             for subj in fd.read().rstrip().split(',')]
-            done_subj.extend(run_subjs)
-
-        done_subj = np.unique(done_subj)
-        sub_dirs = np.setdiff1d(sub_dirs, done_subj)
-        if len(sub_dirs) == 0:
-            break
-
-        # Process num_proc subjects at once
-        sub_dirs = sub_dirs[:num_proc]
-
-        # Put IsRun
-        IsRun = wd0 / f'IsRun_TrF_{gethostname()}'
-        run_subjs = [d.name for d in sub_dirs]
-        with open(IsRun, 'w') as fd:
-            print(','.join(run_subjs), file=fd)
-
-        print(f"{len(sub_dirs)} data will be processed.")
-
-        # -- Prepare input files ----
-        if tmp_workplace and workplace.is_dir():
-            shutil.rmtree(workplace)
-
-        if not workplace.is_dir():
-            workplace.mkdir()
-
-        tractoflow_input_dir = workplace / 'tractoflow_input'
-        tractoflow_input_dir.mkdir()
-
-        print('Link tractoflow input files')
-        for sub_dir in sub_dirs:
-            if not sub_dir.is_dir():
-                continue
-
-            sub = sub_dir.name
-            dst_dir = tractoflow_input_dir / sub
-            if not dst_dir.is_dir():
-                dst_dir.mkdir()
-
-            for src_f in sub_dir.glob('*'):
-                if not src_f.is_file():
-                    continue
-                dst_f = dst_dir / src_f.name
-                dst_f.symlink_to(src_f)
-
-        # -- Run TractoFlow ----
-        cmd = "nextflow run -bg tractoflow -r 2.4.2"
-        cmd += f" --input {tractoflow_input_dir}"
-        if ABS:
-            cmd += " --fs {fs}"
-        if processes is not None:
-            cmd += " --processes {processes}"
-
-        profile = ['cbrain']  # Copy all the output files, not use symlinks.
-        if use_cuda:
-            profile.append('use_cuda')
-
-        if fully_reproducible:
-            profile.append('fully_reproducible')
-
-        if ABS:
-            profile.append('ABS')
-
-        if len(profile):
-            cmd += f" -profile {','.join(profile)}"
-
-        if with_docker:
-            # cmd += ' -with-docker scilus/scilus:1.4.2'
-            cmd += ' -with-docker scilus/scilus:1.6.0'
-        else:
-            cmd += f' -with-singularity {sif_file}'
-        cmd += ' -resume'
-
-        if tmpdir is not None:
-            env = os.environ.copy()
-            env["SINGULARITY_TMPDIR"] = tmpdir
+    # A new subject is launched as soon as a slot is freed, and each finished
+    # subject is copied back on its own.
+    # A subject's lease is held until its results are copied back.
+    locks = {}
+    running = {}  # sub -> (process, sub_work, reservation, profiler)
+    failed = []
+    created = []  # Subject working folders made by this run
+    kept = []  # Working folders kept for an incomplete copy-back
+    nf_mon = NextflowMonitor()
+    copier = CopyBack(num_streams=copy_streams, checksum=verify_checksum)
+    index = StateIndex(wd0)
+
+    def copy_back_done(sub, ok, sub_work=None):
+        if ok:
+            print(f"Copied back the results of {sub}")
+            index.set('tractoflow', sub, 'done', outputs=[
+                wd0 / 'results' / sub / 'PFT_Tracking' /
+                f"{sub}__pft_tracking_prob_wm_seed_0.trk"],
+                checksum=verify_checksum)
+            if tmp_workplace and sub_work.is_dir():
+                shutil.rmtree(sub_work)
         else:
-            env = None
-
-        try:
-            subprocess.check_call(shlex.split(cmd), cwd=workplace, env=env)
-        except Exception:
-            print(f"Failed to run {cmd}")
-            sys.exit()
-
-        # Wait for complete
-        tf_results_folder = workplace / 'results'
-
+            print(f"Copy-back of {sub} is incomplete. {sub_work} is kept.")
+            index.set('tractoflow', sub, 'failed')
+            kept.append(sub_work)
+        sys.stdout.flush()
+        locks.pop(sub).release()
+
+    rescan = True
+    rescan_interval = 300  # Pick up subjects whose inputs become ready
+    last_scan = 0
+    blocked = False
+    try:
         while True:
-            # Check if all the result filese are made
-            done_subj = []
-            for sub_dir in sub_dirs:
-                sub = sub_dir.name
-                results_dir = tf_results_folder.parent / 'results' / sub
-                last_f = results_dir / 'PFT_Tracking' / \
-                    f"{sub}__pft_tracking_prob_wm_seed_0.trk"
-                if last_f.is_file() and not overwrite:
-                    done_subj.append(sub_dir)
-
-            last_dirs = np.setdiff1d(sub_dirs, done_subj)
-            if len(last_dirs) == 0:
+            # -- Fill free slots ----
+            if time.time() - last_scan > rescan_interval:
+                rescan = True
+
+            if rescan and len(running) < num_proc:
+                pending = find_pending_subjects(
+                    input_orig, overwrite=overwrite,
+                    exclude=list(running.keys()) + failed, ABS=ABS,
+                    index=index, rescan=rescan_index, subjects=subjects)
+                rescan_index = False
+                blocked = False
+                for sub_dir in pending[:num_proc - len(running)]:
+                    sub = sub_dir.name
+                    lock = Lease(wd0 / f'IsRun_TrF_{sub}')
+                    if not lock.acquire():
+                        continue
+
+                    # Wait for other jobs on the node if it does not fit
+                    input_size = profiler.dwi_input_size(
+                        sub_dir / 'dwi.nii.gz')
+                    rid = admission.try_admit(
+                        'tractoflow', subject=sub, input_size=input_size,
+                        cpu=processes)
+                    if rid is None and len(running) == 0:
+                        # Nothing of this run is running: the node is held
+                        # by other scripts. Wait for them to free it.
+                        rid = admission.admit(
+                            'tractoflow', subject=sub, input_size=input_size,
+                            cpu=processes)
+                    if rid is None:
+                        lock.release()
+                        blocked = True
+                        break
+                    locks[sub] = lock
+
+                    sub_work = workplace / sub
+                    if tmp_workplace and sub_work.is_dir():
+                        shutil.rmtree(sub_work)
+                    created.append(sub_work)
+                    try:
+                        proc = launch_tractoflow(
+                            sub_dir, sub_work, ABS=ABS, fs=fs,
+                            processes=processes, use_cuda=use_cuda,
+                            fully_reproducible=fully_reproducible,
+                            with_docker=with_docker, sif_file=sif_file,
+                            tmpdir=tmpdir)
+                    except Exception as e:
+                        print(f"Failed to run TractoFlow for {sub}: {e}")
+                        admission.release(rid)
+                        locks.pop(sub).release()
+                        index.set('tractoflow', sub, 'failed')
+                        failed.append(sub)
+                        continue
+                    admission.set_pid(rid, proc.pid)
+                    prof = profiler.ProcMonitor(
+                        proc.pid, 'tractoflow', subject=sub,
+                        input_size=input_size, interval=30)
+                    prof.start()
+                    nf_mon.watch(
+                        sub, proc, sub_work / 'trace.txt', [sub],
+                        partial(is_tractoflow_done, sub_work / 'results'))
+                    running[sub] = (proc, sub_work, rid, prof)
+                    index.set('tractoflow', sub, 'running')
+
+                rescan = blocked
+                last_scan = time.time()
+
+            if len(running) == 0:
                 break
 
-            # Check if the process is running
-            cmd = "pgrep -f 'run -bg tractoflow'"
-            try:
-                out = subprocess.check_output(shlex.split(cmd))
-            except Exception:
-                break
-
-            time.sleep(10)
-
-        # --- Copy back -------------------------------------------------------
-        shutil.rmtree(tractoflow_input_dir)
-        cmd = "rsync -rtuvz --copy-links --exclude='.nextflow*'"
-        cmd += f" -exclude='tractoflow_input' {workplace}/ {wd0}/"
-        subprocess.run(shlex.split(cmd))
-
-        if IsRun.is_file():
-            IsRun.unlink()
+            # -- Wait for a run to finish ----
+            # Retry soon if a subject is waiting for the node resources.
+            event = nf_mon.get(timeout=10 if blocked else rescan_interval)
+            if event is None or event[0] != 'exit':
+                continue
 
-    if tmp_workplace and workplace.is_dir():
-        shutil.rmtree(workplace)
+            sub = event[1]
+            proc, sub_work, rid, prof = running.pop(sub)
+            prof.stop(returncode=proc.returncode)
+            admission.release(rid)
+            rescan = True
+            if is_tractoflow_done(sub_work / 'results', sub):
+                # Copy back in the background
+                print(f"TractoFlow for {sub} finished at {time.ctime()}")
+                copier.submit(sub, sub_work / 'results', wd0 / 'results',
+                              on_done=partial(copy_back_done,
+                                              sub_work=sub_work))
+            else:
+                print(f"TractoFlow for {sub} failed"
+                      f" (exit code {proc.returncode})."
+                      f" See {sub_work}/.nextflow.log")
+                failed.append(sub)
+                index.set('tractoflow', sub, 'failed')
+                if tmp_workplace and sub_work.is_dir():
+                    shutil.rmtree(sub_work)
+                locks.pop(sub).release()
+            sys.stdout.flush()
+
+    finally:
+        for sub, (proc, sub_work, rid, prof) in running.items():
+            if proc.poll() is None:
+                proc.terminate()
+            prof.stop(save=False)
+            admission.release(rid)
+
+        copier.shutdown()
+
+        for lock in list(locks.values()):
+            lock.release()
+
+    # Remove only the folders made by this run. Other instances on this host
+    # may be using the same working place.
+    if tmp_workplace:
+        for sub_work in created:
+            if sub_work.is_dir() and sub_work not in kept:
+                shutil.rmtree(sub_work)
+        try:
+            workplace.rmdir()
+        except OSError:
+            pass
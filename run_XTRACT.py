@@ -8,18 +8,94 @@ https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/XTRACT
 # %% import ===================================================================
 import argparse
 from pathlib import Path
-import shlex
-import subprocess
+import os
+import shutil
 import numpy as np
-from socket import gethostname
-import time
 
-from tqdm import tqdm
-from mproc import run_multi_shell
+from mproc import run_multi_shell, run_multi
+from joblock import Lease, is_locked
+from state_index import StateIndex
+from tract_stats import tract_stats, OUT_NAME
 
 if '__file__' not in locals():
     __file__ = 'run_XTRACT.py'
 
+PARTS_DIR = '.xtract_parts'
+
+
+# %% read_structures ==========================================================
+def read_structures(str_f=None):
+    """
+    Read an XTRACT structures file (default: the HUMAN protocols of FSL).
+    Returns a list of (tract, line).
+    """
+    if str_f is None:
+        str_f = Path(os.environ.get('FSLDIR', '/usr/local/fsl')) / 'etc' / \
+            'xtract_data' / 'HUMAN' / 'structureList'
+    assert Path(str_f).is_file(), f"No structures file {str_f}"
+
+    structures = []
+    with open(str_f, 'r') as fd:
+        for line in fd:
+            if len(line.split()) == 0 or line.startswith('#'):
+                continue
+            structures.append((line.split()[0], line.rstrip('\n')))
+
+    return structures
+
+
+# %% split_structures =========================================================
+def split_structures(structures, n_groups):
+    """
+    Split the structures into n_groups with similar total numbers of seeds
+    (the second column of the structures file scales the seeds).
+    """
+    def weight(line):
+        try:
+            return float(line.split()[1])
+        except (IndexError, ValueError):
+            return 1.0
+
+    groups = [[] for _ in range(min(n_groups, len(structures)))]
+    loads = np.zeros(len(groups))
+    for tract, line in sorted(structures, key=lambda st: -weight(st[1])):
+        gi = int(np.argmin(loads))
+        groups[gi].append((tract, line))
+        loads[gi] += weight(line)
+
+    return groups
+
+
+# %% parts_done ===============================================================
+def parts_done(parts):
+    """
+    Check if all tracts of the groups [(part_dir, tracts), ...] are done.
+    """
+    return all([(part_dir / 'tracts' / tract / 'densityNorm.nii.gz').is_file()
+                for part_dir, tracts in parts for tract in tracts])
+
+
+# %% merge_tree ===============================================================
+def merge_tree(src_dir, dst_dir):
+    """
+    Move the files of src_dir into dst_dir. Files that exist in both (e.g.,
+    the logs and the command list of xtract) are concatenated.
+    """
+    if not dst_dir.is_dir():
+        dst_dir.mkdir(parents=True)
+
+    for src in sorted(src_dir.iterdir()):
+        dst = dst_dir / src.name
+        if src.is_dir():
+            merge_tree(src, dst)
+        elif dst.is_file():
+            with open(dst, 'ab') as fd_dst, open(src, 'rb') as fd_src:
+                shutil.copyfileobj(fd_src, fd_dst)
+            src.unlink()
+        else:
+            os.replace(src, dst)
+    src_dir.rmdir()
+
 
 # %% __main__ =================================================================
 if __name__ == '__main__':
@@ -30,80 +106,215 @@ if __name__ == '__main__':
 
     parser.add_argument('FDT_folder', help='FDT results folder')
     parser.add_argument('--gpu', action='store_true', help='Use GPU')
+    parser.add_argument('--num_proc', type=int,
+                        help='Number of parallel xtract jobs (default: 1'
+                        ' with --gpu, half of the CPUs without)')
+    parser.add_argument('--split_tracts', type=int, default=1,
+                        help='Split the tract protocols of a subject into'
+                        ' this number of parallel jobs')
+    parser.add_argument('--str',
+                        help='XTRACT structures file (default: all HUMAN'
+                        ' protocols)')
+    parser.add_argument('--py_stats', action='store_true',
+                        help='Compute the tract stats with the in-process'
+                        ' engine (tract_stats.py) instead of xtract_stats.'
+                        f' They are written to {OUT_NAME}, not to stats.csv')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
     FDT_folder = Path(args.FDT_folder).resolve()
     assert FDT_folder.is_dir(), f"No directory at {FDT_folder}"
     gpu = args.gpu
+    num_proc = args.num_proc
+    split_tracts = args.split_tracts
+    str_f = args.str
+    py_stats = args.py_stats
+    rescan = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     '''DEBUG
     FDT_folder = Path.home() / \
         'MRI/TractoFlow_workspace/DTI_AdolescentData/FDT'
     gpu = True
+    num_proc = None
+    split_tracts = 1
+    str_f = None
+    py_stats = False
+    rescan = False
+    subjects = None
     overwrite = False
     '''
 
+    # Subjects recorded as done in the state index are not checked on disk.
+    index = StateIndex(FDT_folder.parent)
+
     # --- XTRACT ----------------------------------------------------------
     # Get input data
     SUB_DIRS = [sub_dir for sub_dir in FDT_folder.glob('*.bedpostX')
                 if sub_dir.is_dir()]
+    if subjects is not None:
+        SUB_DIRS = [sub_dir for sub_dir in SUB_DIRS
+                    if sub_dir.name.replace('.bedpostX', '') in subjects]
 
     # Check if the job is done
+    if overwrite:
+        done = set()
+    else:
+        done = index.done_subjects(
+            'xtract',
+            [sub_dir.name.replace('.bedpostX', '') for sub_dir in SUB_DIRS],
+            lambda sub: (FDT_folder / f"{sub}.xtract" / 'tracts' / 'vof_r' /
+                         'densityNorm.nii.gz').is_file(),
+            rescan=rescan)
+
     done_subj = []
     for sub_dir in SUB_DIRS:
         sub = sub_dir.name.replace('.bedpostX', '')
-        res_dir = FDT_folder / f"{sub}.xtract"
-        last_f = res_dir / 'tracts' / 'vof_r' / 'densityNorm.nii.gz'
-        last_f = res_dir / 'stats.csv'
         IsRun = FDT_folder / f'IsRunning_XTRACT_{sub}'
-        if last_f.is_file() and not overwrite:
+        if sub in done:
             done_subj.append(sub_dir)
-        elif IsRun.is_file():
+        elif is_locked(IsRun) or \
+                any([is_locked(FDT_folder / f'IsRunning_XTRACT_{sub}_{gi}')
+                     for gi in range(split_tracts)]):
             done_subj.append(sub_dir)
     SUB_DIRS = np.setdiff1d(SUB_DIRS, done_subj)
 
-    # run xtract
-    for sub_dir in tqdm(SUB_DIRS, desc='XTRACT'):
-        sub = sub_dir.name.replace('.bedpostX', '')
-        IsRun = FDT_folder / f'IsRunning_XTRACT_{sub}'
-        if IsRun.is_file():
-            continue
+    # Tract protocols of the parallel jobs of a subject
+    if split_tracts > 1:
+        groups = split_structures(read_structures(str_f), split_tracts)
 
+    # xtract jobs: one per subject, or one per protocol group of a subject.
+    # Without GPU, each xtract run is a single-threaded probtrackx2 sweep,
+    # so the jobs are run in parallel on the CPU cores.
+    Cmds = []
+    JobNames = []
+    Locks = []
+    JobSubs = []
+    Parts = {}
+    for sub_dir in SUB_DIRS:
+        sub = sub_dir.name.replace('.bedpostX', '')
         res_dir = FDT_folder / f"{sub}.xtract"
         last_f = res_dir / 'tracts' / 'vof_r' / 'densityNorm.nii.gz'
         if last_f.is_file() and not overwrite:
             continue
 
-        with open(IsRun, 'w', encoding='utf-8') as fd:
-            print(gethostname(), file=fd)
-            print(time.ctime(), file=fd)
+        opt = ' -gpu' if gpu else ''
+        if split_tracts <= 1:
+            cmd = f"xtract -bpx {sub_dir} -out {res_dir} -species HUMAN"
+            if str_f is not None:
+                cmd += f" -str {str_f}"
+            Cmds.append(cmd + opt)
+            JobNames.append(f"xtract_{sub}")
+            Locks.append(FDT_folder / f'IsRunning_XTRACT_{sub}')
+            JobSubs.append(sub)
+            Parts[sub] = []
+            continue
+
+        # Each group is tracked into its own folder and merged later. Groups
+        # done in an earlier run with the same protocols are kept.
+        parts_dir = FDT_folder / PARTS_DIR / sub
+        if not parts_dir.is_dir():
+            parts_dir.mkdir(parents=True)
+        Parts[sub] = []
+        for gi, group in enumerate(groups):
+            part_str_f = parts_dir / f"structures_{gi}.txt"
+            part_dir = parts_dir / f"part_{gi}"
+            tracts = [tract for tract, _ in group]
+            Parts[sub].append((part_dir, tracts))
+            str_text = '\n'.join([line for _, line in group]) + '\n'
+            if not overwrite and part_str_f.is_file() and \
+                    part_str_f.read_text() == str_text and \
+                    all([(part_dir / 'tracts' / tract /
+                          'densityNorm.nii.gz').is_file()
+                         for tract in tracts]):
+                continue
+
+            part_str_f.write_text(str_text)
+            if part_dir.is_dir():
+                shutil.rmtree(part_dir)
+            cmd = f"xtract -bpx {sub_dir} -out {part_dir} -species HUMAN"
+            cmd += f" -str {part_str_f}"
+            Cmds.append(cmd + opt)
+            JobNames.append(f"xtract_{sub}_{gi}")
+            Locks.append(FDT_folder / f'IsRunning_XTRACT_{sub}_{gi}')
+            JobSubs.append(sub)
+
+    failed_subs = set()
+    if len(Cmds):
+        if num_proc is None:
+            num_proc = 1 if gpu else 0
+        for sub in sorted(set(JobSubs)):
+            index.set('xtract', sub, 'running')
+        results = run_multi_shell(Cmds, JobNames, Nr_proc=num_proc,
+                                  stage='xtract', locks=Locks,
+                                  threads=None if gpu else 1, details=True)
+        # Jobs skipped for a lock held by another process are not failures
+        failed_subs = set([sub for sub, res in zip(JobSubs, results)
+                           if res['returncode'] != 0 and
+                           res['start'] is not None])
 
-        # XTRACT
-        cmd = f"xtract -bpx {sub_dir} -out {res_dir} -species HUMAN"
-        if gpu:
-            cmd += ' -gpu'
-        subprocess.check_call(shlex.split(cmd))
+    for sub, parts in Parts.items():
+        res_dir = FDT_folder / f"{sub}.xtract"
+        last_f = res_dir / 'tracts' / 'vof_r' / 'densityNorm.nii.gz'
+        if len(parts):
+            # Merge the groups when all of them are done. The group
+            # with vof_r, which marks the subject as done, goes last.
+            # Another host finishing the other groups of the subject may
+            # merge them at the same time, so the merge is done under a
+            # lease and the parts are checked again after acquiring it.
+            if parts_done(parts):
+                with Lease(FDT_folder / f"IsRun_XTRACT_merge_{sub}") as lock:
+                    if lock.acquired and parts_done(parts):
+                        for part_dir, tracts in sorted(
+                                parts, key=lambda pt: 'vof_r' in pt[1]):
+                            merge_tree(part_dir, res_dir)
+                        shutil.rmtree(FDT_folder / PARTS_DIR / sub)
+                        try:
+                            (FDT_folder / PARTS_DIR).rmdir()
+                        except OSError:
+                            # Parts of other subjects remain
+                            pass
 
-        if IsRun.is_file():
-            IsRun.unlink()
+        if last_f.is_file():
+            index.set('xtract', sub, 'done', outputs=[last_f])
+        elif sub in failed_subs:
+            index.set('xtract', sub, 'failed')
+            print(f"xtract failed for {sub}")
 
     # --- run xtract_stats ----------------------------------------------------
     # Get input data
     SUB_DIRS = [sub_dir for sub_dir in FDT_folder.glob('*.xtract')
                 if sub_dir.is_dir()]
+    if subjects is not None:
+        SUB_DIRS = [sub_dir for sub_dir in SUB_DIRS
+                    if sub_dir.name.replace('.xtract', '') in subjects]
+
+    # The stats of --py_stats are kept apart from those of xtract_stats
+    if py_stats:
+        stats_stage, stats_name = 'xtract_py_stats', OUT_NAME
+    else:
+        stats_stage, stats_name = 'xtract_stats', 'stats.csv'
 
     # Check if the job is done
-    done_subj = []
-    for sub_dir in SUB_DIRS:
-        last_f = sub_dir / 'stats.csv'
-        if last_f.is_file() and not overwrite:
-            done_subj.append(sub_dir)
-    SUB_DIRS = np.setdiff1d(SUB_DIRS, done_subj)
+    if not overwrite:
+        done = index.done_subjects(
+            stats_stage,
+            [sub_dir.name.replace('.xtract', '') for sub_dir in SUB_DIRS],
+            lambda sub: (FDT_folder / f"{sub}.xtract" /
+                         stats_name).is_file(),
+            rescan=rescan)
+        SUB_DIRS = [sub_dir for sub_dir in SUB_DIRS
+                    if sub_dir.name.replace('.xtract', '') not in done]
 
     Cmds = []
     JobNames = []
+    Jobs = []
+    Subjs = []
     for sub_dir in SUB_DIRS:
         last_f = sub_dir / 'tracts' / 'vof_r' / 'densityNorm.nii.gz'
         if not last_f.is_file():
@@ -117,10 +328,25 @@ if __name__ == '__main__':
         if not r.is_file():
             continue
 
+        meas = 'vol,prob,length,FA,MD,AD,GA,RD'
         cmd = f"xtract_stats -d {dti_dir} -xtract {sub_dir} -w {w} -r {r}"
-        cmd += ' -meas vol,prob,length,FA,MD,AD,GA,RD'
+        cmd += f" -meas {meas}"
         Cmds.append(cmd)
         JobNames.append(f"xtract_stats_{sub}")
+        Jobs.append({'dti_prefix': str(dti_dir), 'xtract_dir': sub_dir,
+                     'warp_f': w, 'ref_f': r, 'meas': meas.split(',')})
+        Subjs.append(sub)
 
-    if len(Cmds):
-        run_multi_shell(Cmds, JobNames)
+    if len(Subjs):
+        if py_stats:
+            # The DTI maps are read once per subject and all tracts share
+            # one warp computation
+            run_multi(Jobs, tract_stats, no_return=True)
+        else:
+            run_multi_shell(Cmds, JobNames, stage='xtract_stats')
+        for sub in Subjs:
+            stats_f = FDT_folder / f"{sub}.xtract" / stats_name
+            if stats_f.is_file():
+                index.set(stats_stage, sub, 'done', outputs=[stats_f])
+            else:
+                index.set(stats_stage, sub, 'failed')
@@ -12,14 +12,16 @@ import os
 import shlex
 import subprocess
 import shutil
-from socket import gethostname
 import sys
 
-import numpy as np
 from tqdm import tqdm
-import time
 import ants
-from ants_run import ants_registration
+import xfm_cache
+from filesync import sync_tree
+import admission
+import profiler
+from joblock import Lease
+from state_index import StateIndex
 
 if '__file__' not in locals():
     __file__ = 'run_bedpostx.py'
@@ -95,7 +97,7 @@ def arrange_input_data(subj_root, work_dir, overwrite=False):
 
 
 # %% standardize_to_MNI =======================================================
-def standardize_to_MNI(bpx_sub_dir, overwrite=False):
+def standardize_to_MNI(bpx_sub_dir, cache_dir=None, overwrite=False):
 
     print('-' * 80)
     print('--- standardize to MNI ---')
@@ -113,9 +115,12 @@ def standardize_to_MNI(bpx_sub_dir, overwrite=False):
     if not standard2diff_ANTs_mat.is_file() or \
             not standard2diff_ANTs_wrp.is_file() or overwrite:
         # Run ANTs registration: template_f -> t1
-
-        ants_registration(t1_f, MNI_f, f"{xfms_dir}/standard2diff_",
-                          verbose=False)
+        # The same registration made by run_warp2template.py is reused.
+        if cache_dir is None:
+            cache_dir = bpx_sub_dir.parent.parent / 'xfm_cache'
+        xfm_cache.cached_registration(
+            t1_f, MNI_f, f"{xfms_dir}/standard2diff_", cache_dir,
+            verbose=False, overwrite=overwrite)
 
         tx = ants.read_transform(standard2diff_ANTs_mat)
         ants.write_transform(tx, standard2diff_ANTs_mat)
@@ -175,6 +180,10 @@ if __name__ == '__main__':
     parser.add_argument('results_folder', help='TractoFlow results folder')
     parser.add_argument('--gpu', action='store_true', help='Use GPU')
     parser.add_argument('--workplace', help='Local working place')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
@@ -184,6 +193,8 @@ if __name__ == '__main__':
     workplace = args.workplace
     if workplace is not None:
         workplace = Path(workplace).resolve()
+    rescan = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     '''DEBUG
@@ -191,6 +202,8 @@ if __name__ == '__main__':
         'MRI/TractoFlow_workspace/DTI_AdolescentData/results'
     gpu = True
     workplace = None
+    rescan = False
+    subjects = None
     overwrite = False
     '''
 
@@ -210,21 +223,28 @@ if __name__ == '__main__':
     sub_dirs = [sub_dir for sub_dir in results_folder.glob('*')
                 if sub_dir.is_dir() and
                 sub_dir.name not in ('Readme', 'Compute_Kernel')]
+    if subjects is not None:
+        sub_dirs = [sub_dir for sub_dir in sub_dirs
+                    if sub_dir.name in subjects]
 
     work_dir = results_folder.parent / 'FDT'
     if not work_dir.is_dir():
         work_dir.mkdir()
 
-    # Check if the job is done
-    done_subj = []
-    for sub_dir in sub_dirs:
-        sub = sub_dir.name
-        results_dir = work_dir / f"{sub}.bedpostX"
-        last_f = results_dir / 'mean_fsumsamples.nii.gz'
-        if last_f.is_file() and not overwrite:
-            done_subj.append(sub_dir)
+    # Registration cache shared with run_warp2template.py
+    cache_dir = results_folder.parent / 'xfm_cache'
 
-    sub_dirs = np.setdiff1d(sub_dirs, done_subj)
+    # Check if the job is done
+    # Subjects recorded as done in the state index are not checked on disk.
+    index = StateIndex(results_folder.parent)
+    if not overwrite:
+        done = index.done_subjects(
+            'bedpostx', [sub_dir.name for sub_dir in sub_dirs],
+            lambda sub: (work_dir / f"{sub}.bedpostX" /
+                         'mean_fsumsamples.nii.gz').is_file(),
+            rescan=rescan)
+        sub_dirs = [sub_dir for sub_dir in sub_dirs
+                    if sub_dir.name not in done]
 
     # --- Run process ------------------------------------------------------
     for subj_root in tqdm(sub_dirs, desc='Running the bedpostx process'):
@@ -236,14 +256,16 @@ if __name__ == '__main__':
         if last_f.is_file() and not overwrite:
             continue
 
-        IsRun = work_dir.parent / f"IsRun_bedpostx_{sub}"
-        if IsRun.is_file():
+        lock = Lease(work_dir.parent / f"IsRun_bedpostx_{sub}")
+        if not lock.acquire():
             continue
+        index.set('bedpostx', sub, 'running')
 
-        with open(IsRun, 'w') as fd:
-            fd.write(gethostname())
-            fd.write(time.ctime())
-
+        dwi_f = subj_root / 'Compute_FreeWater' / \
+            f"{sub}__dwi_fw_corrected.nii.gz"
+        input_size = profiler.dwi_input_size(dwi_f)
+        rid = admission.admit('bedpostx', subject=sub, pid=os.getpid(),
+                              input_size=input_size)
         try:
             # -- Arrage input data diretory for bedpostx --
             ret = arrange_input_data(subj_root, loc_work_dir,
@@ -256,33 +278,41 @@ if __name__ == '__main__':
                 cmd = f"bedpostx_gpu {sub}"
             else:
                 cmd = f"bedpostx {sub}"
-            subprocess.check_call(shlex.split(cmd), cwd=loc_work_dir)
+            profiler.check_call(shlex.split(cmd), 'bedpostx', subject=sub,
+                                input_size=input_size, cwd=loc_work_dir)
 
             # -- Standardization to MNI for XTRACT --
             bpx_sub_dir = loc_work_dir / f"{sub}.bedpostX"
-            standardize_to_MNI(bpx_sub_dir, overwrite=overwrite)
+            standardize_to_MNI(bpx_sub_dir, cache_dir=cache_dir,
+                               overwrite=overwrite)
 
             # -- Copy back result files --
-            cmd = f"rsync -rtuvz --copy-links --include='{sub}*'"
-            cmd += f" --include='{sub}*/**' --exclude='*'"
-            cmd += f" {loc_work_dir}/ {work_dir}/"
-            subprocess.run(shlex.split(cmd))
+            for src_dir in loc_work_dir.glob(f"{sub}*"):
+                if src_dir.is_dir():
+                    sync_tree(src_dir, work_dir / src_dir.name)
+            index.set('bedpostx', sub, 'done', outputs=[last_f])
 
         except Exception as e:
             print(e)
+            index.set('bedpostx', sub, 'failed')
 
         finally:
+            admission.release(rid)
+
             if (loc_work_dir / sub).is_dir():
                 shutil.rmtree(loc_work_dir / sub)
 
-            if IsRun.is_file():
-                IsRun.unlink()
+            lock.release()
 
     # run standardize_to_MNI if it has not been done.
     for bpx_sub_dir in work_dir.glob('*.bedpostX'):
+        if subjects is not None and \
+                bpx_sub_dir.name.replace('.bedpostX', '') not in subjects:
+            continue
         wrp_f = bpx_sub_dir / 'xfms' / 'standard2diff.nii.gz'
         if not wrp_f.is_file():
-            standardize_to_MNI(bpx_sub_dir, overwrite=overwrite)
+            standardize_to_MNI(bpx_sub_dir, cache_dir=cache_dir,
+                               overwrite=overwrite)
 
     if tmp_workplace and loc_work_dir.is_dir():
         shutil.rmtree(loc_work_dir)
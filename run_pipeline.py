@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run all processing stages as a per-subject pipeline.
+
+The stages (FreeSurfer -> TractoFlow -> freewater_flow -> warp2template,
+bedpostX -> XTRACT, PROBTRACKX -> collect_all_results) form a dependency
+graph for each subject. A subject is sent to its next stage as soon as its
+own dependencies are done, so, e.g., bedpostX of one subject runs while
+TractoFlow is still running on another subject. Each stage is run by its
+script for one subject (--subjects), so node resources, locks, and the state
+index are handled by the scripts as when they are run by hand.
+"""
+
+
+# %% import ===================================================================
+import argparse
+from pathlib import Path
+import multiprocessing
+import shutil
+import subprocess
+import sys
+import time
+
+from run_TractoFlow import is_tractoflow_done
+from run_FreewaterFlow import is_fwflow_done
+from run_warp2template import metric_files
+from run_PROBTRACKX import load_roi_names
+
+if '__file__' not in locals():
+    __file__ = 'run_pipeline.py'
+
+script_dir = Path(__file__).resolve().parent
+
+# Stage dependencies in the order of the pipeline
+STAGE_DEPS = {'freesurfer': [],
+              'tractoflow': ['freesurfer'],
+              'freewaterflow': ['tractoflow'],
+              'warp2template': ['freewaterflow'],
+              'bedpostx': ['freewaterflow'],
+              'xtract': ['bedpostx'],
+              'probtrackx': ['bedpostx'],
+              'collect': ['warp2template', 'xtract', 'probtrackx']}
+
+GPU_STAGES = ('bedpostx', 'xtract', 'probtrackx')
+
+
+# %% is_stage_done ============================================================
+def is_stage_done(stage, sub, input_orig, ROI_names=None):
+    """
+    Check the result files of a stage for a subject.
+    """
+    wd0 = input_orig.parent
+    results = wd0 / 'results'
+    FDT = wd0 / 'FDT'
+    if stage == 'freesurfer':
+        return (input_orig / sub / 'aparc+aseg.nii.gz').is_file() and \
+            (input_orig / sub / 'wmparc.nii.gz').is_file()
+    elif stage == 'tractoflow':
+        return is_tractoflow_done(results, sub)
+    elif stage == 'freewaterflow':
+        return is_fwflow_done(results, sub)
+    elif stage == 'warp2template':
+        return all([(results / sub / f"Standardize_{metric_dir}" /
+                     f"{sub}__{metric}_standard.nii.gz").is_file()
+                    for metric_dir, metrics in metric_files.items()
+                    for metric in metrics])
+    elif stage == 'bedpostx':
+        return (FDT / f"{sub}.bedpostX" / 'xfms' /
+                'standard2diff.nii.gz').is_file()
+    elif stage == 'xtract':
+        return (FDT / f"{sub}.xtract" / 'stats.csv').is_file()
+    elif stage == 'probtrackx':
+        return all([(FDT / f"{sub}.probtackx" /
+                     f"{roi}_fdt_paths_prob_standard.nii.gz").is_file()
+                    for roi in ROI_names.values])
+    elif stage == 'collect':
+        return (wd0 / 'all_results' / sub /
+                f"{sub}_FDT_xtract_stats.csv").is_file()
+
+
+# %% stage_command ============================================================
+def stage_command(stage, sub, input_orig, run_dir, opts):
+    """
+    Command line running a stage for one subject.
+    """
+    wd0 = input_orig.parent
+    if stage == 'freesurfer':
+        cmd = ['run_FreeSurfer.py', input_orig]
+    elif stage == 'tractoflow':
+        cmd = ['run_TractoFlow.py', input_orig, '--num_proc', '1',
+               '--workplace', run_dir]
+        if opts.ABS:
+            cmd.append('--ABS')
+        if opts.use_cuda:
+            cmd.append('--use_cuda')
+        if opts.fully_reproducible:
+            cmd.append('--fully_reproducible')
+        if opts.with_docker:
+            cmd.append('--with_docker')
+    elif stage == 'freewaterflow':
+        cmd = ['run_FreewaterFlow.py', wd0 / 'results', '--num_proc', '1',
+               '--workplace', run_dir]
+    elif stage == 'warp2template':
+        cmd = ['run_warp2template.py', wd0 / 'results']
+    elif stage == 'bedpostx':
+        cmd = ['run_bedpostX.py', wd0 / 'results', '--workplace', run_dir]
+    elif stage == 'xtract':
+        cmd = ['run_XTRACT.py', wd0 / 'FDT']
+    elif stage == 'probtrackx':
+        cmd = ['run_PROBTRACKX.py', wd0 / 'FDT',
+               '--seed_template', opts.seed_template]
+    elif stage == 'collect':
+        cmd = ['collect_all_results.py', wd0]
+
+    if opts.gpu and stage in GPU_STAGES:
+        cmd.append('--gpu')
+
+    cmd[0] = script_dir / cmd[0]
+    return [sys.executable] + [str(cc) for cc in cmd] + ['--subjects', sub]
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    # Read arguments
+    parser = argparse.ArgumentParser(
+        prog='run_pipeline.py',
+        description='Run all TractoFlowProc stages as a per-subject pipeline')
+
+    parser.add_argument('input', help='input folder')
+    parser.add_argument('--ABS', action='store_true',
+                        help='Run FreeSurfer and TractoFlow-ABS')
+    parser.add_argument('--use_cuda', action='store_true',
+                        help='Use eddy_cuda in TractoFlow')
+    parser.add_argument('--fully_reproducible', action='store_true',
+                        help='Run TractoFlow with --fully_reproducible')
+    parser.add_argument('--with_docker', action='store_true',
+                        help='Run TractoFlow with docker')
+    parser.add_argument('--gpu', action='store_true',
+                        help='Use GPU for bedpostX, XTRACT, and PROBTRACKX')
+    parser.add_argument('--seed_template',
+                        help='Seed mask for PROBTRACKX. PROBTRACKX is run'
+                        ' only if this is given.')
+    parser.add_argument('--workplace', help='Local working place')
+    parser.add_argument('--max_jobs', type=int,
+                        default=max(multiprocessing.cpu_count() // 2, 1),
+                        help='Maximum number of stage jobs run at once')
+    parser.add_argument('--gpu_jobs', type=int, default=1,
+                        help='Maximum number of GPU jobs run at once')
+    parser.add_argument('--max_attempts', type=int, default=2,
+                        help='Number of runs of a stage before giving up a'
+                        ' subject')
+    parser.add_argument('--retry_delay', type=float, default=600,
+                        help='Seconds to wait before running an incomplete'
+                        ' stage again (e.g., when it is run on another host)')
+    parser.add_argument('--poll', type=float, default=10,
+                        help='Interval (seconds) to check the jobs')
+
+    opts = parser.parse_args()
+    input_orig = Path(opts.input).resolve()
+    assert input_orig.is_dir(), f"No directory at {input_orig}"
+    if opts.seed_template is not None:
+        opts.seed_template = Path(opts.seed_template).resolve()
+    if opts.workplace is None:
+        workplace = Path.home() / 'pipeline_work'
+    else:
+        workplace = Path(opts.workplace).resolve()
+    if not workplace.is_dir():
+        workplace.mkdir(parents=True)
+
+    wd0 = input_orig.parent
+    log_dir = wd0 / 'pipeline_logs'
+    if not log_dir.is_dir():
+        log_dir.mkdir()
+
+    # --- Stage graph ---------------------------------------------------------
+    stages = list(STAGE_DEPS.keys())
+    if not opts.ABS:
+        stages.remove('freesurfer')
+    ROI_names = None
+    if opts.seed_template is None:
+        stages.remove('probtrackx')
+    else:
+        ROI_names = load_roi_names(opts.seed_template)
+    deps = {stage: [dep for dep in STAGE_DEPS[stage] if dep in stages]
+            for stage in stages}
+
+    # --- Initial state -------------------------------------------------------
+    subjects = [sub_dir.name for sub_dir in sorted(input_orig.glob('*'))
+                if (sub_dir / 'dwi.nii.gz').is_file()]
+    state = {}  # (sub, stage) -> 'waiting', 'running', 'done', or 'failed'
+    for sub in subjects:
+        for stage in stages:
+            if is_stage_done(stage, sub, input_orig, ROI_names):
+                state[(sub, stage)] = 'done'
+            else:
+                state[(sub, stage)] = 'waiting'
+    attempts = {key: 0 for key in state}
+    retry_at = {key: 0 for key in state}
+
+    print(f"Pipeline of {len(subjects)} subjects: {' -> '.join(stages)}")
+    print(f"Started at {time.ctime()}")
+    sys.stdout.flush()
+
+    # --- Run -----------------------------------------------------------------
+    running = {}  # (sub, stage) -> (process, log file, run_dir)
+    try:
+        while True:
+            # Launch ready stages. Later stages go first so that subjects
+            # are finished early.
+            for stage in stages[::-1]:
+                for sub in subjects:
+                    if len(running) >= opts.max_jobs:
+                        break
+
+                    key = (sub, stage)
+                    if state[key] != 'waiting' or \
+                            time.time() < retry_at[key]:
+                        continue
+                    if not all([state[(sub, dep)] == 'done'
+                                for dep in deps[stage]]):
+                        continue
+                    if opts.gpu and stage in GPU_STAGES and \
+                            len([1 for ss, st in running
+                                 if st in GPU_STAGES]) >= opts.gpu_jobs:
+                        continue
+
+                    run_dir = workplace / f"{stage}_{sub}"
+                    cmd = stage_command(stage, sub, input_orig, run_dir,
+                                        opts)
+                    log_f = log_dir / f"{sub}_{stage}.log"
+                    log_fd = open(log_f, 'a')
+                    print(f"{time.ctime()}: {' '.join(cmd)}", file=log_fd)
+                    log_fd.flush()
+                    proc = subprocess.Popen(cmd, stdout=log_fd,
+                                            stderr=subprocess.STDOUT,
+                                            cwd=log_dir)
+                    running[key] = (proc, log_fd, run_dir)
+                    state[key] = 'running'
+                    attempts[key] += 1
+                    print(f"Start {stage} for {sub}")
+                    sys.stdout.flush()
+
+            if len(running) == 0:
+                retry_wait = [retry_at[key] - time.time()
+                              for key, st in state.items()
+                              if st == 'waiting' and
+                              retry_at[key] > time.time()]
+                if len(retry_wait) == 0:
+                    break
+                time.sleep(min(retry_wait))
+                continue
+
+            # Wait for jobs to finish
+            time.sleep(opts.poll)
+            for key in list(running.keys()):
+                proc, log_fd, run_dir = running[key]
+                if proc.poll() is None:
+                    continue
+
+                log_fd.close()
+                del running[key]
+                sub, stage = key
+                if is_stage_done(stage, sub, input_orig, ROI_names):
+                    state[key] = 'done'
+                    print(f"{stage} for {sub} is done")
+                    if run_dir.is_dir():
+                        shutil.rmtree(run_dir, ignore_errors=True)
+                elif attempts[key] < opts.max_attempts:
+                    state[key] = 'waiting'
+                    retry_at[key] = time.time() + opts.retry_delay
+                    print(f"{stage} for {sub} is not completed"
+                          f" (exit code {proc.returncode})."
+                          f" Retry after {opts.retry_delay:.0f} s.")
+                else:
+                    state[key] = 'failed'
+                    print(f"{stage} for {sub} failed. See"
+                          f" {log_dir}/{sub}_{stage}.log")
+                sys.stdout.flush()
+
+    finally:
+        for key, (proc, log_fd, run_dir) in running.items():
+            if proc.poll() is None:
+                proc.terminate()
+            log_fd.close()
+
+    # --- Summary -------------------------------------------------------------
+    print(f"Finished at {time.ctime()}")
+    for stage in stages:
+        counts = {st: 0 for st in ('done', 'failed', 'waiting')}
+        for sub in subjects:
+            counts[state[(sub, stage)]] += 1
+        print(f"{stage}: {counts['done']} done, {counts['failed']} failed,"
+              f" {counts['waiting']} not run")
@@ -4,13 +4,18 @@
 # %% import ===================================================================
 import argparse
 from pathlib import Path
+import multiprocessing
+import os
 import shlex
 import subprocess
-from socket import gethostname
-import time
 
 from tqdm import tqdm
-from ants_run import ants_registration, ants_warp_resample
+from ants_run import ants_warp_resample_batch
+import xfm_cache
+import admission
+from joblock import Lease
+from mproc import core_sets, thread_env
+from state_index import StateIndex
 
 if '__file__' not in locals():
     __file__ = 'run_Warp2MNI.py'
@@ -26,56 +31,127 @@ metric_files = {'DTI_Metrics': ('ad', 'fa', 'ga', 'md', 'rd'),
                 }
 
 
-# %% apply_warp ===============================================================
-def apply_warp(regt1_fs, template=MNI_f, metric_files=metric_files,
-               overwrite=False):
-
-    for t1_f in tqdm(regt1_fs, desc='Apply warping'):
-        work_root = t1_f.parent.parent
-
-        # Check if warping paramter files exist
-        Standardize_T1_dir = work_root / 'Standardize_T1'
-        aff_f = Standardize_T1_dir / 'template2orig_0GenericAffine.mat'
-        invwrp_f = Standardize_T1_dir / 'template2orig_1InverseWarp.nii.gz'
-        if not aff_f.is_file() or not invwrp_f.is_file():
+# %% warp_subject_metrics =====================================================
+def warp_subject_metrics(subj_root, template=MNI_f, metric_files=metric_files,
+                         overwrite=False):
+    """
+    Warp all metric files of a subject into the template space at once.
+    The template and the transform chain are loaded once for the subject.
+    """
+    # Check if warping paramter files exist
+    Standardize_T1_dir = subj_root / 'Standardize_T1'
+    aff_f = Standardize_T1_dir / 'template2orig_0GenericAffine.mat'
+    invwrp_f = Standardize_T1_dir / 'template2orig_1InverseWarp.nii.gz'
+    if not aff_f.is_file() or not invwrp_f.is_file():
+        return None
+
+    # Collect the metric files to be warped
+    src_fs = []
+    warped_fs = []
+    for metric_dir, metrics in metric_files.items():
+        src_dir = subj_root / metric_dir
+        if not src_dir.is_dir():
             continue
 
-        # Apply warp
-        for metric_dir, metric in metric_files.items():
-            src_dir = work_root / metric_dir
-            if not src_dir.is_dir():
+        dst_dir = subj_root / f"Standardize_{metric_dir}"
+        for metric in metrics:
+            src_f = src_dir / f"{subj_root.name}__{metric}.nii.gz"
+            if not src_f.is_file():
+                print(f"Not found {src_f}.")
+                continue
+
+            warped_f = dst_dir / \
+                src_f.name.replace('.nii.gz', '_standard.nii.gz')
+            if warped_f.is_file() and not overwrite:
                 continue
 
-            dst_dir = work_root / f"Standardize_{metric_dir}"
             if not dst_dir.is_dir():
                 dst_dir.mkdir()
 
-            for metric in metric:
-                src_f = src_dir / f"{work_root.name}__{metric}.nii.gz"
-                if not src_f.is_file():
-                    print(f"Not found {src_f}.")
-                    continue
-
-                warped_f = dst_dir / \
-                    src_f.name.replace('.nii.gz', '_standard.nii.gz')
-                if warped_f.is_file() and not overwrite:
-                    continue
-
-                # Apply warp with resample in fix_f space
-                warp_params = [str(aff_f), str(invwrp_f)]
-                whichtoinvert = [True, False]
-                out_f = warped_f
-                ants_warp_resample(
-                    template, src_f, warped_f, warp_params,
-                    interpolator='linear', imagetype=0,
-                    whichtoinvert=whichtoinvert, verbose=False)
-
-                try:
-                    cmd = f"3drefit -view tlrc -space MNI {out_f}"
-                    subprocess.check_call(shlex.split(cmd),
-                                          stderr=subprocess.PIPE)
-                except Exception:
-                    pass
+            src_fs.append(src_f)
+            warped_fs.append(warped_f)
+
+    if len(src_fs) == 0:
+        return []
+
+    # Apply warp with resample in template space
+    warp_params = [str(aff_f), str(invwrp_f)]
+    whichtoinvert = [True, False]
+    ants_warp_resample_batch(
+        template, src_fs, warped_fs, warp_params, interpolator='linear',
+        imagetype=0, whichtoinvert=whichtoinvert, verbose=False)
+
+    for out_f in warped_fs:
+        try:
+            cmd = f"3drefit -view tlrc -space MNI {out_f}"
+            subprocess.check_call(shlex.split(cmd), stderr=subprocess.PIPE)
+        except Exception:
+            pass
+
+    return warped_fs
+
+
+# %% register_subject =========================================================
+def register_subject(t1_f, template, cache_dir, work_root, overwrite=False,
+                     num_threads=None):
+    """
+    Register the template to the T1 image of a subject.
+    num_threads: number of ITK threads used by ANTs.
+    Returns the subject name and the status ('done', 'skip', 'running' or
+    'failed').
+    """
+    if num_threads is not None:
+        os.environ.update(thread_env(num_threads))
+
+    work_dir = t1_f.parent.parent / 'Standardize_T1'
+    subj = work_dir.parent.name
+    if not work_dir.is_dir():
+        work_dir.mkdir()
+
+    aff_f = work_dir / 'template2orig_0GenericAffine.mat'
+    invwrp_f = work_dir / 'template2orig_1InverseWarp.nii.gz'
+    if aff_f.is_file() and invwrp_f.is_file() and not overwrite:
+        # Make the existing result reusable by run_bedpostX.py
+        xfm_cache.store(cache_dir, t1_f, template,
+                        f"{work_dir}/template2orig_")
+        return subj, 'skip'
+
+    lock = Lease(work_root / f"IsRun_ANTs_{subj}")
+    if not lock.acquire():
+        return subj, 'running'
+
+    try:
+        # Run ANTs registration: template_f -> t1
+        # The same registration made by run_bedpostX.py is reused.
+        with admission.reserve('ants_registration', subject=subj,
+                               cpu=num_threads):
+            xfm_cache.cached_registration(
+                t1_f, template, f"{work_dir}/template2orig_", cache_dir,
+                verbose=False, overwrite=overwrite)
+        status = 'done'
+
+    except Exception as e:
+        print(f"ANTs registration for {subj} failed: {e}")
+        status = 'failed'
+
+    finally:
+        lock.release()
+
+    return subj, status
+
+
+def _register_subject_kwargs(kwargs):
+    return register_subject(**kwargs)
+
+
+# %% apply_warp ===============================================================
+def apply_warp(regt1_fs, template=MNI_f, metric_files=metric_files,
+               overwrite=False):
+
+    for t1_f in tqdm(regt1_fs, desc='Apply warping'):
+        work_root = t1_f.parent.parent
+        warp_subject_metrics(work_root, template=template,
+                             metric_files=metric_files, overwrite=overwrite)
 
 
 # %% __main__ =================================================================
@@ -88,12 +164,22 @@ if __name__ == '__main__':
     parser.add_argument('results_folder', help='TractoFlow results folder')
     parser.add_argument('--template', default=MNI_f,
                         help='Template brain file')
+    parser.add_argument('--num_proc', default=1, type=int,
+                        help='Number of subjects registered in parallel.'
+                        ' ANTs threads are divided among them.')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Process only these subjects')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Rebuild the state index from the result files')
     parser.add_argument('--overwrite', action='store_true', help='Overwrite')
 
     args = parser.parse_args()
     results_folder = Path(args.results_folder).resolve()
     assert results_folder.is_dir(), f"No directory at {results_folder}"
     template = args.template
+    num_proc = max(args.num_proc, 1)
+    rescan = args.rescan
+    subjects = args.subjects
     overwrite = args.overwrite
 
     work_root = results_folder.parent
@@ -102,14 +188,26 @@ if __name__ == '__main__':
     results_folder = Path.home() / \
         'MRI/TractoFlow_workspace/DTI_AdolescentData/results'
     template = MNI_f
+    num_proc = 1
+    rescan = False
+    subjects = None
     overwrite = False
     work_root = results_folder.parent
     '''
 
+    # Subjects recorded as done in the state index are skipped.
+    index = StateIndex(work_root)
+    if rescan:
+        index.reset('ants_registration')
+        index.reset('apply_warp')
+
     # --- Get input data dirs -------------------------------------------------
     sub_dirs = [sub_dir for sub_dir in results_folder.glob('*')
                 if sub_dir.is_dir() and
                 sub_dir.name not in ('Readme', 'Compute_Kernel')]
+    if subjects is not None:
+        sub_dirs = [sub_dir for sub_dir in sub_dirs
+                    if sub_dir.name in subjects]
 
     # Collect T1 registered to DWI
     regt1_fs = []
@@ -121,35 +219,48 @@ if __name__ == '__main__':
             regt1_fs.append(regT1_f)
 
     # --- Calculate warping parameters ----------------------------------------
-    for t1_f in tqdm(regt1_fs, desc='ANTs registration'):
-        work_dir = t1_f.parent.parent / 'Standardize_T1'
-        if not work_dir.is_dir():
-            work_dir.mkdir()
-
-        aff_f = work_dir / 'template2orig_0GenericAffine.mat'
-        invwrp_f = work_dir / 'template2orig_1InverseWarp.nii.gz'
-        if aff_f.is_file() and invwrp_f.is_file() and not overwrite:
-            continue
-
-        subj = work_dir.parent.name
-        IsRun = work_root / f"IsRun_ANTs_{subj}"
-        if IsRun.is_file():
-            continue
-
-        with open(IsRun, 'w') as fd:
-            fd.write(gethostname())
-            fd.write(time.ctime())
-
-        # Run ANTs registration: template_f -> t1
-        _ = ants_registration(t1_f, template, f"{work_dir}/template2orig_",
-                              verbose=False)
-
-        if IsRun.is_file():
-            IsRun.unlink()
+    # Registration cache shared with run_bedpostX.py
+    cache_dir = work_root / 'xfm_cache'
+    # ANTs threads x workers <= physical cores
+    num_proc = min(num_proc, max(len(regt1_fs), 1))
+    num_proc, num_threads, _ = core_sets(num_proc)
+    os.environ.update(thread_env(num_threads))
+
+    reg_done = {} if overwrite else index.status('ants_registration')
+    job_kwargs = [{'t1_f': t1_f, 'template': template,
+                   'cache_dir': cache_dir, 'work_root': work_root,
+                   'overwrite': overwrite, 'num_threads': num_threads}
+                  for t1_f in regt1_fs
+                  if reg_done.get(t1_f.parent.parent.name) != 'done']
+    status = {'done': 0, 'skip': 0, 'running': 0, 'failed': 0}
+    if num_proc == 1:
+        results = map(_register_subject_kwargs, job_kwargs)
+        pool = None
+    else:
+        print(f"Run {num_proc} registrations in parallel"
+              f" with {num_threads} threads each")
+        pool = multiprocessing.Pool(processes=num_proc)
+        results = pool.imap_unordered(_register_subject_kwargs, job_kwargs)
+
+    pbar = tqdm(results, total=len(job_kwargs), desc='ANTs registration')
+    for subj, stat in pbar:
+        status[stat] += 1
+        pbar.set_postfix(status)
+        if stat in ('done', 'skip'):
+            index.set('ants_registration', subj, 'done')
+        elif stat == 'failed':
+            index.set('ants_registration', subj, 'failed')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # --- Apply warp to DTI and FODF metrics files to standardize -------------
+    warp_done = {} if overwrite else index.status('apply_warp')
     for t1_f in tqdm(regt1_fs, desc='Apply warping'):
         subj_root = t1_f.parent.parent
+        if warp_done.get(subj_root.name) == 'done':
+            continue
 
         # Check if warping paramter files exist
         Standardize_T1_dir = subj_root / 'Standardize_T1'
@@ -158,51 +269,22 @@ if __name__ == '__main__':
         if not aff_f.is_file() or not invwrp_f.is_file():
             continue
 
-        IsRun = work_root / f"IsRun_ApplyWarp_{subj_root.name}"
-        if IsRun.is_file():
-            continue
-
-        # Apply warp
-        for metric_dir, metric in metric_files.items():
-            src_dir = subj_root / metric_dir
-            if not src_dir.is_dir():
+        with Lease(work_root / f"IsRun_ApplyWarp_{subj_root.name}") as lock:
+            if not lock.acquired:
                 continue
 
-            dst_dir = subj_root / f"Standardize_{metric_dir}"
-            if not dst_dir.is_dir():
-                dst_dir.mkdir()
-
-            for metric in metric:
-                src_f = src_dir / f"{subj_root.name}__{metric}.nii.gz"
-                if not src_f.is_file():
-                    print(f"Not found {src_f}.")
-                    continue
-
-                warped_f = dst_dir / \
-                    src_f.name.replace('.nii.gz', '_standard.nii.gz')
-                if warped_f.is_file() and not overwrite:
-                    continue
-
-                if not IsRun.is_file():
-                    with open(IsRun, 'w') as fd:
-                        fd.write(gethostname())
-                        fd.write(time.ctime())
-
-                # Apply warp with resample in fix_f space
-                warp_params = [str(aff_f), str(invwrp_f)]
-                whichtoinvert = [True, False]
-                out_f = warped_f
-                ants_warp_resample(
-                    template, src_f, warped_f, warp_params,
-                    interpolator='linear', imagetype=0,
-                    whichtoinvert=whichtoinvert, verbose=False)
-
-                try:
-                    cmd = f"3drefit -view tlrc -space MNI {out_f}"
-                    subprocess.check_call(shlex.split(cmd),
-                                          stderr=subprocess.PIPE)
-                except Exception:
-                    pass
-
-        if IsRun.is_file():
-            IsRun.unlink()
+            # Apply warp
+            try:
+                warp_subject_metrics(subj_root, template=template,
+                                     metric_files=metric_files,
+                                     overwrite=overwrite)
+                # Done when all metrics (including those made later by
+                # run_FreewaterFlow.py) are warped
+                if all([(subj_root / metric_dir /
+                         f"{subj_root.name}__{metric}.nii.gz").is_file()
+                        for metric_dir, metrics in metric_files.items()
+                        for metric in metrics]):
+                    index.set('apply_warp', subj_root.name, 'done')
+            except Exception as e:
+                print(f"Failed to warp metrics for {subj_root.name}: {e}")
+                index.set('apply_warp', subj_root.name, 'failed')
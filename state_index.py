@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent index of the processing state of each subject and stage.
+
+The index is an SQLite file on the local disk of the host
+(~/.tractoflowproc/state_index/{workspace name}_{path hash}.sqlite; SQLite
+locking is not reliable on the NFS share of the workspace). It records the
+status (pending, running, done, failed) of each (stage, subject) with
+timestamps and the size, mtime, and optionally checksum of the output
+files. The scripts ask the index which subjects are done instead of probing
+the result files of every subject on each pass, and only subjects that are
+not recorded as done are checked on disk. The index is only a cache: the
+running jobs are claimed with joblock, a subject done on another host is
+found on disk and recorded, and if the index cannot be used the scripts
+fall back to checking the files.
+
+    ./state_index.py ~/TractoFlow_workspace
+shows the summary of the index.
+"""
+
+
+# %% import ===================================================================
+from contextlib import closing
+from pathlib import Path
+from socket import gethostname
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from filesync import file_checksum
+import telemetry
+
+INDEX_DIR = telemetry.STATE_DIR / 'state_index'
+STATUSES = ('pending', 'running', 'done', 'failed')
+
+
+# %% index_file ===============================================================
+def index_file(workspace):
+    """
+    Local index file of a workspace.
+    """
+    workspace = Path(workspace).resolve()
+    key = hashlib.sha1(str(workspace).encode()).hexdigest()[:12]
+    return INDEX_DIR / f"{workspace.name}_{key}.sqlite"
+
+
+# %% StateIndex ===============================================================
+class StateIndex:
+    """
+    Index of the processing state in a workspace.
+    """
+
+    def __init__(self, workspace, db_f=None):
+        if db_f is None:
+            db_f = index_file(workspace)
+        self.db_f = Path(db_f)
+        self.usable = True
+        try:
+            if not self.db_f.parent.is_dir():
+                self.db_f.parent.mkdir(parents=True, exist_ok=True)
+            self._execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " stage TEXT, subject TEXT, status TEXT, host TEXT,"
+                " started REAL, updated REAL, outputs TEXT,"
+                " PRIMARY KEY (stage, subject))")
+        except (sqlite3.Error, OSError) as e:
+            print(f"State index {self.db_f} is not available: {e}")
+            self.usable = False
+
+    def _execute(self, sql, params=(), many=False):
+        con = sqlite3.connect(self.db_f, timeout=120)
+        with closing(con):
+            with con:
+                if many:
+                    cur = con.executemany(sql, params)
+                else:
+                    cur = con.execute(sql, params)
+                return cur.fetchall()
+
+    def status(self, stage):
+        """
+        Return {subject: status} of a stage.
+        """
+        if not self.usable:
+            return {}
+        try:
+            rows = self._execute(
+                "SELECT subject, status FROM state WHERE stage = ?", (stage,))
+        except sqlite3.Error as e:
+            print(f"Failed to read the state index: {e}")
+            return {}
+        return dict(rows)
+
+    def get(self, stage, subject):
+        """
+        Return the record of a subject as a dict, or None.
+        """
+        if not self.usable:
+            return None
+        rows = self._execute(
+            "SELECT status, host, started, updated, outputs FROM state"
+            " WHERE stage = ? AND subject = ?", (stage, subject))
+        if len(rows) == 0:
+            return None
+        status, host, started, updated, outputs = rows[0]
+        return {'status': status, 'host': host, 'started': started,
+                'updated': updated,
+                'outputs': json.loads(outputs) if outputs else {}}
+
+    def set(self, stage, subject, status, outputs=(), checksum=False):
+        """
+        Record a state transition.
+        outputs: output files recorded with their size and mtime (and sha256
+        if checksum is True).
+        """
+        assert status in STATUSES, f"Unknown status {status}"
+        telemetry.emit('state', stage, subject, status=status)
+        if not self.usable:
+            return
+
+        out_info = {}
+        for out_f in outputs:
+            if not Path(out_f).is_file():
+                continue
+            st = os.stat(out_f)
+            out_info[str(out_f)] = {'size': st.st_size, 'mtime': st.st_mtime}
+            if checksum:
+                out_info[str(out_f)]['sha256'] = file_checksum(out_f)
+
+        now = time.time()
+        try:
+            self._execute(
+                "INSERT INTO state VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (stage, subject) DO UPDATE SET"
+                " status = excluded.status, host = excluded.host,"
+                " started = CASE WHEN excluded.status = 'running'"
+                "   THEN excluded.started ELSE state.started END,"
+                " updated = excluded.updated,"
+                " outputs = CASE WHEN excluded.outputs != ''"
+                "   THEN excluded.outputs ELSE state.outputs END",
+                (stage, subject, status, gethostname(),
+                 now if status == 'running' else None, now,
+                 json.dumps(out_info) if out_info else ''))
+        except sqlite3.Error as e:
+            print(f"Failed to update the state index: {e}")
+
+    def reset(self, stage):
+        """
+        Forget the records of a stage.
+        """
+        if not self.usable:
+            return
+        try:
+            self._execute("DELETE FROM state WHERE stage = ?", (stage,))
+        except sqlite3.Error as e:
+            print(f"Failed to reset the state index: {e}")
+
+    def done_subjects(self, stage, subjects, is_done, rescan=False):
+        """
+        Return the set of subjects that are done in stage.
+        Only subjects that are not recorded as done are checked on disk with
+        is_done(subject), and the results are recorded. With rescan=True the
+        records of the stage are rebuilt from disk.
+        """
+        subjects = list(subjects)
+        if not self.usable:
+            done = set([sub for sub in subjects if is_done(sub)])
+            telemetry.emit('plan', stage, total=len(subjects), done=len(done))
+            return done
+
+        if rescan:
+            self.reset(stage)
+
+        recorded = self.status(stage)
+        done = set([sub for sub in subjects if recorded.get(sub) == 'done'])
+
+        now = time.time()
+        rows = []
+        for sub in subjects:
+            if sub in done:
+                continue
+            if is_done(sub):
+                done.add(sub)
+                rows.append((stage, sub, 'done', gethostname(), None, now,
+                             ''))
+            elif sub not in recorded:
+                rows.append((stage, sub, 'pending', gethostname(), None, now,
+                             ''))
+
+        if len(rows):
+            try:
+                self._execute(
+                    "INSERT INTO state VALUES (?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (stage, subject) DO UPDATE SET"
+                    " status = excluded.status, updated = excluded.updated",
+                    rows, many=True)
+            except sqlite3.Error as e:
+                print(f"Failed to update the state index: {e}")
+
+        telemetry.emit('plan', stage, total=len(subjects), done=len(done))
+        return done
+
+    def summary(self):
+        """
+        Return {stage: {status: count}}.
+        """
+        rows = self._execute(
+            "SELECT stage, status, COUNT(*) FROM state"
+            " GROUP BY stage, status ORDER BY stage")
+        summ = {}
+        for stage, status, cnt in rows:
+            summ.setdefault(stage, {})[status] = cnt
+        return summ
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='state_index.py', description='Show the pipeline state index')
+    parser.add_argument('workspace', help='Workspace folder')
+    parser.add_argument('--stage', help='Show the subjects of a stage')
+    opts = parser.parse_args()
+
+    assert index_file(opts.workspace).is_file(), \
+        f"No state index of {opts.workspace} on this host"
+    index = StateIndex(opts.workspace)
+    if opts.stage is None:
+        for stage, counts in index.summary().items():
+            print(f"{stage}: " + ', '.join(
+                [f"{counts.get(st, 0)} {st}" for st in STATUSES]))
+    else:
+        for sub, status in sorted(index.status(opts.stage).items()):
+            print(f"{sub}\t{status}")
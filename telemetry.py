@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Structured progress events of the TractoFlowProc stages.
+
+Every stage appends JSON-lines events to a local file
+(~/.tractoflowproc/events.jsonl):
+    plan: number of subjects of a stage and how many are already done
+        (emitted by StateIndex.done_subjects)
+    state: state transition of a subject (running, done, failed; emitted by
+        StateIndex.set)
+    start, end: external command run by the profiler, with the exit code,
+        peak RSS, CPU seconds, and wall time
+    job_failed: failed job of mproc.imap_multi, and whether it is rerun
+
+    ./telemetry.py
+summarizes the throughput, ETA, and failures of each stage.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import argparse
+import datetime
+import fcntl
+import json
+import os
+import time
+
+
+# %% Settings =================================================================
+STATE_DIR = Path(os.environ.get('TRACTOFLOWPROC_STATE',
+                                Path.home() / '.tractoflowproc'))
+EVENTS_F = STATE_DIR / 'events.jsonl'
+
+
+# %% emit =====================================================================
+def emit(event, stage, subject=None, **fields):
+    """
+    Append an event. Failures to write are ignored so that the telemetry
+    never stops a job.
+    """
+    rec = {'event': event, 'stage': stage, 'subject': subject,
+           'time': time.time(), 'host': gethostname(), 'pid': os.getpid()}
+    rec.update(fields)
+    try:
+        if not STATE_DIR.is_dir():
+            STATE_DIR.mkdir(parents=True)
+        with open(EVENTS_F, 'a') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            fd.write(json.dumps(rec, default=str) + '\n')
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    except Exception:
+        pass
+
+
+# %% load_events ==============================================================
+def load_events(events_f=EVENTS_F, since=None):
+    """
+    Read the events, optionally only those after the time since.
+    """
+    if not Path(events_f).is_file():
+        return []
+
+    events = []
+    with open(events_f, 'r') as fd:
+        for line in fd:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if since is not None and rec['time'] < since:
+                continue
+            events.append(rec)
+
+    return events
+
+
+# %% summarize ================================================================
+def summarize(events, window=24*3600, now=None):
+    """
+    Summarize the events of each stage.
+    Returns {stage: dict} with the number of subjects (total, done, running,
+    failed), the throughput (done subjects/hour in the last window seconds),
+    the ETA (seconds), the failed subjects, and the command statistics.
+    """
+    if now is None:
+        now = time.time()
+
+    summ = {}
+    for rec in sorted(events, key=lambda rec: rec['time']):
+        stage = rec['stage']
+        st = summ.setdefault(stage, {
+            'plan': None, 'states': {}, 'done_times': [], 'first': None,
+            'commands': 0, 'command_failures': 0, 'wall': 0.0,
+            'cpu_seconds': 0.0, 'peak_rss': 0})
+        if st['first'] is None:
+            st['first'] = rec['time']
+
+        if rec['event'] == 'plan':
+            st['plan'] = rec
+            st['states'] = {}
+        elif rec['event'] == 'state':
+            st['states'][rec['subject']] = rec['status']
+            if rec['status'] == 'done':
+                st['done_times'].append(rec['time'])
+        elif rec['event'] == 'end':
+            st['commands'] += 1
+            if rec.get('returncode') not in (0, None):
+                st['command_failures'] += 1
+            st['wall'] += rec.get('wall', 0)
+            st['cpu_seconds'] += rec.get('cpu_seconds', 0)
+            st['peak_rss'] = max(st['peak_rss'], rec.get('peak_rss', 0))
+
+    for stage, st in summ.items():
+        states = st.pop('states')
+        plan = st.pop('plan')
+        done_times = st.pop('done_times')
+        first = st.pop('first')
+
+        # Subjects done since the latest plan are added to its done count
+        n_done = len([1 for status in states.values() if status == 'done'])
+        st['total'] = None if plan is None else plan['total']
+        st['done'] = n_done + (0 if plan is None else plan['done'])
+        st['running'] = len([1 for status in states.values()
+                             if status == 'running'])
+        st['failed_subjects'] = sorted(
+            [sub for sub, status in states.items() if status == 'failed'])
+        st['failed'] = len(st['failed_subjects'])
+
+        recent = [tt for tt in done_times if tt > now - window]
+        span = min(window, now - first)
+        st['throughput'] = len(recent) / (span / 3600) if span > 0 else 0.0
+
+        st['eta'] = None
+        if st['total'] is not None and st['throughput'] > 0:
+            remaining = max(st['total'] - st['done'] - st['failed'], 0)
+            st['eta'] = remaining / st['throughput'] * 3600
+
+    return summ
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='telemetry.py',
+        description='Show the progress of the TractoFlowProc stages')
+    parser.add_argument('--events', default=EVENTS_F,
+                        help='Event file (default: %(default)s)')
+    parser.add_argument('--since', type=float,
+                        help='Use only the events of the last SINCE hours')
+    parser.add_argument('--window', type=float, default=24,
+                        help='Hours to measure the throughput')
+    parser.add_argument('--failures', action='store_true',
+                        help='List the failed subjects')
+    opts = parser.parse_args()
+
+    since = None
+    if opts.since is not None:
+        since = time.time() - opts.since * 3600
+    summ = summarize(load_events(opts.events, since=since),
+                     window=opts.window * 3600)
+    if len(summ) == 0:
+        print(f"No events in {opts.events}")
+
+    for stage, st in summ.items():
+        total = '?' if st['total'] is None else st['total']
+        if st['eta'] is None:
+            eta = '-'
+        else:
+            eta = str(datetime.timedelta(seconds=int(st['eta'])))
+        print(f"{stage:20s} {st['done']}/{total} done,"
+              f" {st['running']} running, {st['failed']} failed,"
+              f" {st['throughput']:.2f} subjects/h, ETA {eta}")
+        if st['commands']:
+            print(f"{'':20s} {st['commands']} commands"
+                  f" ({st['command_failures']} failed),"
+                  f" wall {st['wall'] / 3600:.1f} h,"
+                  f" CPU {st['cpu_seconds'] / 3600:.1f} h,"
+                  f" peak RSS {st['peak_rss'] / 1e9:.1f} GB")
+        if opts.failures and st['failed']:
+            print(f"{'':20s} failed: {' '.join(st['failed_subjects'])}")
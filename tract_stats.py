@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process tract statistics of XTRACT results, equivalent to xtract_stats.
+
+The tract density maps (tracts/{tract}/densityNorm.nii.gz) are warped into
+diffusion space with fsl_warp, sharing one computation of the sampling
+coordinates (cached on the local disk, see fsl_warp), thresholded, and the
+statistics of all tracts are computed with grouped reductions over the
+tract voxels.
+The DTI maps are read once per subject instead of once per tract.
+
+    ./tract_stats.py -d FDT/sub/DTI_ -xtract FDT/sub.xtract \\
+        -w FDT/sub.bedpostX/xfms/standard2diff -r FDT/sub/DTI_FA.nii.gz \\
+        -meas vol,prob,length,FA,MD,AD,GA,RD
+writes FDT/sub.xtract/stats_py.csv with the options of xtract_stats. As in
+fslstats -M, -S, and -P 50, the statistics are of the non-zero voxels.
+The output is not named stats.csv, which marks the subject as done for
+run_pipeline.py, collect_all_results.py, and xtract_table.py, because its
+columns have not been checked against a real xtract_stats output yet.
+--check compares the output with a stats.csv made by xtract_stats for the
+same subject; run_XTRACT.py uses this engine only with --py_stats.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import argparse
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+import fsl_warp
+
+THR = 0.001
+MEASURES = ('vol', 'prob', 'length', 'FA', 'MD')
+# Mean path length of the streamlines (probtrackx2 --ompl)
+LENGTH_F = 'density_lenths.nii.gz'
+# Not stats.csv until the layout is confirmed to be that of xtract_stats
+OUT_NAME = 'stats_py.csv'
+
+
+# %% _nii =====================================================================
+def _nii(fname):
+    """
+    Image file name with or without the .nii.gz extension, as FSL accepts.
+    """
+    fname = Path(fname)
+    if fname.is_file() or fname.name.endswith(('.nii', '.nii.gz')):
+        return fname
+    for ext in ('.nii.gz', '.nii'):
+        if fname.with_name(fname.name + ext).is_file():
+            return fname.with_name(fname.name + ext)
+    return fname.with_name(fname.name + '.nii.gz')
+
+
+# %% list_tracts ==============================================================
+def list_tracts(xtract_dir):
+    """
+    Tracts in the XTRACT output folder (all of tracts/ by default, as
+    xtract_stats).
+    """
+    return sorted([tract_dir.name for tract_dir in
+                   (Path(xtract_dir) / 'tracts').glob('*')
+                   if (tract_dir / 'densityNorm.nii.gz').is_file()])
+
+
+# %% stats_columns ============================================================
+def stats_columns(meas=MEASURES):
+    """
+    Columns of stats.csv for the measures.
+    """
+    columns = []
+    for m in meas:
+        if m == 'vol':
+            columns.append('volume')
+        else:
+            columns += [f"mean_{m}", f"median_{m}", f"std_{m}"]
+    return columns
+
+
+# %% group_stats ==============================================================
+def group_stats(values, counts):
+    """
+    Mean, median, and standard deviation of the non-zero values of each
+    group, as fslstats -M, -P 50, and -S (the median is the sorted value at
+    floor(n / 2), as the percentiles of fslstats). values holds the groups
+    one after another and counts their sizes. Groups without non-zero values
+    get 0.
+    """
+    n_grp = len(counts)
+    labels = np.repeat(np.arange(n_grp), counts)
+    values = values.astype(np.float64)
+    nonzero = values != 0
+    labels = labels[nonzero]
+    values = values[nonzero]
+
+    counts = np.bincount(labels, minlength=n_grp)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    nonempty = counts > 0
+    safe = np.maximum(counts, 1)
+
+    mean = np.bincount(labels, weights=values, minlength=n_grp) / safe
+    dev2 = np.bincount(labels, weights=(values - mean[labels]) ** 2,
+                       minlength=n_grp)
+    std = np.sqrt(dev2 / np.maximum(counts - 1, 1))
+
+    # Medians from the values sorted within each group
+    sorted_v = values[np.lexsort((values, labels))]
+    median = np.zeros(n_grp)
+    median[nonempty] = sorted_v[starts[nonempty] + counts[nonempty] // 2]
+
+    mean[~nonempty] = 0
+    std[~nonempty] = 0
+    return mean, median, std
+
+
+# %% tract_stats ==============================================================
+def tract_stats(dti_prefix, xtract_dir, warp_f, ref_f, meas=MEASURES,
+                thr=THR, out_f=None, tracts=None, batch=8):
+    """
+    Compute the stats of the tracts and write them to out_f (default:
+    xtract_dir/OUT_NAME).
+    dti_prefix: path and basename of the DTI maps (e.g., sub/DTI_ for
+        sub/DTI_FA.nii.gz).
+    warp_f: warp from the XTRACT space to diffusion space, or 'native' if
+        the tracts are in diffusion space.
+    ref_f: reference image in diffusion space.
+    batch: number of tracts warped at a time.
+    Returns the stats DataFrame.
+    """
+    xtract_dir = Path(xtract_dir)
+    if out_f is None:
+        out_f = xtract_dir / OUT_NAME
+    out_f = Path(out_f)
+    if tracts is None:
+        tracts = list_tracts(xtract_dir)
+    native = str(warp_f) == 'native'
+    if not native:
+        warp_f = _nii(warp_f)
+
+    ref_img = nib.load(_nii(ref_f))
+    vox_vol = float(np.prod(ref_img.header.get_zooms()[:3]))
+    use_length = 'length' in meas
+
+    # --- Tract voxels in diffusion space ---
+    # Only the voxels above the threshold are kept for each tract.
+    tract_vox = []
+    tract_prob = []
+    tract_len = []
+    for bi in range(0, len(tracts), batch):
+        in_datas = []
+        in_img = None
+        for tract in tracts[bi:bi+batch]:
+            tract_dir = xtract_dir / 'tracts' / tract
+            img = nib.load(tract_dir / 'densityNorm.nii.gz')
+            in_img = img
+            in_datas.append(np.asarray(img.dataobj, dtype=np.float32))
+            if use_length:
+                if (tract_dir / LENGTH_F).is_file():
+                    in_datas.append(np.asarray(
+                        nib.load(tract_dir / LENGTH_F).dataobj,
+                        dtype=np.float32))
+                else:
+                    in_datas.append(np.zeros(img.shape[:3], np.float32))
+
+        if native:
+            out_datas = in_datas
+        else:
+            out_datas = fsl_warp.apply_warp(in_datas, in_img, warp_f,
+                                            ref_img=ref_img)
+
+        step = 2 if use_length else 1
+        for ii in range(0, len(out_datas), step):
+            dens = out_datas[ii].ravel()
+            vox = np.flatnonzero((dens >= thr) & (dens > 0))
+            tract_vox.append(vox)
+            tract_prob.append(dens[vox])
+            if use_length:
+                tract_len.append(out_datas[ii+1].ravel()[vox])
+        del in_datas, out_datas
+
+    counts = np.array([len(vox) for vox in tract_vox], dtype=int)
+    all_vox = np.concatenate(tract_vox) if len(tract_vox) else \
+        np.zeros(0, dtype=int)
+
+    # --- Stats ---
+    stats = {}
+    for m in meas:
+        if m == 'vol':
+            stats['volume'] = counts * vox_vol
+            continue
+
+        if m == 'prob':
+            values = np.concatenate(tract_prob) if len(tract_prob) else \
+                np.zeros(0)
+        elif m == 'length':
+            values = np.concatenate(tract_len) if len(tract_len) else \
+                np.zeros(0)
+        else:
+            # DTI map, read once for all tracts
+            map_f = _nii(f"{dti_prefix}{m}")
+            map_img = nib.load(map_f)
+            if map_img.shape[:3] != ref_img.shape[:3]:
+                raise ValueError(f"{map_f} does not match the grid of"
+                                 f" {ref_f}")
+            values = np.asarray(map_img.dataobj,
+                                dtype=np.float32).ravel()[all_vox]
+
+        (stats[f"mean_{m}"], stats[f"median_{m}"],
+         stats[f"std_{m}"]) = group_stats(values, counts)
+
+    tab = pd.DataFrame(stats, index=pd.Index(tracts, name='tract'))
+    tab = tab[stats_columns(meas)]
+
+    # Write atomically
+    tmp_f = out_f.parent / f".{out_f.name}.{gethostname()}_{os.getpid()}"
+    try:
+        tab.to_csv(tmp_f)
+        os.replace(tmp_f, out_f)
+    finally:
+        if tmp_f.exists():
+            tmp_f.unlink()
+
+    return tab
+
+
+# %% compare_stats ============================================================
+def compare_stats(ref_f, tab, rtol=1e-3):
+    """
+    Compare the stats with a stats.csv written by xtract_stats (ref_f).
+    Returns a list of the differences in the header, the tracts, and the
+    values (relative tolerance rtol). An empty list means identical.
+    """
+    ref = pd.read_csv(ref_f, index_col=0)
+    ref.index = ref.index.astype(str).str.strip()
+    ref.columns = ref.columns.astype(str).str.strip()
+
+    diffs = []
+    header = [str(tab.index.name)] + list(tab.columns)
+    ref_header = [str(ref.index.name).strip()] + list(ref.columns)
+    if header != ref_header:
+        diffs.append(f"header {header} != {ref_header}")
+    if list(tab.index) != list(ref.index):
+        diffs.append(f"tracts {list(tab.index)} != {list(ref.index)}")
+    if len(diffs):
+        return diffs
+
+    ref_v = ref.apply(pd.to_numeric, errors='coerce').to_numpy()
+    close = np.isclose(tab.to_numpy(), ref_v, rtol=rtol, atol=0)
+    for ti, ci in zip(*np.nonzero(~close)):
+        diffs.append(f"{tab.index[ti]} {tab.columns[ci]}:"
+                     f" {tab.iat[ti, ci]} != {ref_v[ti, ci]}")
+    return diffs
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    # Options follow xtract_stats
+    parser = argparse.ArgumentParser(
+        prog='tract_stats.py',
+        description='Compute the stats of XTRACT tracts (xtract_stats'
+        ' without the external calls)')
+    parser.add_argument('-d', required=True,
+                        help='Path and basename of the DTI maps'
+                        ' (e.g., /home/DTI/dti_)')
+    parser.add_argument('-xtract', required=True,
+                        help='XTRACT output folder')
+    parser.add_argument('-w', required=True,
+                        help="Warp from XTRACT to diffusion space, or"
+                        " 'native'")
+    parser.add_argument('-r', required=True,
+                        help='Reference image in diffusion space')
+    parser.add_argument('-out', help='Output file (default:'
+                        f' XTRACT_dir/{OUT_NAME})')
+    parser.add_argument('-str', help='Structures file (as in XTRACT;'
+                        ' default: all tracts)')
+    parser.add_argument('-thr', type=float, default=THR,
+                        help='Threshold of the tract densities')
+    parser.add_argument('-meas', default=','.join(MEASURES),
+                        help='Comma-separated measures (default:'
+                        ' %(default)s)')
+    parser.add_argument('--check',
+                        help='stats.csv of xtract_stats to compare the'
+                        ' output with')
+    opts = parser.parse_args()
+
+    tracts = None
+    if opts.str is not None:
+        with open(opts.str, 'r') as fd:
+            tracts = [line.split()[0] for line in fd
+                      if len(line.split()) and not line.startswith('#')]
+
+    tab = tract_stats(opts.d, opts.xtract, opts.w, opts.r,
+                      meas=opts.meas.split(','), thr=opts.thr,
+                      out_f=opts.out, tracts=tracts)
+    print(f"Stats of {len(tab)} tracts are saved")
+    sys.stdout.flush()
+
+    if opts.check is not None:
+        diffs = compare_stats(opts.check, tab)
+        for diff in diffs:
+            print(diff)
+        if len(diffs):
+            sys.exit(f"{len(diffs)} differences from {opts.check}")
+        print(f"Same as {opts.check}")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of ANTs registration results.
+
+A registration is identified by the hash of the image contents of the fixed
+and moving images and the registration parameters. run_warp2template.py and
+run_bedpostX.py register the same template to the same T1 image, so the
+second one reuses the transforms of the first one instead of running SyN
+again.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from socket import gethostname
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nib
+
+from ants_run import ants_registration, SYN_PARAMS
+from joblock import Lease
+
+XFM_FILES = ('0GenericAffine.mat', '1Warp.nii.gz', '1InverseWarp.nii.gz')
+
+
+# %% image_hash ===============================================================
+def image_hash(fname):
+    """
+    Hash of the voxel data and the affine of an image. Header edits that do
+    not change the geometry (e.g., 3drefit -space) do not change the hash.
+    """
+    img = nib.load(str(fname))
+    hs = hashlib.sha256()
+    hs.update(str(img.shape).encode())
+    hs.update(np.round(img.affine, 4).astype(np.float64).tobytes())
+    hs.update(np.ascontiguousarray(np.asanyarray(img.dataobj)).tobytes())
+    return hs.hexdigest()
+
+
+# %% registration_key =========================================================
+def registration_key(fix_f, move_f, params=SYN_PARAMS):
+    hs = hashlib.sha256()
+    hs.update(image_hash(fix_f).encode())
+    hs.update(image_hash(move_f).encode())
+    hs.update(json.dumps(params, sort_keys=True).encode())
+    return hs.hexdigest()
+
+
+# %% _put_files ===============================================================
+def _put_files(src_prefix, dst_prefix):
+    """
+    Put transform files at dst_prefix. Warp fields are hard-linked if
+    possible. The affine file is copied because callers may rewrite it.
+    """
+    for xfm in XFM_FILES:
+        src_f = Path(f"{src_prefix}{xfm}")
+        dst_f = Path(f"{dst_prefix}{xfm}")
+        if not src_f.is_file():
+            continue
+
+        tmp_f = dst_f.parent / f".{gethostname()}_{os.getpid()}_{dst_f.name}"
+        if tmp_f.exists():
+            tmp_f.unlink()
+        try:
+            if xfm.endswith('.mat'):
+                raise OSError
+            os.link(src_f, tmp_f)
+        except OSError:
+            shutil.copy2(src_f, tmp_f)
+        os.replace(tmp_f, dst_f)
+
+
+# %% store ====================================================================
+def store(cache_dir, fix_f, move_f, prefix, params=SYN_PARAMS, key=None):
+    """
+    Add existing transform files (prefix + XFM_FILES) to the cache.
+    """
+    cache_dir = Path(cache_dir)
+    if key is None:
+        key = registration_key(fix_f, move_f, params)
+    key_dir = cache_dir / key
+    if key_dir.is_dir():
+        return key_dir
+
+    if not all([Path(f"{prefix}{xfm}").is_file() for xfm in XFM_FILES]):
+        return None
+
+    if not cache_dir.is_dir():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir))
+    _put_files(prefix, f"{tmp_dir}/")
+    with open(tmp_dir / 'info.json', 'w') as fd:
+        json.dump({'fixed': str(fix_f), 'moving': str(move_f),
+                   'params': params, 'host': gethostname(),
+                   'time': time.ctime()}, fd)
+    try:
+        os.rename(tmp_dir, key_dir)
+    except OSError:
+        # Stored by another process
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return key_dir
+
+
+# %% invalidate ===============================================================
+def invalidate(cache_dir, key):
+    """
+    Remove a cache entry. The entry is renamed first so that no other
+    process takes a partly removed entry.
+    """
+    key_dir = Path(cache_dir) / key
+    old_dir = key_dir.parent / f".{key}.old.{gethostname()}_{os.getpid()}"
+    try:
+        os.rename(key_dir, old_dir)
+    except OSError:
+        return
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+# %% cached_registration ======================================================
+def cached_registration(fix_f, move_f, outprefix, cache_dir, verbose=True,
+                        overwrite=False):
+    """
+    ants_run.ants_registration with a content-addressed cache.
+    The transform files are placed at outprefix + XFM_FILES. Returns True if
+    the result was taken from the cache.
+    overwrite: run the registration even if it is cached, and replace the
+    cache entry with the new result.
+    """
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    key = registration_key(fix_f, move_f)
+    key_dir = cache_dir / key
+    lock = Lease(cache_dir / f"{key}.lock", info={'moving': str(move_f)})
+
+    while True:
+        # Hit
+        if key_dir.is_dir() and not overwrite:
+            _put_files(f"{key_dir}/", outprefix)
+            return True
+
+        # Miss: compute unless another process is computing it
+        if lock.acquire():
+            break
+        time.sleep(30)
+
+    try:
+        if key_dir.is_dir() and not overwrite:
+            # Stored while waiting for the lock
+            _put_files(f"{key_dir}/", outprefix)
+            return True
+        # The files at outprefix may be hard links to a cache entry
+        for xfm in XFM_FILES:
+            if Path(f"{outprefix}{xfm}").is_file():
+                Path(f"{outprefix}{xfm}").unlink()
+        ants_registration(fix_f, move_f, outprefix, verbose=verbose)
+        if key_dir.is_dir():
+            invalidate(cache_dir, key)
+        store(cache_dir, fix_f, move_f, outprefix, key=key)
+    finally:
+        lock.release()
+
+    return False
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cohort table of the XTRACT statistics.
+
+The stats.csv files of all subjects ({sub}.xtract/stats.csv) are read in
+parallel and concatenated into one long-format table with a row per
+subject x tract x measure:
+    subject, tract, measure, value, mtime, size
+(mtime and size are those of the source stats.csv). The table is stored as
+FDT/xtract_stats.parquet and updated incrementally: only the stats.csv
+files that are new or have changed since the last update are parsed.
+The QC of zero values and missing tracts is a query over the whole table.
+
+    ./xtract_table.py ~/TractoFlow_workspace/FDT
+updates the table and prints the QC. pyarrow (or fastparquet) is required
+only for the Parquet file. read_table() gives the same table without
+writing it, reading the CSV files if the Parquet file cannot be used.
+"""
+
+
+# %% import ===================================================================
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from socket import gethostname
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+from joblock import Lease
+
+TABLE_NAME = 'xtract_stats.parquet'
+COLUMNS = ['subject', 'tract', 'measure', 'value', 'mtime', 'size']
+
+
+# %% _parquet_engine ==========================================================
+def _parquet_engine():
+    for engine in ('pyarrow', 'fastparquet'):
+        try:
+            __import__(engine)
+            return engine
+        except ImportError:
+            pass
+    return None
+
+
+def _check_parquet():
+    engine = _parquet_engine()
+    if engine is None:
+        sys.exit("pyarrow is required for the XTRACT stats table."
+                 " Install it with 'pip install pyarrow'.")
+    return engine
+
+
+# %% list_stats_files =========================================================
+def list_stats_files(FDT_folder, subjects=None):
+    """
+    Return {subject: stats.csv} of the XTRACT results in FDT_folder.
+    """
+    files = {}
+    for sub_dir in sorted(Path(FDT_folder).glob('*.xtract')):
+        sub = sub_dir.name.replace('.xtract', '')
+        if subjects is not None and sub not in subjects:
+            continue
+        stats_f = sub_dir / 'stats.csv'
+        if stats_f.is_file():
+            files[sub] = stats_f
+
+    return files
+
+
+# %% read_stats ===============================================================
+def read_stats(sub, stats_f):
+    """
+    Read a stats.csv (a row per tract, a column per measure) into the
+    long-format rows of the table.
+    """
+    st = os.stat(stats_f)
+    tab = pd.read_csv(stats_f, index_col=0)
+    tab.index = tab.index.astype(str).str.strip()
+    tab.columns = tab.columns.astype(str).str.strip()
+    tab = tab.apply(pd.to_numeric, errors='coerce')
+
+    long_tab = tab.rename_axis(index='tract').reset_index().melt(
+        id_vars='tract', var_name='measure', value_name='value')
+    long_tab.insert(0, 'subject', sub)
+    long_tab['mtime'] = st.st_mtime
+    long_tab['size'] = st.st_size
+    return long_tab[COLUMNS]
+
+
+# %% load_table ===============================================================
+def _empty_table():
+    return pd.DataFrame({col: pd.Series(dtype=dt) for col, dt in zip(
+        COLUMNS, [str, str, str, float, float, int])})
+
+
+def load_table(table_f):
+    """
+    Load the table. An empty table is returned if table_f does not exist.
+    """
+    if not Path(table_f).is_file():
+        return _empty_table()
+
+    _check_parquet()
+    return pd.read_parquet(table_f)
+
+
+# %% _refresh_table ===========================================================
+def _refresh_table(table, stats_files, subjects=None, num_workers=8):
+    """
+    Replace the rows of the new or changed stats_files in table and drop
+    the subjects whose stats.csv has been removed.
+    Returns (table, number of parsed files, whether table was changed).
+    """
+    # Source stamp of each stored subject
+    stored = table.groupby('subject', sort=False)[['mtime', 'size']] \
+        .first()
+    changed = []
+    for sub, stats_f in stats_files.items():
+        st = os.stat(stats_f)
+        if sub not in stored.index or \
+                stored.at[sub, 'mtime'] != st.st_mtime or \
+                stored.at[sub, 'size'] != st.st_size:
+            changed.append(sub)
+
+    if subjects is None:
+        removed = set(stored.index) - set(stats_files)
+    else:
+        removed = set(subjects) & set(stored.index) - set(stats_files)
+
+    if len(changed) == 0 and len(removed) == 0:
+        return table, 0, False
+
+    # Parse the changed files in parallel
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = {sub: pool.submit(read_stats, sub, stats_files[sub])
+                   for sub in changed}
+
+    new_tabs = []
+    for sub, ft in futures.items():
+        if ft.exception() is not None:
+            print(f"Failed to read {stats_files[sub]}: {ft.exception()}")
+            continue
+        new_tabs.append(ft.result())
+
+    parsed = set([tab.subject.iat[0] for tab in new_tabs if len(tab)])
+    keep = ~table.subject.isin(parsed | removed)
+    table = pd.concat([table[keep]] + new_tabs, ignore_index=True)
+    table = table.sort_values(['subject', 'tract', 'measure'],
+                              kind='stable', ignore_index=True)
+
+    return table, len(new_tabs), True
+
+
+# %% update_table =============================================================
+def update_table(FDT_folder, table_f=None, subjects=None, num_workers=8):
+    """
+    Add new or changed stats.csv files in FDT_folder to the table. Subjects
+    whose stats.csv has been removed are dropped.
+    Returns (table, number of parsed files).
+    """
+    engine = _check_parquet()
+    FDT_folder = Path(FDT_folder)
+    if table_f is None:
+        table_f = FDT_folder / TABLE_NAME
+    table_f = Path(table_f)
+
+    stats_files = list_stats_files(FDT_folder, subjects=subjects)
+
+    # One writer at a time
+    with Lease(table_f.parent / f".{table_f.name}.lock") as lock:
+        if not lock.acquired:
+            print(f"{table_f} is being updated by another process.")
+            return load_table(table_f), 0
+
+        table, n_parsed, changed = _refresh_table(
+            load_table(table_f), stats_files, subjects=subjects,
+            num_workers=num_workers)
+        if not changed:
+            return table, 0
+
+        # Write atomically
+        tmp_f = table_f.parent / \
+            f".{table_f.name}.{gethostname()}_{os.getpid()}"
+        try:
+            table.to_parquet(tmp_f, engine=engine, index=False)
+            os.replace(tmp_f, table_f)
+        finally:
+            if tmp_f.exists():
+                tmp_f.unlink()
+
+    sys.stdout.flush()
+    return table, n_parsed
+
+
+# %% read_table ===============================================================
+def read_table(FDT_folder, table_f=None, subjects=None, num_workers=8):
+    """
+    Return the table of the current stats.csv files in FDT_folder without
+    writing anything. The rows of the stored table are reused for the
+    unchanged files if it can be read; otherwise (e.g., without pyarrow)
+    all stats.csv files are read.
+    """
+    FDT_folder = Path(FDT_folder)
+    if table_f is None:
+        table_f = FDT_folder / TABLE_NAME
+    table_f = Path(table_f)
+
+    table = None
+    if table_f.is_file() and _parquet_engine() is not None:
+        try:
+            table = load_table(table_f)
+        except Exception as e:
+            print(f"Failed to read {table_f}: {e}")
+    if table is None:
+        table = _empty_table()
+
+    stats_files = list_stats_files(FDT_folder, subjects=subjects)
+    if subjects is not None:
+        table = table[table.subject.isin(subjects)]
+    table, _, _ = _refresh_table(table, stats_files, subjects=subjects,
+                                 num_workers=num_workers)
+    return table
+
+
+# %% qc_table =================================================================
+def qc_table(table):
+    """
+    Find the tracts with zero or missing (NaN) values and the tracts missing
+    from a subject's stats (tracts present for any other subject).
+    Returns a DataFrame of subject, tract, issue ('zero', 'nan', or
+    'missing'), and the measures with the issue.
+    """
+    columns = ['subject', 'tract', 'issue', 'measures']
+    if len(table) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Zero and NaN values
+    issue = pd.Series(None, index=table.index, dtype=object)
+    issue[table.value == 0] = 'zero'
+    issue[table.value.isna()] = 'nan'
+    bad = table.assign(issue=issue)[issue.notna()]
+    bad = bad.groupby(['subject', 'tract', 'issue'], sort=True).measure \
+        .agg(','.join).rename('measures').reset_index()
+
+    # Missing tracts: the subject x tract grid minus the stored pairs
+    grid = pd.MultiIndex.from_product(
+        [table.subject.unique(), table.tract.unique()],
+        names=['subject', 'tract'])
+    present = pd.MultiIndex.from_frame(
+        table[['subject', 'tract']].drop_duplicates())
+    missing = grid.difference(present).to_frame(index=False)
+    missing['issue'] = 'missing'
+    missing['measures'] = ''
+
+    return pd.concat([bad, missing], ignore_index=True)[columns] \
+        .sort_values(['subject', 'tract'], ignore_index=True)
+
+
+# %% __main__ =================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='xtract_table.py',
+        description='Aggregate the XTRACT stats of all subjects into one'
+        ' table and check the tracts')
+    parser.add_argument('FDT_folder', help='FDT results folder')
+    parser.add_argument('--table', help='Table file (default:'
+                        f' FDT_folder/{TABLE_NAME})')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Update only these subjects')
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help='Number of files read in parallel')
+    parser.add_argument('--qc_out', help='Save the QC issues to a CSV file')
+    opts = parser.parse_args()
+
+    table, n_parsed = update_table(opts.FDT_folder, table_f=opts.table,
+                                   subjects=opts.subjects,
+                                   num_workers=opts.num_workers)
+    print(f"Parsed {n_parsed} stats files;"
+          f" {table.subject.nunique()} subjects in the table")
+
+    issues = qc_table(table)
+    if len(issues):
+        with pd.option_context('display.max_rows', None,
+                               'display.width', 200):
+            print(issues.to_string(index=False))
+    else:
+        print('No zero or missing tracts')
+    if opts.qc_out is not None:
+        issues.to_csv(opts.qc_out, index=False)